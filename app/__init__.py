@@ -11,7 +11,6 @@ if TYPE_CHECKING:
 
     from app.metrics.metric_reporting import MetricsReporter
 
-ONE_HOUR_IN_SECONDS = 3600
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 
 app = FastAPI(title="status-monitor")
@@ -24,7 +23,6 @@ async def startup_event():
     """Lifecycle event that is triggered when the application starts."""
     from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-    from app.metrics.iq_activity import clear_old_activity_files
     from app.metrics.metric_reporting import MetricsReporter
 
     logging.basicConfig(
@@ -44,7 +42,6 @@ async def startup_event():
     # Every hour, try to report collected metrics to the cloud. Run at 3 minutes past the hour, with a jitter of 120
     # seconds, to avoid every edge-endpoint report hitting the server at the exact same time.
     scheduler.add_job(reporter.report_metrics_to_cloud, "cron", hour="*", minute="3", jitter=120)
-    scheduler.add_job(clear_old_activity_files, "interval", seconds=ONE_HOUR_IN_SECONDS)
     scheduler.start()
 
 
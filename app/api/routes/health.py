@@ -2,6 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.responses import JSONResponse
 
 from app.core.app_state import AppState, get_app_state
+from app.metrics.runtime_stats import runtime_stats
 
 router = APIRouter()
 
@@ -30,3 +31,13 @@ async def readiness(app_state: AppState = Depends(get_app_state)) -> JSONRespons
     if not app_state.is_ready:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="not ready")
     return JSONResponse(content={"status": "ready"}, status_code=status.HTTP_200_OK)
+
+
+@router.get("/metrics")
+async def metrics() -> JSONResponse:
+    """
+    Report runtime statistics (admission control, result caches, etc.) for the worker process that handles the request.
+    Returns:
+        JSONResponse: A JSON response with the statistics of this worker process.
+    """
+    return JSONResponse(content=runtime_stats.snapshot(), status_code=status.HTTP_200_OK)
@@ -1,18 +1,29 @@
+import functools
 import logging
 import random
-from typing import Literal, Optional
+from typing import AsyncIterator, Literal, Optional
 
-from fastapi import (APIRouter, BackgroundTasks, Depends, HTTPException, Query,
-                     Request, status)
+from fastapi import (APIRouter, Depends, HTTPException, Query, Request,
+                     Response, status)
 from intellioptics import IntelliOptics
 from model import ImageQuery
+from PIL import Image
 
+from app.core.admission import AdmissionRejectedError
 from app.core.app_state import (AppState, get_app_state, get_detector_metadata,
-                                get_intellioptics_sdk_instance,
-                                refresh_detector_metadata_if_needed)
-from app.core.edge_inference import get_edge_inference_model_name
-from app.core.utils import create_iq, generate_metadata_dict, safe_call_sdk
+                                get_edge_iq_template,
+                                get_intellioptics_sdk_instance)
+from app.core.configs import EdgeInferenceConfig
+from app.core.edge_inference import (EdgeInferenceError,
+                                     get_edge_inference_model_name)
+from app.core.escalation_dispatcher import Escalation
+from app.core.image_preprocessing import get_image_dimensions
+from app.core.scheduling import InferenceSource
+from app.core.utils import (generate_metadata_dict, prefixed_ksuid,
+                            safe_call_sdk)
+from app.escalation_queue.models import SubmitImageQueryParams
 from app.metrics.iq_activity import record_activity_for_metrics
+from app.metrics.runtime_stats import runtime_stats
 
 logger = logging.getLogger(__name__)
 
@@ -27,8 +38,59 @@ async def validate_content_type(request: Request) -> str:
     return request.headers.get("Content-Type", "")
 
 
-async def validate_image_bytes(request: Request, content_type: str = Depends(validate_content_type)) -> bytes:
+async def admit_image_query(request: Request, app_state: AppState = Depends(get_app_state)) -> AsyncIterator[None]:
+    """
+    Reserve the request's share of the in-flight byte budget before its body is read, and hold it until the request
+    has been handled. Sheds the request with a 503 if the budget doesn't free up in time.
+    """
+    max_image_bytes = app_state.edge_config.global_config.max_image_bytes
+    content_length = request.headers.get("Content-Length", "")
+    # Without a Content-Length we can't know the size up front, so assume the worst
+    num_bytes = min(int(content_length), max_image_bytes) if content_length.isdigit() else max_image_bytes
+
+    try:
+        await app_state.admission_controller.acquire_bytes(num_bytes)
+    except AdmissionRejectedError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers=e.retry_after_header
+        ) from e
+    try:
+        yield
+    finally:
+        await app_state.admission_controller.release_bytes(num_bytes)
+
+
+async def validate_image_bytes(
+    request: Request,
+    content_type: str = Depends(validate_content_type),
+    app_state: AppState = Depends(get_app_state),
+    _admission: None = Depends(admit_image_query),  # The body is only read once the request has been admitted
+) -> bytes:
+    global_config = app_state.edge_config.global_config
+    too_large_detail = f"Image is larger than the maximum of {global_config.max_image_bytes} bytes"
+
+    # Reject oversized uploads before reading the body, when the client tells us the size up front
+    content_length = request.headers.get("Content-Length", "")
+    if content_length.isdigit() and int(content_length) > global_config.max_image_bytes:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=too_large_detail)
+
     image_bytes = await request.body()
+    if len(image_bytes) > global_config.max_image_bytes:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=too_large_detail)
+
+    # Only the image header is parsed here; images in formats we can't parse are passed through unchanged
+    try:
+        image_size = get_image_dimensions(image_bytes)
+    except Image.DecompressionBombError as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e)) from e
+    if image_size is not None and image_size[0] * image_size[1] > global_config.max_image_pixels:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=(
+                f"Image is {image_size[0]}x{image_size[1]}, which exceeds the maximum of "
+                f"{global_config.max_image_pixels} pixels"
+            ),
+        )
     return image_bytes
 
 
@@ -49,7 +111,6 @@ async def validate_query_params_for_edge(request: Request):
 @router.post("", response_model=ImageQuery)
 async def post_image_query(  # noqa: PLR0913, PLR0915, PLR0912
     request: Request,
-    background_tasks: BackgroundTasks,
     detector_id: str = Query(...),
     content_type: str = Depends(validate_content_type),
     image_bytes: bytes = Depends(validate_image_bytes),
@@ -86,7 +147,6 @@ async def post_image_query(  # noqa: PLR0913, PLR0915, PLR0912
     Dependencies:
         io (IntelliOptics): Application's IntelliOptics SDK instance.
         app_state (AppState): Application's state manager.
-        background_tasks (BackgroundTasks): FastAPI background tasks manager for asynchronous operations.
 
     Returns:
         ImageQuery: The submitted image query, potentially with results depending on the mode of operation.
@@ -131,105 +191,203 @@ async def post_image_query(  # noqa: PLR0913, PLR0915, PLR0912
         )
 
     # Confirm the existence of the detector in GL, get relevant metadata
-    detector_metadata = get_detector_metadata(detector_id=detector_id, io=io)  # NOTE: API call (once, then cached)
-    # Schedule a background task to refresh the detector metadata if it's too old
-    background_tasks.add_task(refresh_detector_metadata_if_needed, detector_id, io)
+    # NOTE: API call the first time the detector is used, then cached and refreshed in the background
+    detector_metadata = await get_detector_metadata(detector_id=detector_id, io=io)
 
     confidence_threshold = confidence_threshold or detector_metadata.confidence_threshold
 
     # for holding edge results if and when available
     results = None
+    # ID of the cloud image query submitted by a hedged edge inference request, if the edge answer won the race
+    hedged_image_query_id = None
 
     if require_human_review:
         # If human review is required, we should skip edge inference completely
         logger.debug("Received human_review=ALWAYS. Skipping edge inference.")
         record_activity_for_metrics(detector_id, activity_type="escalations")
+    elif app_state.edge_inference_manager.inference_circuit_is_open(detector_id=detector_id):
+        # The inference pods for this detector have been failing, so don't wait on them. Go straight to the cloud.
+        logger.debug(f"Circuit breaker is open for {detector_id=}. Skipping edge inference.")
+        runtime_stats.increment("circuit_breaker_skipped_edge", detector_id=detector_id)
+        if return_edge_prediction:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"Edge predictions are required, but edge inference is failing for {detector_id=}.",
+            )
     elif app_state.edge_inference_manager.inference_is_available(detector_id=detector_id):
         # -- Edge-model Inference --
         logger.debug(f"Local inference is available for {detector_id=}. Running inference...")
-        results = app_state.edge_inference_manager.run_inference(
-            detector_id=detector_id, image_bytes=image_bytes, content_type=content_type
+        max_concurrent_requests = (
+            detector_inference_config.max_concurrent_requests
+            if detector_inference_config is not None
+            else EdgeInferenceConfig().max_concurrent_requests
         )
-        ml_confidence = results["confidence"]
-
-        is_confident_enough = ml_confidence >= confidence_threshold
-        if return_edge_prediction or is_confident_enough:  # Return the edge prediction
-            if return_edge_prediction:
-                logger.debug(f"Returning edge prediction without cloud escalation. {detector_id=}")
-            else:
-                logger.debug(f"Edge detector confidence sufficient. {detector_id=}")
-
-            image_query = create_iq(
-                detector_id=detector_id,
-                mode=detector_metadata.mode,
-                mode_configuration=detector_metadata.mode_configuration,
-                result_value=results["label"],
-                confidence=ml_confidence,
-                confidence_threshold=confidence_threshold,
-                is_done_processing=True,
-                query=detector_metadata.query,
-                patience_time=patience_time,
-                rois=results["rois"],
-                text=results["text"],
-            )
-
-            # Skip cloud operations if escalation is disabled
-            if disable_cloud_escalation:
-                return image_query
-
-            if is_confident_enough:  # Audit confident edge predictions at the specified rate
-                if random.random() < app_state.edge_config.global_config.confident_audit_rate:
-                    logger.debug(
-                        f"Auditing confident edge prediction with confidence {ml_confidence} for detector {detector_id=}."
+        # Hedging only makes sense if the client is happy to get a cloud answer
+        hedge_to_cloud = (
+            detector_inference_config is not None
+            and detector_inference_config.hedge_to_cloud
+            and not return_edge_prediction
+        )
+        try:
+            await app_state.admission_controller.acquire_detector_slot(detector_id, max_concurrent_requests)
+            try:
+                edge_inference = app_state.edge_inference_manager.run_inference_async(
+                    detector_id=detector_id,
+                    image_bytes=image_bytes,
+                    content_type=content_type,
+                    source=InferenceSource.API,
+                    api_token=request.headers.get("x-api-token"),
+                )
+                if hedge_to_cloud:
+                    outcome = await app_state.request_hedger.run(
+                        detector_id=detector_id,
+                        inference_config=detector_inference_config,
+                        edge_inference=edge_inference,
+                        submit_to_cloud=functools.partial(
+                            safe_call_sdk,
+                            io.submit_image_query,
+                            detector=detector_id,
+                            image=image_bytes,
+                            patience_time=patience_time,
+                            confidence_threshold=confidence_threshold,
+                            human_review=human_review,
+                            metadata=generate_metadata_dict(results=None, is_edge_audit=False),
+                        ),
+                        is_usable=lambda edge_results: edge_results["confidence"] >= confidence_threshold,
+                        is_cloud_usable=lambda iq: (
+                            iq.result is not None and iq.result.confidence >= confidence_threshold
+                        ),
+                        escalate=functools.partial(
+                            _escalate_hedged_image_query,
+                            app_state=app_state,
+                            detector_id=detector_id,
+                            image_bytes=image_bytes,
+                            io=io,
+                            patience_time=patience_time,
+                            confidence_threshold=confidence_threshold,
+                            human_review=human_review,
+                        ),
                     )
-                    record_activity_for_metrics(detector_id, activity_type="audits")
-                    background_tasks.add_task(
-                        safe_call_sdk,
-                        io.submit_image_query,
-                        detector=detector_id,
-                        image=image_bytes,
-                        wait=0,
-                        patience_time=patience_time,
+                    if outcome.cloud_image_query is not None:
+                        return outcome.cloud_image_query
+                    results, hedged_image_query_id = outcome.edge_results, outcome.image_query_id
+                else:
+                    results = await edge_inference
+            finally:
+                await app_state.admission_controller.release_detector_slot(detector_id)
+        except AdmissionRejectedError as e:
+            # Too many requests are already waiting on this detector's inference pods. Shed load to the cloud.
+            logger.warning(f"Skipping edge inference for {detector_id=}: {e}")
+            if return_edge_prediction:
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e), headers=e.retry_after_header
+                ) from e
+        except EdgeInferenceError as e:
+            # Either the primary or the OODD inference call failed or missed its deadline. Fall back to the cloud.
+            logger.warning(f"Edge inference failed for {detector_id=}: {e}")
+            if return_edge_prediction:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail=f"Edge predictions are required, but edge inference failed for {detector_id=}.",
+                ) from e
+
+        if results is not None:
+            ml_confidence = results["confidence"]
+
+            is_confident_enough = ml_confidence >= confidence_threshold
+            if return_edge_prediction or is_confident_enough:  # Return the edge prediction
+                if return_edge_prediction:
+                    logger.debug(f"Returning edge prediction without cloud escalation. {detector_id=}")
+                else:
+                    logger.debug(f"Edge detector confidence sufficient. {detector_id=}")
+
+                # Edge answers are rendered straight to JSON from the detector's precompiled template, which skips
+                # building and re-validating the ImageQuery models (see `EdgeImageQueryTemplate`)
+                iq_template = get_edge_iq_template(detector_id=detector_id, detector_metadata=detector_metadata)
+                # If the request was hedged, the cloud image query with this ID was already submitted as an escalation
+                image_query_id = hedged_image_query_id or prefixed_ksuid(prefix="iq_")
+                is_done_processing = True
+                extra_metadata = {"from_edge_cache": True} if results.get("from_edge_cache") else None
+
+                # Skip cloud operations if escalation is disabled, or if they already happened while hedging
+                if not disable_cloud_escalation and hedged_image_query_id is None:
+                    if is_confident_enough:  # Audit confident edge predictions at the specified rate
+                        # Audits are skipped, rather than waited for, if there's no room left for them
+                        if random.random() < app_state.edge_config.global_config.confident_audit_rate and (
+                            app_state.escalation_dispatcher.accepts(is_audit=True)
+                        ):
+                            logger.debug(
+                                f"Auditing confident edge prediction with confidence {ml_confidence} for detector "
+                                f"{detector_id=}."
+                            )
+                            record_activity_for_metrics(detector_id, activity_type="audits")
+                            await app_state.escalation_dispatcher.submit(
+                                Escalation(
+                                    detector_id=detector_id,
+                                    image_bytes=image_bytes,
+                                    io=io,
+                                    submit_iq_params=SubmitImageQueryParams(
+                                        patience_time=patience_time,
+                                        confidence_threshold=confidence_threshold,
+                                        human_review=None,
+                                        metadata=generate_metadata_dict(results=results, is_edge_audit=True),
+                                        # We give the cloud IQ the same ID as the returned edge IQ
+                                        image_query_id=image_query_id,
+                                    ),
+                                    is_audit=True,
+                                )
+                            )
+                            # We keep done_processing=True here because although we escalated the query for an audit,
+                            # this is invisible to the user. From their perspective, this is the final answer.
+                    elif not app_state.escalation_dispatcher.accepts(is_audit=False):
+                        # Rather than wait for room, return the edge answer without escalating it
+                        logger.debug(f"Not escalating to cloud because the escalation queue is full: {detector_id=}")
+                    # Escalate after returning edge prediction if escalation is enabled and we have low confidence.
+                    # Only escalate if we haven't escalated on this detector too recently.
+                    elif app_state.edge_inference_manager.escalation_cooldown_complete(detector_id=detector_id):
+                        logger.debug(
+                            f"Escalating to cloud due to low confidence: {ml_confidence} < "
+                            f"thresh={confidence_threshold}"
+                        )
+                        record_activity_for_metrics(detector_id, activity_type="escalations")
+                        await app_state.escalation_dispatcher.submit(
+                            Escalation(
+                                detector_id=detector_id,
+                                image_bytes=image_bytes,
+                                io=io,
+                                submit_iq_params=SubmitImageQueryParams(
+                                    patience_time=patience_time,
+                                    confidence_threshold=confidence_threshold,
+                                    human_review=human_review,
+                                    metadata=generate_metadata_dict(results=results, is_edge_audit=False),
+                                    # Ensure the cloud IQ has the same ID as the returned edge IQ
+                                    image_query_id=image_query_id,
+                                ),
+                                is_audit=False,
+                            )
+                        )
+                        # Not done processing because the associated IQ in the cloud could get a better answer
+                        is_done_processing = False
+                    else:
+                        logger.debug(
+                            "Not escalating to cloud due to rate limit on background cloud escalations: "
+                            f"{detector_id=}"
+                        )
+
+                return Response(
+                    content=iq_template.render_json(
+                        image_query_id=image_query_id,
+                        result_value=results["label"],
+                        confidence=ml_confidence,
                         confidence_threshold=confidence_threshold,
-                        want_async=True,
-                        metadata=generate_metadata_dict(results=results, is_edge_audit=True),
-                        image_query_id=image_query.id,  # We give the cloud IQ the same ID as the returned edge IQ
-                    )
-                    # We keep done_processing=True here because although we escalated the query for an audit, this is
-                    # invisible to the user. From their perspective, this is the final answer.
-
-                    # Don't want to escalate to cloud again if we're already auditing the query
-                    return image_query
-
-            # Escalate after returning edge prediction if escalation is enabled and we have low confidence.
-            if not is_confident_enough:
-                # Only escalate if we haven't escalated on this detector too recently.
-                if app_state.edge_inference_manager.escalation_cooldown_complete(detector_id=detector_id):
-                    logger.debug(
-                        f"Escalating to cloud due to low confidence: {ml_confidence} < thresh={confidence_threshold}"
-                    )
-                    record_activity_for_metrics(detector_id, activity_type="escalations")
-                    background_tasks.add_task(
-                        safe_call_sdk,
-                        io.submit_image_query,  # This has to be submit_image_query in order to specify image_query_id
-                        detector=detector_id,
-                        image=image_bytes,
-                        wait=0,
+                        is_done_processing=is_done_processing,
                         patience_time=patience_time,
-                        confidence_threshold=confidence_threshold,
-                        human_review=human_review,
-                        want_async=True,
-                        metadata=generate_metadata_dict(results=results, is_edge_audit=False),
-                        image_query_id=image_query.id,  # Ensure the cloud IQ has the same ID as the returned edge IQ
-                    )
-                    # Not done processing because the associated IQ in the cloud could get a better answer
-                    image_query.done_processing = False
-                else:
-                    logger.debug(
-                        f"Not escalating to cloud due to rate limit on background cloud escalations: {detector_id=}"
-                    )
-
-            return image_query
+                        rois=results["rois"],
+                        text=results["text"],
+                        extra_metadata=extra_metadata,
+                    ),
+                    media_type="application/json",
+                )
     else:
         # -- Edge-inference is not available --
         # Create an edge-inference deployment record, which may be used to spin up an edge-inference server.
@@ -279,3 +437,37 @@ async def post_image_query(  # noqa: PLR0913, PLR0915, PLR0912
         human_review=human_review,
         metadata=generate_metadata_dict(results=results, is_edge_audit=False),
     )
+
+
+async def _escalate_hedged_image_query(  # noqa: PLR0913
+    image_query_id: str,
+    app_state: AppState,
+    detector_id: str,
+    image_bytes: bytes,
+    io: IntelliOptics,
+    patience_time: Optional[float],
+    confidence_threshold: float,
+    human_review: Optional[str],
+) -> None:
+    """
+    Escalates an image query whose hedged cloud submission failed after its edge answer was returned, so that the ID
+    the client was given exists in the cloud.
+    """
+    if not app_state.escalation_dispatcher.accepts(is_audit=False):
+        logger.warning(f"Not escalating hedged image query {image_query_id} because the escalation queue is full.")
+        return
+    await app_state.escalation_dispatcher.submit(
+        Escalation(
+            detector_id=detector_id,
+            image_bytes=image_bytes,
+            io=io,
+            submit_iq_params=SubmitImageQueryParams(
+                patience_time=patience_time,
+                confidence_threshold=confidence_threshold,
+                human_review=human_review,
+                metadata=generate_metadata_dict(results=None, is_edge_audit=False),
+                image_query_id=image_query_id,
+            ),
+            is_audit=False,
+        )
+    )
@@ -0,0 +1,110 @@
+"""Admission control and load shedding for image queries.
+
+Without limits, a burst of large uploads is buffered in memory without bound and piles up on the inference pods until
+they start timing out. The `AdmissionController` bounds two things for each worker process:
+    - the total size of the image bodies currently being handled, and
+    - the number of concurrent edge inference requests for each detector.
+Requests that can't be admitted wait for a short, bounded time and are then shed.
+"""
+
+import asyncio
+import logging
+import math
+import time
+from collections import defaultdict
+from typing import Callable
+
+from app.metrics.runtime_stats import runtime_stats
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejectedError(Exception):
+    """Raised when a request can't be admitted before its wait deadline."""
+
+    def __init__(self, message: str, retry_after_sec: float):
+        super().__init__(message)
+        self.retry_after_sec = retry_after_sec
+
+    @property
+    def retry_after_header(self) -> dict[str, str]:
+        """The `Retry-After` header to return with the rejection. Must be a whole number of seconds."""
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after_sec)))}
+
+
+class AdmissionController:
+    """
+    Tracks in-flight work and decides whether new work can be admitted.
+
+    A request that would exceed a limit waits up to `max_wait_sec` for capacity to free up, after which an
+    `AdmissionRejectedError` is raised. A single request larger than the whole byte budget is still admitted once
+    nothing else is in flight, so that it isn't rejected forever.
+    """
+
+    def __init__(self, max_inflight_bytes: int, max_wait_sec: float, retry_after_sec: float):
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_wait_sec = max_wait_sec
+        self.retry_after_sec = retry_after_sec
+        self.inflight_bytes = 0
+        self.inflight_requests_per_detector: dict[str, int] = defaultdict(int)
+        self._condition = asyncio.Condition()
+
+    async def acquire_bytes(self, num_bytes: int) -> None:
+        """Reserve `num_bytes` of the in-flight byte budget. Must be paired with `release_bytes`."""
+
+        def can_admit() -> bool:
+            return self.inflight_bytes == 0 or self.inflight_bytes + num_bytes <= self.max_inflight_bytes
+
+        def admit() -> None:
+            self.inflight_bytes += num_bytes
+
+        await self._acquire(can_admit, admit, reason="inflight_bytes")
+
+    async def release_bytes(self, num_bytes: int) -> None:
+        async with self._condition:
+            self.inflight_bytes -= num_bytes
+            self._condition.notify_all()
+
+    async def acquire_detector_slot(self, detector_id: str, max_concurrent_requests: int) -> None:
+        """Reserve one of the detector's concurrent inference slots. Must be paired with `release_detector_slot`."""
+
+        def can_admit() -> bool:
+            return self.inflight_requests_per_detector[detector_id] < max_concurrent_requests
+
+        def admit() -> None:
+            self.inflight_requests_per_detector[detector_id] += 1
+
+        await self._acquire(can_admit, admit, reason="detector_concurrency", detector_id=detector_id)
+
+    async def release_detector_slot(self, detector_id: str) -> None:
+        async with self._condition:
+            self.inflight_requests_per_detector[detector_id] -= 1
+            if self.inflight_requests_per_detector[detector_id] <= 0:
+                del self.inflight_requests_per_detector[detector_id]
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            "inflight_bytes": self.inflight_bytes,
+            "max_inflight_bytes": self.max_inflight_bytes,
+            "inflight_requests_per_detector": dict(self.inflight_requests_per_detector),
+        }
+
+    async def _acquire(
+        self, can_admit: Callable[[], bool], admit: Callable[[], None], reason: str, detector_id: str | None = None
+    ) -> None:
+        labels = {"reason": reason} if detector_id is None else {"reason": reason, "detector_id": detector_id}
+        start_time = time.perf_counter()
+        async with self._condition:
+            if not can_admit():
+                try:
+                    await asyncio.wait_for(self._condition.wait_for(can_admit), timeout=self.max_wait_sec)
+                except asyncio.TimeoutError:
+                    runtime_stats.increment("admission_shed", **labels)
+                    logger.warning(f"Shedding request after waiting {self.max_wait_sec}s for admission ({labels}).")
+                    raise AdmissionRejectedError(
+                        f"The edge endpoint is overloaded ({reason}). Please retry later.", self.retry_after_sec
+                    ) from None
+            admit()
+        runtime_stats.increment("admission_admitted", **labels)
+        runtime_stats.observe_ms("admission_wait", (time.perf_counter() - start_time) * 1000, **labels)
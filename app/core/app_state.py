@@ -1,19 +1,28 @@
 import logging
 import os
 import time
-from functools import lru_cache
 
 import cachetools
 import yaml
 from fastapi import Request
 from intellioptics import IntelliOptics
 from model import Detector
+from pydantic import ValidationError
 
-from .configs import EdgeInferenceConfig, RootEdgeConfig
+from app.escalation_queue.queue_writer import QueueWriter
+from app.metrics.runtime_stats import runtime_stats
+
+from .admission import AdmissionController
+from .configs import EdgeInferenceConfig, GlobalConfig, RootEdgeConfig
 from .database import DatabaseManager
+from .detector_metadata import DetectorMetadataCache
 from .edge_inference import EdgeInferenceManager
-from .file_paths import DEFAULT_EDGE_CONFIG_PATH
-from .utils import TimestampedCache, safe_call_sdk
+from .escalation_dispatcher import EscalationDispatcher
+from .file_paths import DEFAULT_EDGE_CONFIG_PATH, SHARED_STATE_PATH_PREFIX
+from .hedging import RequestHedger
+from .sdk_instances import SdkInstanceCache
+from .shared_state import SharedState, open_shared_state
+from .utils import EdgeImageQueryTemplate, safe_call_sdk
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +30,9 @@ MAX_SDK_INSTANCES_CACHE_SIZE = 1000
 MAX_DETECTOR_IDS_CACHE_SIZE = 1000
 STALE_METADATA_THRESHOLD_SEC = 30  # 30 seconds
 
+# State shared with the other edge-endpoint workers in this pod, if enabled. Set when the AppState is created.
+shared_state: SharedState | None = None
+
 
 def load_edge_config() -> RootEdgeConfig:
     """
@@ -84,9 +96,8 @@ def get_detector_inference_configs(
     return detector_to_inference_config
 
 
-@lru_cache(maxsize=MAX_SDK_INSTANCES_CACHE_SIZE)
-def _get_intellioptics_sdk_instance_internal(api_token: str):
-    return IntelliOptics(api_token=api_token)
+# SDK instances for each API token, sharing one pool of connections to the cloud
+sdk_instances = SdkInstanceCache(maxsize=MAX_SDK_INSTANCES_CACHE_SIZE)
 
 
 def get_intellioptics_sdk_instance(request: Request):
@@ -96,62 +107,148 @@ def get_intellioptics_sdk_instance(request: Request):
     need to do that here.
     """
     api_token = request.headers.get("x-api-token")
-    return _get_intellioptics_sdk_instance_internal(api_token)
+    return sdk_instances.get(api_token)
 
 
-def refresh_detector_metadata_if_needed(detector_id: str, io: IntelliOptics) -> None:
+def fetch_detector_metadata(detector_id: str, io: IntelliOptics) -> tuple[Detector, float]:
     """
-    Check if detector metadata needs refreshing based on age of cached value and refresh it if it's too old.
-    If the refresh fails, the stale cached metadata is restored.
+    Fetches detector metadata from the IntelliOptics API, returning it along with the time it was fetched. With shared
+    state, metadata that another worker fetched recently is used instead of calling the API.
     """
-    metadata_cache: TimestampedCache = get_detector_metadata.cache
-    cached_value_timestamp = metadata_cache.get_timestamp(detector_id)
-    if cached_value_timestamp is not None:
-        cached_value_age = time.monotonic() - cached_value_timestamp
-        if cached_value_age > STALE_METADATA_THRESHOLD_SEC:
-            logger.info(f"Detector metadata for {detector_id=} is stale. Attempting to refresh...")
-            metadata_cache.suspend_cached_value(detector_id)
-
-            try:
-                # Repopulate the cache with fresh metadata
-                get_detector_metadata(detector_id=detector_id, io=io)
-                metadata_cache.delete_suspended_value(detector_id)
-                logger.info(f"Detector metadata for {detector_id=} refreshed successfully.")
-            except KeyError:
-                # This shouldn't happen, but if we fail to delete the suspended value we don't want to try to restore it
-                logger.warning(
-                    f"After fetching new metadata, did not successfully delete suspended value for {detector_id=}. "
-                    "This is unexpected."
-                )
-            except Exception as e:
-                logger.error(
-                    f"Failed to refresh detector metadata for {detector_id=}: {e}. Restoring stale cached metadata."
-                )
-                metadata_cache.restore_suspended_value(detector_id)
-
-
-@cachetools.cached(
-    cache=TimestampedCache(maxsize=MAX_DETECTOR_IDS_CACHE_SIZE),
-    key=lambda detector_id, io: detector_id,
+    shared_metadata = _get_shared_detector_metadata(detector_id)
+    if shared_metadata is not None:
+        return shared_metadata
+
+    detector = safe_call_sdk(io.get_detector, id=detector_id)
+    if shared_state is not None:
+        shared_state.publish_detector_metadata(detector_id, detector.model_dump_json().encode())
+    return detector, time.monotonic()
+
+
+def _get_shared_detector_metadata(detector_id: str) -> tuple[Detector, float] | None:
+    """Returns the detector's metadata and fetch time if another worker shared it recently."""
+    shared_metadata = shared_state.get_detector_metadata(detector_id) if shared_state is not None else None
+    if shared_metadata is None:
+        return None
+    fetched_at, metadata_json = shared_metadata
+    # Metadata that is nearly due for a refresh itself isn't worth taking; fetch it from the API instead
+    if time.monotonic() - fetched_at > STALE_METADATA_THRESHOLD_SEC / 2:
+        return None
+    try:
+        return Detector.model_validate_json(metadata_json), fetched_at
+    except ValidationError as e:
+        logger.warning(f"Ignoring invalid shared metadata for {detector_id=}: {e}")
+        return None
+
+
+detector_metadata_cache = DetectorMetadataCache(
+    fetch_metadata=fetch_detector_metadata,
+    max_size=MAX_DETECTOR_IDS_CACHE_SIZE,
+    refresh_after_sec=STALE_METADATA_THRESHOLD_SEC,
 )
-def get_detector_metadata(detector_id: str, io: IntelliOptics) -> Detector:
+
+
+async def get_detector_metadata(detector_id: str, io: IntelliOptics) -> Detector:
     """
     Returns detector metadata from the IntelliOptics API.
-    Caches the result so that we don't have to make an expensive API call every time.
+    The metadata is cached and refreshed in the background, so this only waits on the API the first time a detector
+    is used (unless it was prefetched from the edge config).
     """
-    detector = safe_call_sdk(io.get_detector, id=detector_id)
-    return detector
+    return await detector_metadata_cache.get(detector_id, io)
+
+
+# Precompiled edge answer templates, keyed by detector ID. Each entry also holds the detector metadata the template was
+# built from, so that the template is rebuilt whenever the cached metadata is refreshed.
+edge_iq_template_cache: cachetools.LRUCache = cachetools.LRUCache(maxsize=MAX_DETECTOR_IDS_CACHE_SIZE)
+
+
+def get_edge_iq_template(detector_id: str, detector_metadata: Detector) -> EdgeImageQueryTemplate:
+    """
+    Returns the precompiled response template for a detector's edge answers, building it from the detector metadata
+    if it isn't cached or was built from older metadata.
+    """
+    cached = edge_iq_template_cache.get(detector_id)
+    if cached is not None and cached[0] is detector_metadata:
+        return cached[1]
+
+    template = EdgeImageQueryTemplate(
+        detector_id=detector_id,
+        mode=detector_metadata.mode,
+        mode_configuration=detector_metadata.mode_configuration,
+        query=detector_metadata.query,
+    )
+    edge_iq_template_cache[detector_id] = (detector_metadata, template)
+    return template
+
+
+def _create_queue_writer(global_config: GlobalConfig) -> QueueWriter | None:
+    """Creates a writer for the on-disk escalation queue, or returns None if the queue directory isn't writable."""
+    try:
+        return QueueWriter(
+            commit_interval_sec=global_config.escalation_queue_commit_interval,
+            fsync_policy=global_config.escalation_queue_fsync,
+            max_bytes=global_config.escalation_queue_max_mb * 1024 * 1024,
+            max_records=global_config.escalation_queue_max_records,
+        )
+    except OSError as e:
+        logger.warning(f"Can't write to the escalation queue, escalations that can't be submitted will be dropped: {e}")
+        return None
 
 
 class AppState:
     def __init__(self):
+        global shared_state
+
         self.edge_config = load_edge_config()
+        global_config = self.edge_config.global_config
+        self.shared_state = open_shared_state(SHARED_STATE_PATH_PREFIX) if global_config.shared_state_enabled else None
+        shared_state = self.shared_state
         detector_inference_configs = get_detector_inference_configs(root_edge_config=self.edge_config)
-        self.edge_inference_manager = EdgeInferenceManager(detector_inference_configs=detector_inference_configs)
+        self.edge_inference_manager = EdgeInferenceManager(
+            detector_inference_configs=detector_inference_configs,
+            global_config=global_config,
+            scheduling_config=self.edge_config.scheduling,
+            shared_state=self.shared_state,
+        )
+        self.admission_controller = AdmissionController(
+            max_inflight_bytes=global_config.max_inflight_image_bytes,
+            max_wait_sec=global_config.admission_max_wait,
+            retry_after_sec=global_config.admission_retry_after,
+        )
+        self.request_hedger = RequestHedger(speedmon=self.edge_inference_manager.speedmon)
+        self.escalation_dispatcher = EscalationDispatcher(
+            global_config, queue_writer=_create_queue_writer(global_config)
+        )
+        runtime_stats.register_collector("admission", self.admission_controller.stats)
+        runtime_stats.register_collector("result_caches", self.edge_inference_manager.result_cache_stats)
+        runtime_stats.register_collector("circuit_breakers", self.edge_inference_manager.circuit_breakers.stats)
+        runtime_stats.register_collector("hedging", self.request_hedger.stats_snapshot)
+        runtime_stats.register_collector("escalations", self.escalation_dispatcher.stats)
+        if self.edge_inference_manager.scheduler is not None:
+            runtime_stats.register_collector("scheduler", self.edge_inference_manager.scheduler.stats)
+        if self.shared_state is not None:
+            runtime_stats.register_collector("shared_state", self.shared_state.stats)
+        runtime_stats.register_collector("detector_metadata_cache", detector_metadata_cache.stats)
+        runtime_stats.register_collector("sdk_instances", sdk_instances.stats)
         self.db_manager = DatabaseManager()
         self.stream_configs = self.edge_config.streams
         self.is_ready = False
 
+    def get_prefetch_sdk_instances(self) -> dict[str, IntelliOptics]:
+        """
+        Returns an SDK instance for each detector in the edge config, for prefetching the detector's metadata. Uses the
+        detector's API token if its inference config has one, and otherwise the edge endpoint's API token.
+        """
+        default_api_token = os.environ.get("INTELLIOPTICS_API_TOKEN")
+        prefetch_sdk_instances = {}
+        for detector_id, inference_config in (self.edge_inference_manager.detector_inference_configs or {}).items():
+            api_token = inference_config.api_token or default_api_token
+            if not api_token:
+                logger.info(f"No API token to prefetch detector metadata for {detector_id=} with, skipping.")
+                continue
+            prefetch_sdk_instances[detector_id] = sdk_instances.get(api_token)
+        return prefetch_sdk_instances
+
 
 def get_app_state(request: Request) -> AppState:
     if not hasattr(request.app.state, "app_state"):
@@ -0,0 +1,189 @@
+"""Circuit breakers for the edge inference services.
+
+When an inference pod starts erroring or timing out, sending it every request only adds latency before the inevitable
+cloud fallback, and piles more load on a pod that is already struggling. Each inference service URL gets its own
+`CircuitBreaker`, which watches the outcome and latency of recent calls:
+    - CLOSED: calls go through. If too many recent calls failed or were too slow, the breaker opens.
+    - OPEN: calls are rejected immediately, so requests go straight to the cloud. After the open interval, the breaker
+      becomes half-open.
+    - HALF_OPEN: a single probe call is let through. If it succeeds, the breaker closes. If it fails, the breaker opens
+      again, for twice as long as the previous time (up to a maximum).
+"""
+
+import logging
+import time
+from collections import deque
+from enum import Enum
+
+from app.core.configs import GlobalConfig
+from app.metrics.runtime_stats import runtime_stats
+
+logger = logging.getLogger(__name__)
+
+
+class BreakerState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Tracks the health of calls to a single inference service and decides whether new calls are allowed."""
+
+    def __init__(
+        self,
+        name: str,
+        window_sec: float,
+        min_requests: int,
+        error_rate_threshold: float,
+        slow_call_ms: float | None,
+        open_duration_sec: float,
+        max_open_duration_sec: float,
+    ) -> None:
+        self.name = name
+        self.window_sec = window_sec
+        self.min_requests = min_requests
+        self.error_rate_threshold = error_rate_threshold
+        self.slow_call_ms = slow_call_ms
+        self.open_duration_sec = open_duration_sec
+        self.max_open_duration_sec = max_open_duration_sec
+
+        self.state = BreakerState.CLOSED
+        self.opened_at: float | None = None
+        self.current_open_duration_sec = open_duration_sec
+        self._probe_in_flight = False
+        # (timestamp, failed) for each call that finished within the last `window_sec`
+        self._outcomes: deque[tuple[float, bool]] = deque()
+        self._num_failures = 0
+
+    def rejects_requests(self) -> bool:
+        """Whether a new call would be rejected right now. Unlike `allow_request`, this doesn't change any state."""
+        if self.state == BreakerState.OPEN:
+            return time.monotonic() - self.opened_at < self.current_open_duration_sec
+        if self.state == BreakerState.HALF_OPEN:
+            return self._probe_in_flight
+        return False
+
+    def allow_request(self) -> bool:
+        """
+        Whether a call can be made now. Every allowed call must be followed by `record_success`, `record_failure` or
+        `record_cancelled`.
+        """
+        if self.state == BreakerState.OPEN:
+            if time.monotonic() - self.opened_at < self.current_open_duration_sec:
+                return False
+            self._transition(BreakerState.HALF_OPEN)
+
+        if self.state == BreakerState.HALF_OPEN:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self, latency_ms: float) -> None:
+        if self.slow_call_ms is not None and latency_ms > self.slow_call_ms:
+            self.record_failure()
+            return
+
+        if self.state == BreakerState.HALF_OPEN:
+            self._probe_in_flight = False
+            self.current_open_duration_sec = self.open_duration_sec
+            self._transition(BreakerState.CLOSED)
+            return
+        self._record_outcome(failed=False)
+
+    def record_failure(self) -> None:
+        if self.state == BreakerState.HALF_OPEN:
+            self._probe_in_flight = False
+            self.current_open_duration_sec = min(self.current_open_duration_sec * 2, self.max_open_duration_sec)
+            self._open()
+            return
+        if self.state == BreakerState.OPEN:
+            return  # A call that started before the breaker opened
+
+        self._record_outcome(failed=True)
+        num_calls = len(self._outcomes)
+        if num_calls >= self.min_requests and self._num_failures / num_calls >= self.error_rate_threshold:
+            logger.warning(
+                f"Opening the circuit breaker for {self.name}: {self._num_failures} of the last {num_calls} calls "
+                "failed or were too slow."
+            )
+            self._open()
+
+    def record_cancelled(self) -> None:
+        """Record that an allowed call was abandoned before it finished, e.g. because its sibling call failed."""
+        if self.state == BreakerState.HALF_OPEN:
+            self._probe_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state.value,
+            "recent_calls": len(self._outcomes),
+            "recent_failures": self._num_failures,
+            "open_duration_sec": self.current_open_duration_sec,
+        }
+
+    def _record_outcome(self, failed: bool) -> None:
+        now = time.monotonic()
+        self._outcomes.append((now, failed))
+        self._num_failures += failed
+        while self._outcomes and now - self._outcomes[0][0] > self.window_sec:
+            _, expired_failed = self._outcomes.popleft()
+            self._num_failures -= expired_failed
+
+    def _open(self) -> None:
+        self.opened_at = time.monotonic()
+        self._transition(BreakerState.OPEN)
+
+    def _transition(self, new_state: BreakerState) -> None:
+        old_state = self.state
+        self.state = new_state
+        if new_state != BreakerState.HALF_OPEN:
+            # Each state judges the service on calls made while it was in that state
+            self._outcomes.clear()
+            self._num_failures = 0
+        runtime_stats.increment(
+            "circuit_breaker_transitions", service=self.name, from_state=old_state.value, to_state=new_state.value
+        )
+        log = logger.info if new_state != BreakerState.OPEN else logger.warning
+        log(
+            f"Circuit breaker for {self.name} went from {old_state.value} to {new_state.value}."
+            + (f" Retrying in {self.current_open_duration_sec}s." if new_state == BreakerState.OPEN else "")
+        )
+
+
+class CircuitBreakerRegistry:
+    """Creates and holds one `CircuitBreaker` per inference service URL."""
+
+    def __init__(self, global_config: GlobalConfig) -> None:
+        self.config = global_config
+        self.breakers: dict[str, CircuitBreaker] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.circuit_breaker_enabled
+
+    def get(self, inference_client_url: str) -> CircuitBreaker:
+        breaker = self.breakers.get(inference_client_url)
+        if breaker is None:
+            config = self.config
+            breaker = CircuitBreaker(
+                name=inference_client_url,
+                window_sec=config.circuit_breaker_window,
+                min_requests=config.circuit_breaker_min_requests,
+                error_rate_threshold=config.circuit_breaker_error_rate,
+                slow_call_ms=config.circuit_breaker_slow_call_ms,
+                open_duration_sec=config.circuit_breaker_open_duration,
+                max_open_duration_sec=config.circuit_breaker_max_open_duration,
+            )
+            self.breakers[inference_client_url] = breaker
+        return breaker
+
+    def rejects_requests(self, inference_client_url: str) -> bool:
+        if not self.enabled:
+            return False
+        breaker = self.breakers.get(inference_client_url)
+        return breaker is not None and breaker.rejects_requests()
+
+    def stats(self) -> dict[str, dict]:
+        return {url: breaker.stats() for url, breaker in self.breakers.items()}
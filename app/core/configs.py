@@ -9,6 +9,12 @@ from typing_extensions import Self
 logger = logging.getLogger(__name__)
 
 
+class QueueFsyncPolicy(str, Enum):
+    NONE = "none"  # Leave it to the OS to write escalations to disk
+    INTERVAL = "interval"  # Sync each group commit to disk
+    ALWAYS = "always"  # Sync each escalation to disk before moving on
+
+
 class GlobalConfig(BaseModel):
     refresh_rate: float = Field(
         default=60.0,
@@ -18,6 +24,142 @@ class GlobalConfig(BaseModel):
         default=1e-5,  # A detector running at 1 FPS = ~100,000 IQ/day, so 1e-5 is ~1 confident IQ/day audited
         description="The probability that any given confident prediction will be sent to the cloud for auditing.",
     )
+    health_probe_interval: float = Field(
+        default=2.0,
+        gt=0.0,
+        description="The interval (in seconds) at which the readiness of each inference server is probed.",
+    )
+    health_probe_timeout: float = Field(
+        default=1.0, gt=0.0, description="Timeout (in seconds) for each inference server readiness probe."
+    )
+    health_probe_failure_threshold: int = Field(
+        default=2,
+        ge=1,
+        description="Number of consecutive failed probes before an inference server is considered not ready.",
+    )
+    max_image_bytes: int = Field(
+        default=32 * 1024 * 1024,
+        ge=1,
+        description="Image queries with a larger body (in bytes) are rejected with a 413 before any processing.",
+    )
+    max_image_pixels: int = Field(
+        default=100_000_000,
+        ge=1,
+        description="Image queries whose image has more pixels than this (width * height) are rejected with a 413.",
+    )
+    max_inflight_image_bytes: int = Field(
+        default=512 * 1024 * 1024,
+        ge=1,
+        description=(
+            "Maximum total size (in bytes) of the image queries that each edge-endpoint worker handles at once. "
+            "Requests beyond this budget wait briefly and are then rejected with a 503."
+        ),
+    )
+    admission_max_wait: float = Field(
+        default=0.5,
+        ge=0.0,
+        description="Maximum time (in seconds) a request waits for capacity before it is shed.",
+    )
+    admission_retry_after: float = Field(
+        default=1.0,
+        gt=0.0,
+        description="Value (in seconds) of the Retry-After header returned with shed requests.",
+    )
+    shared_state_enabled: bool = Field(
+        default=True,
+        description=(
+            "Share detector metadata, inference server readiness, escalation cooldowns and inference speed between "
+            "the edge-endpoint worker processes, through shared memory."
+        ),
+    )
+    circuit_breaker_enabled: bool = Field(
+        default=True,
+        description="Whether to stop sending requests to inference servers that keep failing or timing out.",
+    )
+    circuit_breaker_window: float = Field(
+        default=30.0,
+        gt=0.0,
+        description="The window (in seconds) of recent calls used to compute an inference server's error rate.",
+    )
+    circuit_breaker_min_requests: int = Field(
+        default=10,
+        ge=1,
+        description="Minimum number of calls in the window before an inference server's circuit breaker can open.",
+    )
+    circuit_breaker_error_rate: float = Field(
+        default=0.5,
+        gt=0.0,
+        le=1.0,
+        description="Fraction of failed (or slow) calls in the window at which an inference server's breaker opens.",
+    )
+    circuit_breaker_slow_call_ms: float | None = Field(
+        default=None,
+        gt=0.0,
+        description="If set, successful calls that take longer than this (in milliseconds) count as failures.",
+    )
+    circuit_breaker_open_duration: float = Field(
+        default=2.0,
+        gt=0.0,
+        description=(
+            "How long (in seconds) an open breaker rejects calls before letting a probe call through. Doubles every "
+            "time the probe fails."
+        ),
+    )
+    circuit_breaker_max_open_duration: float = Field(
+        default=60.0,
+        gt=0.0,
+        description="Upper bound (in seconds) on how long an open breaker rejects calls before probing again.",
+    )
+    escalation_workers: int = Field(
+        default=4,
+        ge=1,
+        description="Number of workers that submit audits and escalations to the cloud in the background.",
+    )
+    escalation_queue_size: int = Field(
+        default=200,
+        ge=1,
+        description=(
+            "Maximum number of audits and escalations waiting in memory to be submitted to the cloud. Beyond this, "
+            "they are left to the escalation queue uploader."
+        ),
+    )
+    escalation_max_attempts: int = Field(
+        default=3,
+        ge=1,
+        description=(
+            "How many times to try submitting an audit or escalation before leaving it to the escalation queue "
+            "uploader."
+        ),
+    )
+    escalation_retry_backoff: float = Field(
+        default=0.5,
+        ge=0.0,
+        description="Delay (in seconds) before the first retry of a failed submission. Doubles with each retry.",
+    )
+    escalation_queue_commit_interval: float = Field(
+        default=0.05,
+        ge=0.0,
+        description=(
+            "Escalations written to the on-disk escalation queue are buffered and written together at this interval "
+            "(in seconds). 0 writes each escalation immediately."
+        ),
+    )
+    escalation_queue_fsync: QueueFsyncPolicy = Field(
+        default=QueueFsyncPolicy.INTERVAL,
+        description="When escalations written to the on-disk escalation queue are synced to disk.",
+    )
+    escalation_queue_max_mb: int = Field(
+        default=2048,
+        ge=0,
+        description=(
+            "Maximum size (in MiB) of the escalations and their images in the on-disk escalation queue. 0 for no limit."
+        ),
+    )
+    escalation_queue_max_records: int = Field(
+        default=100_000,
+        ge=0,
+        description="Maximum number of escalations in the on-disk escalation queue. 0 for no limit.",
+    )
 
 
 class EdgeInferenceConfig(BaseModel):
@@ -54,6 +196,117 @@ class EdgeInferenceConfig(BaseModel):
             "Only applies when `always_return_edge_prediction=True` and `disable_cloud_escalation=False`."
         ),
     )
+    inference_timeout: float = Field(
+        default=10.0,
+        gt=0.0,
+        description="Timeout (in seconds) applied to each request sent to this detector's inference services.",
+    )
+    max_inference_connections: int = Field(
+        default=32,
+        ge=1,
+        description="Maximum number of concurrent connections to each of this detector's inference services.",
+    )
+    max_keepalive_inference_connections: int = Field(
+        default=8,
+        ge=0,
+        description="Maximum number of idle keep-alive connections kept open to each inference service.",
+    )
+    max_batch_size: int = Field(
+        default=1,
+        ge=1,
+        description=(
+            "Maximum number of concurrent requests for this detector that are coalesced into a single inference batch. "
+            "A value of 1 disables micro-batching."
+        ),
+    )
+    max_batch_wait_ms: float = Field(
+        default=5.0,
+        ge=0.0,
+        description="Maximum time (in milliseconds) to wait for more requests before dispatching a partial batch.",
+    )
+    max_batch_queue_depth: int = Field(
+        default=64,
+        ge=1,
+        description=(
+            "Maximum number of requests waiting to be batched for this detector. Requests beyond this limit skip edge "
+            "inference and fall back to the cloud."
+        ),
+    )
+    result_cache_enabled: bool = Field(
+        default=False,
+        description=(
+            "Reuse recent inference results for near-duplicate images, as determined by a perceptual hash of the image."
+        ),
+    )
+    result_cache_max_hamming_distance: int = Field(
+        default=2,
+        ge=0,
+        le=64,
+        description="Maximum Hamming distance between 64-bit image hashes for two images to be considered duplicates.",
+    )
+    result_cache_ttl: float = Field(
+        default=5.0,
+        gt=0.0,
+        description="How long (in seconds) a cached inference result can be reused for.",
+    )
+    result_cache_max_entries: int = Field(
+        default=128, ge=1, description="Maximum number of inference results cached for this detector."
+    )
+    result_cache_max_bytes: int = Field(
+        default=1_000_000, ge=1, description="Maximum total size (in bytes) of the results cached for this detector."
+    )
+    max_concurrent_requests: int = Field(
+        default=32,
+        ge=1,
+        description=(
+            "Maximum number of concurrent edge inference requests for this detector, per edge-endpoint worker. "
+            "Requests beyond this limit are escalated to the cloud, or rejected with a 429 if edge predictions are "
+            "required."
+        ),
+    )
+    max_image_dimension: int | None = Field(
+        default=None,
+        ge=1,
+        description=(
+            "If set, images whose width or height exceeds this many pixels are downscaled (preserving the aspect "
+            "ratio) and re-encoded before being sent to the inference services. Escalations always use the original "
+            "image."
+        ),
+    )
+    reencode_quality: int = Field(
+        default=90, ge=1, le=95, description="JPEG quality used when re-encoding downscaled images."
+    )
+    use_unix_socket: bool = Field(
+        default=False,
+        description=(
+            "Send inference requests over a Unix domain socket shared with the inference pods, when the socket is "
+            "available, instead of over TCP through the Kubernetes service. Falls back to TCP automatically."
+        ),
+    )
+    hedge_to_cloud: bool = Field(
+        default=False,
+        description=(
+            "If edge inference is slower than usual, also submit the image query to the cloud and return whichever "
+            "usable answer arrives first. Ignored when `always_return_edge_prediction=True`."
+        ),
+    )
+    hedge_latency_percentile: float = Field(
+        default=95.0,
+        gt=0.0,
+        le=100.0,
+        description="Submit to the cloud once edge inference has taken longer than this percentile of recent latency.",
+    )
+    hedge_min_delay_ms: float = Field(
+        default=100.0,
+        ge=0.0,
+        description="Never submit a hedged request to the cloud before edge inference has taken this long.",
+    )
+    max_hedge_rate: float = Field(
+        default=0.1,
+        ge=0.0,
+        le=1.0,
+        description="Maximum fraction of this detector's edge inference requests that can be hedged to the cloud.",
+    )
 
     @model_validator(mode="after")
     def validate_configuration(self) -> Self:
@@ -63,6 +316,10 @@ class EdgeInferenceConfig(BaseModel):
             )
         if self.min_time_between_escalations < 0.0:
             raise ValueError("`min_time_between_escalations` cannot be less than 0.0.")
+        if self.max_keepalive_inference_connections > self.max_inference_connections:
+            raise ValueError(
+                "`max_keepalive_inference_connections` cannot be greater than `max_inference_connections`."
+            )
         return self
 
 
@@ -175,6 +432,55 @@ class StreamConfig(BaseModel):
         return self.credentials.resolve()
 
 
+class SchedulingConfig(BaseModel):
+    """
+    Configuration for the weighted fair scheduling of edge inference requests across detectors, API tokens and
+    sources (external API clients vs. RTSP streams).
+    """
+
+    enabled: bool = Field(default=False, description="Whether to schedule edge inference requests.")
+    max_concurrent_inferences: int = Field(
+        default=16,
+        ge=1,
+        description="Maximum number of edge inference requests in flight at once, per edge-endpoint worker.",
+    )
+    max_concurrent_stream_inferences: int | None = Field(
+        default=None,
+        ge=1,
+        description=(
+            "If set, at most this many of the in-flight requests can come from RTSP streams, keeping the remaining "
+            "capacity free for API requests."
+        ),
+    )
+    api_lane_priority: bool = Field(
+        default=True,
+        description=(
+            "Always dispatch waiting API requests before waiting stream requests. If false, the two sources share "
+            "capacity according to `source_weights`."
+        ),
+    )
+    source_weights: dict[str, float] = Field(
+        default_factory=lambda: {"api": 4.0, "stream": 1.0},
+        description="Weights of the 'api' and 'stream' sources. Only used when `api_lane_priority` is false.",
+    )
+    detector_weights: dict[str, float] = Field(
+        default_factory=dict, description="Weights of individual detectors, keyed by detector ID."
+    )
+    api_token_weights: dict[str, float] = Field(
+        default_factory=dict, description="Weights of individual API tokens, keyed by token."
+    )
+    default_weight: float = Field(
+        default=1.0, gt=0.0, description="Weight of detectors and API tokens that aren't listed explicitly."
+    )
+
+    @model_validator(mode="after")
+    def validate_weights(self) -> Self:
+        for weights in (self.source_weights, self.detector_weights, self.api_token_weights):
+            if any(weight <= 0.0 for weight in weights.values()):
+                raise ValueError("Scheduling weights must be greater than 0.0.")
+        return self
+
+
 class RootEdgeConfig(BaseModel):
     """
     Root configuration for edge inference.
@@ -187,6 +493,10 @@ class RootEdgeConfig(BaseModel):
         default_factory=dict,
         description=("Streaming ingest configuration keyed by stream name."),
     )
+    scheduling: SchedulingConfig = Field(
+        default_factory=SchedulingConfig,
+        description="Weighted fair scheduling of edge inference requests.",
+    )
 
     @model_validator(mode="after")
     def validate_inference_configs(self):
@@ -0,0 +1,165 @@
+"""An asynchronous, stale-while-revalidate cache of detector metadata.
+
+Every edge image query needs its detector's metadata, which comes from a blocking cloud API call. The cache makes sure
+that this call is almost never on a request's critical path:
+    - Fetches run in a worker thread, and concurrent misses for the same detector share a single in-flight fetch.
+    - An entry older than `refresh_after_sec` is refreshed in the background, by a periodic loop for detectors that are
+      in use and by the first request that sees it. Requests keep getting the old entry until the refresh succeeds,
+      and if the refresh fails the old entry is kept and the refresh is retried later.
+    - The detectors from the edge config are fetched when the cache starts, before their first image query.
+Only a request for a detector that has never been fetched has to wait for the cloud.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
+from intellioptics import IntelliOptics
+from model import Detector
+
+logger = logging.getLogger(__name__)
+
+REFRESH_CHECK_INTERVAL_SEC = 1.0
+# How long to wait before retrying a failed background refresh
+REFRESH_RETRY_INTERVAL_SEC = 5.0
+# Entries that haven't been used for this long are only refreshed when they are next used
+IDLE_REFRESH_STOP_SEC = 600.0
+
+# Fetches a detector's metadata, returning it along with the `time.monotonic()` time that it was fetched at
+MetadataFetcher = Callable[[str, IntelliOptics], tuple[Detector, float]]
+
+
+@dataclass
+class _CacheEntry:
+    detector: Detector
+    fetched_at: float
+    io: IntelliOptics  # SDK instance that is used to refresh the entry
+    last_used: float
+    retry_at: float = 0.0  # Earliest time to retry after a failed refresh
+
+
+@dataclass
+class MetadataCacheStats:
+    hits: int = 0  # Requests served from a fresh entry
+    stale_hits: int = 0  # Requests served from an entry that was due for a refresh
+    misses: int = 0  # Requests that had to wait for a fetch
+    coalesced: int = 0  # Misses that waited on a fetch that was already in flight
+    refreshes: int = 0
+    refresh_failures: int = 0
+
+
+class DetectorMetadataCache:
+    """Caches detector metadata, refreshing it in the background so that requests don't wait on the cloud."""
+
+    def __init__(self, fetch_metadata: MetadataFetcher, max_size: int, refresh_after_sec: float) -> None:
+        self.fetch_metadata = fetch_metadata
+        self.max_size = max_size
+        self.refresh_after_sec = refresh_after_sec
+
+        self.entries: OrderedDict[str, _CacheEntry] = OrderedDict()  # In least recently used order
+        # Detectors (from the edge config) that are always kept fresh and never evicted
+        self.pinned_detector_ids: set[str] = set()
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._refresh_task: asyncio.Task | None = None
+        self._stats = MetadataCacheStats()
+
+    async def get(self, detector_id: str, io: IntelliOptics) -> Detector:
+        """
+        Returns the detector's metadata. Only waits if the detector isn't cached yet, in which case any error from
+        fetching the metadata is raised.
+        """
+        now = time.monotonic()
+        entry = self.entries.get(detector_id)
+        if entry is not None:
+            entry.last_used = now
+            entry.io = io
+            self.entries.move_to_end(detector_id)
+            if self._needs_refresh(entry, now):
+                self._stats.stale_hits += 1
+                self._fetch(detector_id, io)
+            else:
+                self._stats.hits += 1
+            return entry.detector
+
+        self._stats.misses += 1
+        if detector_id in self._inflight:
+            self._stats.coalesced += 1
+        # Shielded so that a cancelled request doesn't cancel the fetch for the other requests waiting on it
+        detector, _ = await asyncio.shield(self._fetch(detector_id, io))
+        return detector
+
+    async def start(self, detector_ios: dict[str, IntelliOptics]) -> None:
+        """
+        Starts fetching the given detectors' metadata and the background refresh loop. The given detectors are kept
+        fresh whether or not they are used. Doesn't wait for the fetches to finish.
+        """
+        self.pinned_detector_ids.update(detector_ios)
+        for detector_id, io in detector_ios.items():
+            self._fetch(detector_id, io)
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+            self._refresh_task = None
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "inflight": len(self._inflight), **self._stats.__dict__}
+
+    def _needs_refresh(self, entry: _CacheEntry, now: float) -> bool:
+        return now - entry.fetched_at > self.refresh_after_sec and now >= entry.retry_at
+
+    def _fetch(self, detector_id: str, io: IntelliOptics) -> asyncio.Task:
+        """Returns the in-flight fetch of the detector's metadata, starting one if there isn't one already."""
+        task = self._inflight.get(detector_id)
+        if task is None:
+            task = asyncio.create_task(asyncio.to_thread(self.fetch_metadata, detector_id, io))
+            task.add_done_callback(lambda task: self._on_fetched(detector_id, io, task))
+            self._inflight[detector_id] = task
+        return task
+
+    def _on_fetched(self, detector_id: str, io: IntelliOptics, task: asyncio.Task) -> None:
+        self._inflight.pop(detector_id, None)
+        entry = self.entries.get(detector_id)
+        if task.cancelled() or task.exception() is not None:
+            error = "cancelled" if task.cancelled() else task.exception()
+            if entry is None:
+                # Requests waiting on the fetch get the error. If there aren't any (a prefetch), this is the only log.
+                logger.warning(f"Failed to fetch detector metadata for {detector_id=}: {error}")
+                return
+            self._stats.refresh_failures += 1
+            entry.retry_at = time.monotonic() + REFRESH_RETRY_INTERVAL_SEC
+            logger.error(f"Failed to refresh detector metadata for {detector_id=}: {error}. Keeping stale metadata.")
+            return
+
+        detector, fetched_at = task.result()
+        if entry is None:
+            self.entries[detector_id] = _CacheEntry(detector, fetched_at, io=io, last_used=time.monotonic())
+            self._evict_if_full()
+            return
+        self._stats.refreshes += 1
+        entry.detector = detector
+        entry.fetched_at = fetched_at
+        entry.retry_at = 0.0
+
+    def _evict_if_full(self) -> None:
+        if len(self.entries) <= self.max_size:
+            return
+        for detector_id in self.entries:
+            if detector_id not in self.pinned_detector_ids:
+                del self.entries[detector_id]
+                return
+
+    async def _refresh_loop(self) -> None:
+        """Refreshes entries that are due for a refresh, so that the next request for them gets fresh metadata."""
+        while True:
+            await asyncio.sleep(REFRESH_CHECK_INTERVAL_SEC)
+            now = time.monotonic()
+            for detector_id, entry in list(self.entries.items()):
+                recently_used = now - entry.last_used < IDLE_REFRESH_STOP_SEC
+                if (detector_id in self.pinned_detector_ids or recently_used) and self._needs_refresh(entry, now):
+                    self._fetch(detector_id, entry.io)
@@ -1,36 +1,57 @@
+import asyncio
+import copy
 import logging
 import os
 import shutil
 import time
-from typing import Optional
+from dataclasses import asdict, dataclass, field
+from typing import Awaitable, Callable, Optional
 
+import httpx
+import numpy as np
 import requests
 import yaml
-from cachetools import TTLCache, cached
 from fastapi import HTTPException, status
 from jinja2 import Template
 
-from app.core.configs import EdgeInferenceConfig
-from app.core.file_paths import MODEL_REPOSITORY_PATH
+from app.core.circuit_breaker import CircuitBreakerRegistry
+from app.core.configs import EdgeInferenceConfig, GlobalConfig, SchedulingConfig
+from app.core.file_paths import INFERENCE_SOCKET_DIR, MODEL_REPOSITORY_PATH
+from app.core.inference_cache import InferenceResultCache, dhash
+from app.core.image_preprocessing import (REENCODED_CONTENT_TYPE, downscale_image, get_image_dimensions,
+                                          needs_downscaling, preprocess_image)
+from app.core.inference_health import InferenceHealthProber
+from app.core.scheduling import FairScheduler, InferenceSource
+from app.core.shared_state import SharedState
 from app.core.speedmon import SpeedMonitor
 from app.core.utils import ModelInfoBase, ModelInfoWithBinary, parse_model_info
+from app.metrics.iq_activity import record_activity_for_metrics
+from app.metrics.runtime_stats import runtime_stats
 
 logger = logging.getLogger(__name__)
 
-# Simple TTL cache for is_edge_inference_ready checks to avoid having to re-check every time a request is processed.
-# This will be process-specific, so each edge-endpoint worker will have its own cache instance.
-ttl_cache = TTLCache(maxsize=128, ttl=5)
+# Idle pooled connections to the inference services are closed after this many seconds.
+INFERENCE_KEEPALIVE_EXPIRY_SEC = 30.0
+# Upper bound on the time spent establishing a connection to an inference service.
+INFERENCE_CONNECT_TIMEOUT_SEC = 2.0
+# After failing to connect to an inference service's Unix socket, use TCP for this many seconds before trying it again.
+UNIX_SOCKET_RETRY_INTERVAL_SEC = 30.0
 
 
-@cached(ttl_cache)
-def is_edge_inference_ready(inference_client_url: str) -> bool:
-    model_ready_url = f"http://{inference_client_url}/health/ready"
-    try:
-        response = requests.get(model_ready_url)
-        return response.status_code == status.HTTP_200_OK
-    except requests.exceptions.RequestException as e:
-        logger.warning(f"Failed to connect to {model_ready_url}: {e}")
-        return False
+class EdgeInferenceError(RuntimeError):
+    """Raised when edge inference could not produce a result and the request should fall back to the cloud."""
+
+
+class EdgeInferenceTimeoutError(EdgeInferenceError):
+    """Raised when an inference service didn't respond before its deadline."""
+
+
+class EdgeInferenceConnectError(EdgeInferenceError):
+    """Raised when a connection to an inference service couldn't be established."""
+
+
+class EdgeInferenceCircuitOpenError(EdgeInferenceError):
+    """Raised instead of calling an inference service whose circuit breaker is open."""
 
 
 def submit_image_for_inference(inference_client_url: str, image_bytes: bytes, content_type: str) -> dict:
@@ -41,16 +62,70 @@ def submit_image_for_inference(inference_client_url: str, image_bytes: bytes, co
         response = requests.post(inference_url, data=image_bytes, headers=headers)
         if response.status_code != status.HTTP_200_OK:
             logger.error(f"Inference server returned an error: {response.status_code} - {response.text}")
-            raise RuntimeError(f"Inference server error: {response.status_code} - {response.text}")
+            raise EdgeInferenceError(f"Inference server error: {response.status_code} - {response.text}")
         return response.json()
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to connect to {inference_url}: {e}")
-        raise RuntimeError("Failed to submit image for inference") from e
+        raise EdgeInferenceError("Failed to submit image for inference") from e
+
+
+def create_inference_client(inference_config: EdgeInferenceConfig, uds_path: str | None = None) -> httpx.AsyncClient:
+    """
+    Create a long-lived async HTTP client for talking to an inference service. The client keeps a pool of keep-alive
+    connections open so that requests don't pay for a new TCP connection every time. If `uds_path` is given, the client
+    connects to the Unix domain socket at that path instead of over TCP.
+    """
+    limits = httpx.Limits(
+        max_connections=inference_config.max_inference_connections,
+        max_keepalive_connections=inference_config.max_keepalive_inference_connections,
+        keepalive_expiry=INFERENCE_KEEPALIVE_EXPIRY_SEC,
+    )
+    timeout = httpx.Timeout(
+        inference_config.inference_timeout,
+        connect=min(inference_config.inference_timeout, INFERENCE_CONNECT_TIMEOUT_SEC),
+    )
+    if uds_path is not None:
+        # The client ignores `limits` when given a custom transport, so they're set on the transport instead
+        transport = httpx.AsyncHTTPTransport(uds=uds_path, limits=limits)
+        return httpx.AsyncClient(transport=transport, timeout=timeout)
+    return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+
+def get_inference_socket_path(inference_client_url: str) -> str:
+    """The path of the Unix domain socket that the inference service at `inference_client_url` may listen on."""
+    service_name = inference_client_url.split(":")[0]
+    return os.path.join(INFERENCE_SOCKET_DIR, f"{service_name}.sock")
+
+
+async def submit_image_for_inference_async(
+    client: httpx.AsyncClient, inference_client_url: str, image_bytes: bytes, content_type: str
+) -> dict:
+    """Async version of `submit_image_for_inference`, which sends the request over a pooled client."""
+    inference_url = f"http://{inference_client_url}/infer"
+    headers = {"Content-Type": content_type}
+    try:
+        logger.debug(f"Submitting image for inference to {inference_url}")
+        response = await client.post(inference_url, content=image_bytes, headers=headers)
+    except httpx.TimeoutException as e:
+        logger.error(f"Timed out waiting for {inference_url}: {e}")
+        raise EdgeInferenceTimeoutError(f"Timed out waiting for {inference_url}") from e
+    except httpx.ConnectError as e:
+        logger.error(f"Failed to connect to {inference_url}: {e}")
+        raise EdgeInferenceConnectError("Failed to connect to inference server") from e
+    except httpx.HTTPError as e:
+        logger.error(f"Failed to connect to {inference_url}: {e}")
+        raise EdgeInferenceError("Failed to submit image for inference") from e
+
+    if response.status_code != status.HTTP_200_OK:
+        logger.error(f"Inference server returned an error: {response.status_code} - {response.text}")
+        raise EdgeInferenceError(f"Inference server error: {response.status_code} - {response.text}")
+    return response.json()
 
 
 def get_inference_result(primary_response: dict, oodd_response: dict) -> str:
     """
-    Get the final inference result from the primary and OODD responses.
+    Get the final inference result from the primary and OODD responses. This is where the results of the two
+    concurrent inference calls are joined.
     """
     primary_num_classes = get_num_classes(primary_response)
 
@@ -175,6 +250,286 @@ def parse_inference_response(response: dict) -> dict:
     return output_dict
 
 
+def get_inference_results_batch(primary_responses: list[dict], oodd_responses: list[dict]) -> list[dict]:
+    """
+    Batch version of `get_inference_result`, for N primary and N OODD responses. Returns the same results as calling
+    `get_inference_result` on each pair of responses, but does the numeric work on NumPy arrays.
+    """
+    if len(primary_responses) != len(oodd_responses):
+        raise ValueError(f"Got {len(primary_responses)} primary responses but {len(oodd_responses)} OODD responses.")
+    primary_num_classes = get_num_classes_batch(primary_responses)
+
+    primary_output_dicts = parse_inference_responses_batch(primary_responses)
+    oodd_output_dicts = parse_inference_responses_batch(oodd_responses)
+
+    combined_output_dicts = adjust_confidence_with_oodd_batch(
+        primary_output_dicts, oodd_output_dicts, primary_num_classes
+    )
+    logger.debug(f"Combined (primary + OODD) inference results for a batch of {len(combined_output_dicts)}.")
+
+    return combined_output_dicts
+
+
+def get_num_classes_batch(responses: list[dict]) -> np.ndarray:
+    """
+    Batch version of `get_num_classes`. Returns an array with the number of classes for each response.
+    """
+    return np.fromiter((get_num_classes(response) for response in responses), dtype=np.int64, count=len(responses))
+
+
+def adjust_confidence_with_oodd_batch(
+    primary_output_dicts: list[dict], oodd_output_dicts: list[dict], num_classes: np.ndarray
+) -> list[dict]:
+    """
+    Batch version of `adjust_confidence_with_oodd`. The blending is done on NumPy arrays, with the same operations in
+    the same order as the scalar version, so the adjusted confidences are bit-for-bit identical.
+    """
+    n = len(primary_output_dicts)
+    # Results with a missing confidence are returned unadjusted, just like in the scalar version
+    adjustable = np.fromiter(
+        (
+            primary["confidence"] is not None and oodd["confidence"] is not None
+            for primary, oodd in zip(primary_output_dicts, oodd_output_dicts)
+        ),
+        dtype=bool,
+        count=n,
+    )
+    if not adjustable.all():
+        logger.warning(
+            f"Either the OODD or primary confidence is None for {n - adjustable.sum()} of {n} result(s), "
+            "returning the primary result for those."
+        )
+
+    primary_confidences = np.array(
+        [primary["confidence"] if ok else 0.0 for primary, ok in zip(primary_output_dicts, adjustable)],
+        dtype=np.float64,
+    )
+    oodd_confidences = np.array(
+        [oodd["confidence"] if ok else 0.0 for oodd, ok in zip(oodd_output_dicts, adjustable)], dtype=np.float64
+    )
+    # 1.0 is the FAIL (outlier) class
+    oodd_is_outlier = np.fromiter((oodd["label"] == 1 for oodd in oodd_output_dicts), dtype=bool, count=n)
+    outlier_probabilities = np.where(oodd_is_outlier, oodd_confidences, 1 - oodd_confidences)
+    adjusted_confidences = (
+        outlier_probabilities / num_classes + (1 - outlier_probabilities) * primary_confidences
+    ).tolist()
+
+    adjusted_output_dicts = []
+    for i, (primary_output_dict, oodd_output_dict) in enumerate(zip(primary_output_dicts, oodd_output_dicts)):
+        if not adjustable[i]:
+            adjusted_output_dicts.append(primary_output_dict)
+            continue
+        adjusted_output_dict = primary_output_dict.copy()
+        adjusted_output_dict["confidence"] = adjusted_confidences[i]
+        # Raw prediction data for troubleshooting purposes
+        adjusted_output_dict["raw_primary_confidence"] = primary_output_dict["confidence"]
+        adjusted_output_dict["raw_oodd_prediction"] = oodd_output_dict.copy()
+        adjusted_output_dicts.append(adjusted_output_dict)
+
+    return adjusted_output_dicts
+
+
+def parse_inference_responses_batch(responses: list[dict]) -> list[dict]:
+    """
+    Batch version of `parse_inference_response`. The argmax over the multiclass probabilities and the ROI center
+    computation are each done once for the whole batch on NumPy arrays. Like the scalar version, the ROI geometries in
+    the responses are updated in place with their centers.
+    """
+    output_dicts = []
+    multiclass_indices: list[int] = []
+    multiclass_probabilities: list[list[float]] = []
+    all_rois: list[dict] = []
+
+    for i, response in enumerate(responses):
+        if "predictions" not in response:
+            logger.error(f"Invalid inference response: {response}")
+            raise RuntimeError("Invalid inference response")
+
+        multi_predictions: dict = response.get("multi_predictions", None)
+        predictions: dict = response.get("predictions", None)
+        secondary_predictions: dict = response.get("secondary_predictions", None)
+
+        if multi_predictions is not None and predictions is not None:
+            raise ValueError("Got result with both multi_predictions and predictions.")
+        if multi_predictions is not None:
+            # Count or multiclass case. The confidence and label are filled in below, once for the whole batch.
+            probabilities: list[float] = multi_predictions["probabilities"][0]
+            if not probabilities:
+                raise ValueError("Got multi_predictions with no probabilities.")
+            multiclass_indices.append(i)
+            multiclass_probabilities.append(probabilities)
+            confidence, label = None, None
+        elif predictions is not None:
+            # Binary case
+            confidence: float = predictions["confidences"][0]
+            label: int = predictions["labels"][0]
+        else:
+            raise ValueError("Got result with no multi_predictions or predictions.")
+
+        rois: list[dict] | None = None
+        text: str | None = None
+        # Attempt to extract rois / text
+        if secondary_predictions is not None:
+            roi_predictions: dict[str, list[list[dict]]] | None = secondary_predictions.get("roi_predictions", None)
+            text_predictions: list[str] | None = secondary_predictions.get("text_predictions", None)
+            if roi_predictions is not None:
+                rois = roi_predictions["rois"][0]
+                all_rois.extend(rois)
+            if text_predictions is not None:
+                if len(text_predictions) > 1:
+                    raise ValueError("Got more than one text prediction. This should not happen.")
+                text = text_predictions[0]
+
+        output_dicts.append({"confidence": confidence, "label": label, "text": text, "rois": rois})
+
+    if multiclass_indices:
+        labels = _argmax_rows(multiclass_probabilities)
+        for i, probabilities, label in zip(multiclass_indices, multiclass_probabilities, labels):
+            # Take the confidence from the original list so it's exactly the value `max` would have returned
+            output_dicts[i]["confidence"] = probabilities[label]
+            output_dicts[i]["label"] = label
+
+    if all_rois:
+        _set_roi_centers(all_rois)
+
+    return output_dicts
+
+
+def _argmax_rows(rows: list[list[float]]) -> list[int]:
+    """Index of the first maximum of each row. Rows may have different lengths."""
+    row_lengths = {len(row) for row in rows}
+    if len(row_lengths) == 1:
+        matrix = np.array(rows, dtype=np.float64)
+    else:
+        # Pad ragged rows with -inf, which can never be the maximum of a non-empty row
+        matrix = np.full((len(rows), max(row_lengths)), -np.inf)
+        for i, row in enumerate(rows):
+            matrix[i, : len(row)] = row
+    return np.argmax(matrix, axis=1).tolist()
+
+
+def _set_roi_centers(rois: list[dict]) -> None:
+    """Set the x and y center of each ROI's geometry, in place."""
+    geometries = [roi["geometry"] for roi in rois]
+    bounds = np.array(
+        [(geometry["left"], geometry["right"], geometry["top"], geometry["bottom"]) for geometry in geometries],
+        dtype=np.float64,
+    )
+    xs = (0.5 * (bounds[:, 0] + bounds[:, 1])).tolist()
+    ys = (0.5 * (bounds[:, 2] + bounds[:, 3])).tolist()
+    for geometry, x, y in zip(geometries, xs, ys):
+        geometry["x"] = x
+        geometry["y"] = y
+
+
+@dataclass
+class PendingInference:
+    """An inference request that is waiting in a detector's batching queue."""
+
+    image_bytes: bytes
+    content_type: str
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+    def set_result(self, result: dict) -> None:
+        if not self.future.done():  # The waiting request may have been cancelled
+            self.future.set_result(result)
+
+    def set_exception(self, exception: BaseException) -> None:
+        if not self.future.done():
+            self.future.set_exception(exception)
+
+
+class InferenceBatcher:
+    """
+    Dynamic micro-batching scheduler for a single detector.
+
+    Concurrent requests are queued and coalesced into batches. A batch is dispatched as soon as it reaches
+    `max_batch_size` requests, or once `max_batch_wait_sec` has passed since its first request arrived, whichever comes
+    first. Results are delivered back to each waiting request individually. If the queue already holds
+    `max_queue_depth` requests, new requests are rejected immediately so that they can fall back to the cloud.
+    """
+
+    def __init__(
+        self,
+        detector_id: str,
+        max_batch_size: int,
+        max_batch_wait_sec: float,
+        max_queue_depth: int,
+        run_batch: Callable[[str, list[PendingInference]], Awaitable[None]],
+    ) -> None:
+        self.detector_id = detector_id
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait_sec = max_batch_wait_sec
+        self.max_queue_depth = max_queue_depth
+        self._run_batch = run_batch
+        self._queue: asyncio.Queue[PendingInference] | None = None
+        self._worker: asyncio.Task | None = None
+        self._in_flight: set[asyncio.Task] = set()
+
+    async def submit(self, image_bytes: bytes, content_type: str) -> dict:
+        """Queue an image for inference and wait for its result."""
+        self._ensure_started()
+        pending = PendingInference(
+            image_bytes=image_bytes, content_type=content_type, future=asyncio.get_running_loop().create_future()
+        )
+        try:
+            self._queue.put_nowait(pending)
+        except asyncio.QueueFull as e:
+            raise EdgeInferenceError(
+                f"Inference queue for {self.detector_id} is full ({self.max_queue_depth} pending requests)."
+            ) from e
+        return await pending.future
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _ensure_started(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue(maxsize=self.max_queue_depth)
+            self._worker = asyncio.create_task(self._run(), name=f"inference-batcher:{self.detector_id}")
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_batch_wait_sec
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # Don't wait for this batch to finish before collecting the next one; the pooled clients bound concurrency
+            task = asyncio.create_task(self._dispatch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _dispatch(self, batch: list[PendingInference]) -> None:
+        try:
+            await self._run_batch(self.detector_id, batch)
+        except BaseException as e:
+            for pending in batch:
+                pending.set_exception(e if isinstance(e, Exception) else EdgeInferenceError("Batch was cancelled."))
+            if not isinstance(e, Exception):
+                raise
+
+    async def stop(self) -> None:
+        """Stop the scheduler, failing any requests that are still queued."""
+        tasks = list(self._in_flight)
+        if self._worker is not None:
+            tasks.append(self._worker)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        while self._queue is not None and not self._queue.empty():
+            self._queue.get_nowait().set_exception(EdgeInferenceError("Inference batcher was stopped."))
+        self._worker = None
+
+
 class EdgeInferenceManager:
     INPUT_IMAGE_NAME = "image"
     MODEL_OUTPUTS = ["score", "confidence", "probability", "label"]
@@ -185,17 +540,50 @@ class EdgeInferenceManager:
         self,
         detector_inference_configs: dict[str, EdgeInferenceConfig] | None,
         verbose: bool = False,
+        global_config: GlobalConfig | None = None,
+        scheduling_config: SchedulingConfig | None = None,
+        shared_state: SharedState | None = None,
     ) -> None:
         """
         Initializes the edge inference manager.
         Args:
             detector_inference_configs: Dictionary of detector IDs to EdgeInferenceConfig objects
-            edge_config: RootEdgeConfig object
             verbose: Whether to print verbose logs from the inference server client
+            global_config: GlobalConfig object, used to configure the background health prober and the circuit
+                breakers
+            scheduling_config: SchedulingConfig object. If scheduling is enabled, inference requests are admitted in
+                weighted fair order.
+            shared_state: State shared with the other edge-endpoint workers. If given, inference server readiness,
+                escalation cooldowns and inference speed are tracked across all workers instead of per worker.
         """
         self.verbose = verbose
         self.detector_inference_configs, self.inference_client_urls, self.oodd_inference_client_urls = {}, {}, {}
-        self.speedmon = SpeedMonitor()
+        self.shared_state = shared_state
+        self.speedmon = SpeedMonitor(shared_state=shared_state)
+        # Long-lived async HTTP clients, keyed by inference service URL. Created lazily on first use.
+        self.inference_clients: dict[str, httpx.AsyncClient] = {}
+        # Clients that talk to inference services over their Unix socket, for detectors with `use_unix_socket`
+        self.unix_socket_inference_clients: dict[str, httpx.AsyncClient] = {}
+        # When to next try the Unix socket of an inference service that we failed to connect to
+        self.unix_socket_retry_times: dict[str, float] = {}
+        # Per-detector micro-batching schedulers, for detectors with `max_batch_size` > 1. Created lazily on first use.
+        self.batchers: dict[str, InferenceBatcher] = {}
+        # Per-detector caches of recent results for near-duplicate images, for detectors with `result_cache_enabled`
+        self.result_caches: dict[str, InferenceResultCache] = {}
+        # Tracks the readiness of every inference service in the background. Started by `start()`.
+        global_config = global_config or GlobalConfig()
+        self.health_prober = InferenceHealthProber(
+            get_service_urls=self._all_inference_client_urls,
+            probe_interval_sec=global_config.health_probe_interval,
+            probe_timeout_sec=global_config.health_probe_timeout,
+            failure_threshold=global_config.health_probe_failure_threshold,
+            shared_state=shared_state,
+        )
+        # Stops sending requests to inference services that keep failing, so that requests fall back to the cloud fast
+        self.circuit_breakers = CircuitBreakerRegistry(global_config)
+        self.scheduler: FairScheduler | None = None
+        if scheduling_config is not None and scheduling_config.enabled:
+            self.scheduler = FairScheduler(scheduling_config)
 
         if detector_inference_configs:
             self.detector_inference_configs = detector_inference_configs
@@ -252,7 +640,8 @@ class EdgeInferenceManager:
 
     def inference_is_available(self, detector_id: str) -> bool:
         """
-        Queries the inference server to see if everything is ready to perform inference.
+        Checks whether the inference servers for a detector were ready as of their last background health probe.
+        This is an in-memory lookup and never blocks on the inference servers.
         Args:
             detector_id: ID of the detector on which to run local edge inference
         Returns:
@@ -265,14 +654,30 @@ class EdgeInferenceManager:
             logger.info(f"Failed to look up inference clients for {detector_id}")
             return False
 
-        inference_clients_are_ready = is_edge_inference_ready(inference_client_url) and is_edge_inference_ready(
-            oodd_inference_client_url
+        inference_clients_are_ready = all(
+            self.health_prober.is_ready(url) for url in (inference_client_url, oodd_inference_client_url)
         )
         if not inference_clients_are_ready:
             logger.debug("Edge inference server and/or OODD inference server is not ready")
             return False
         return True
 
+    def inference_circuit_is_open(self, detector_id: str) -> bool:
+        """
+        Checks whether the circuit breaker of either of a detector's inference services is currently rejecting calls,
+        in which case edge inference would fail immediately and the request should go straight to the cloud.
+        """
+        return any(
+            self.circuit_breakers.rejects_requests(url)
+            for url in (self.inference_client_urls.get(detector_id), self.oodd_inference_client_urls.get(detector_id))
+            if url is not None
+        )
+
+    def _all_inference_client_urls(self) -> list[str]:
+        """All inference service URLs currently in use, including those of detectors added at runtime."""
+        # Take snapshots, since detectors can be added from the scheduler's worker thread while we iterate
+        return list(self.inference_client_urls.values()) + list(self.oodd_inference_client_urls.values())
+
     def run_inference(self, detector_id: str, image_bytes: bytes, content_type: str) -> dict:
         """
         Submit an image to the inference server, route to a specific model, and return the results.
@@ -293,6 +698,11 @@ class EdgeInferenceManager:
         inference_client_url = self.inference_client_urls[detector_id]
         oodd_inference_client_url = self.oodd_inference_client_urls[detector_id]
 
+        inference_config = self.detector_inference_configs.get(detector_id) or EdgeInferenceConfig()
+        image_bytes, content_type = preprocess_image(
+            image_bytes, content_type, inference_config.max_image_dimension, inference_config.reencode_quality
+        )
+
         response = submit_image_for_inference(inference_client_url, image_bytes, content_type)
         oodd_response = submit_image_for_inference(oodd_inference_client_url, image_bytes, content_type)
 
@@ -306,6 +716,346 @@ class EdgeInferenceManager:
         logger.info(f"Recent-average FPS for {detector_id=}: {fps:.2f}")
         return output_dict
 
+    async def run_inference_async(
+        self,
+        detector_id: str,
+        image_bytes: bytes,
+        content_type: str,
+        source: InferenceSource = InferenceSource.API,
+        api_token: str | None = None,
+    ) -> dict:
+        """
+        Non-blocking version of `run_inference`, for use from the event loop. Requests are sent over long-lived,
+        per-service connection pools so that a slow inference pod doesn't stall other requests in the worker.
+
+        The primary and OODD requests are sent concurrently, so the latency is that of the slower of the two pods
+        rather than the sum of both. Each call has its own deadline (`inference_timeout`); if either call fails or
+        misses its deadline, the other is cancelled and an `EdgeInferenceError` is raised so that the caller can fall
+        back to the cloud.
+
+        Images larger than the detector's `max_image_dimension` are downscaled once (in a worker thread) and the
+        smaller image is sent to both inference services. The caller's `image_bytes` are left untouched.
+
+        If scheduling is enabled, the request waits for its turn according to the weights of its source, detector and
+        API token before being sent to the inference services.
+        Args:
+            detector_id: ID of the detector on which to run local edge inference
+            image_bytes: The serialized image to submit for inference
+            content_type: The content type of the image
+            source: Where the request came from, used for scheduling
+            api_token: API token of the client that sent the request, used for scheduling
+        Returns:
+            Dictionary of inference results, in the same format as `run_inference`.
+        Raises:
+            EdgeInferenceError: If either inference call failed or timed out.
+        """
+        logger.info(f"Submitting image to edge inference service. {detector_id=}")
+        start_time = time.perf_counter()
+
+        inference_config = self.detector_inference_configs.get(detector_id) or EdgeInferenceConfig()
+        image_bytes, content_type = await self._preprocess_image(image_bytes, content_type, inference_config)
+
+        image_hash = None
+        if inference_config.result_cache_enabled:
+            image_hash, cached_output_dict = await self._lookup_cached_result(
+                detector_id, image_bytes, inference_config
+            )
+            if cached_output_dict is not None:
+                return cached_output_dict
+
+        if self.scheduler is not None:
+            async with self.scheduler.slot(detector_id, source=source, api_token=api_token):
+                output_dict = await self._run_uncached_inference(
+                    detector_id, image_bytes, content_type, inference_config
+                )
+        else:
+            output_dict = await self._run_uncached_inference(detector_id, image_bytes, content_type, inference_config)
+
+        if image_hash is not None:
+            self.result_caches[detector_id].put(image_hash, output_dict)
+
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        self.speedmon.update(detector_id, elapsed_ms)
+        fps = self.speedmon.average_fps(detector_id)
+
+        logger.debug(f"Inference server response for request {detector_id=}: {output_dict}.")
+        logger.info(f"Recent-average FPS for {detector_id=}: {fps:.2f}")
+        return output_dict
+
+    async def _run_uncached_inference(
+        self, detector_id: str, image_bytes: bytes, content_type: str, inference_config: EdgeInferenceConfig
+    ) -> dict:
+        if inference_config.max_batch_size > 1:
+            return await self._get_batcher(detector_id, inference_config).submit(image_bytes, content_type)
+        response, oodd_response = await self._submit_to_primary_and_oodd(detector_id, image_bytes, content_type)
+        return get_inference_result(response, oodd_response)
+
+    async def _preprocess_image(
+        self, image_bytes: bytes, content_type: str, inference_config: EdgeInferenceConfig
+    ) -> tuple[bytes, str]:
+        """Downscale the image if it's too large. Only the (cheap) header parse happens on the event loop."""
+        image_size = get_image_dimensions(image_bytes)
+        if not needs_downscaling(image_size, inference_config.max_image_dimension):
+            return image_bytes, content_type
+        processed_bytes = await asyncio.to_thread(
+            downscale_image, image_bytes, inference_config.max_image_dimension, inference_config.reencode_quality
+        )
+        return processed_bytes, REENCODED_CONTENT_TYPE
+
+    async def _lookup_cached_result(
+        self, detector_id: str, image_bytes: bytes, inference_config: EdgeInferenceConfig
+    ) -> tuple[int | None, dict | None]:
+        """
+        Look up a cached result for a near-duplicate of the image. Returns the image's hash (or None if the image
+        couldn't be hashed) and the cached result (or None on a cache miss). Cached results are flagged with
+        `"from_edge_cache": True`.
+        """
+        try:
+            # Decoding the image is CPU-bound, so don't do it on the event loop
+            image_hash = await asyncio.to_thread(dhash, image_bytes)
+        except Exception as e:
+            logger.warning(f"Failed to compute perceptual hash for image on {detector_id=}, skipping cache: {e}")
+            return None, None
+
+        cache = self.result_caches.get(detector_id)
+        if cache is None:
+            cache = InferenceResultCache(
+                max_entries=inference_config.result_cache_max_entries,
+                max_bytes=inference_config.result_cache_max_bytes,
+                ttl_sec=inference_config.result_cache_ttl,
+                max_hamming_distance=inference_config.result_cache_max_hamming_distance,
+            )
+            self.result_caches[detector_id] = cache
+
+        cached_output_dict = cache.get(image_hash)
+        if cached_output_dict is None:
+            return image_hash, None
+
+        # Estimate the pod time saved from the recent average inference latency
+        fps = self.speedmon.average_fps(detector_id)
+        if fps > 0:
+            cache.stats.saved_ms += 1000 / fps
+        record_activity_for_metrics(detector_id, activity_type="cache_hits")
+        logger.debug(f"Returning cached inference result for {detector_id=} ({cache.stats.hits} hits so far).")
+
+        cached_output_dict["from_edge_cache"] = True
+        return image_hash, cached_output_dict
+
+    async def _submit_to_primary_and_oodd(
+        self, detector_id: str, image_bytes: bytes, content_type: str
+    ) -> tuple[dict, dict]:
+        """
+        Send an image to the primary and OODD inference services concurrently and return both raw responses. If either
+        call fails, the other is cancelled and the error is propagated.
+        """
+        if self.inference_circuit_is_open(detector_id):
+            # Don't call either service if one of them would be skipped anyway
+            raise EdgeInferenceCircuitOpenError(f"A circuit breaker for {detector_id=} is open")
+        inference_client_url = self.inference_client_urls[detector_id]
+        oodd_inference_client_url = self.oodd_inference_client_urls[detector_id]
+
+        tasks = [
+            asyncio.create_task(self._submit_with_deadline(detector_id, url, image_bytes, content_type))
+            for url in (inference_client_url, oodd_inference_client_url)
+        ]
+        try:
+            response, oodd_response = await asyncio.gather(*tasks)
+        except BaseException:
+            # Don't leave the other call running in the background if one of them failed
+            for task in tasks:
+                task.cancel()
+            raise
+        return response, oodd_response
+
+    async def _run_batch(self, detector_id: str, batch: list["PendingInference"]) -> None:
+        """
+        Run inference for a batch of coalesced requests and deliver each result to the request that is waiting on it.
+
+        The inference services take one image per request, so the batch is sent as a pipelined burst over the pooled
+        connections. Requests in the batch with identical image bytes are only sent once.
+        """
+        unique_requests: dict[tuple[bytes, str], list[PendingInference]] = {}
+        for pending in batch:
+            unique_requests.setdefault((pending.image_bytes, pending.content_type), []).append(pending)
+
+        raw_results = await asyncio.gather(
+            *(
+                self._submit_to_primary_and_oodd(detector_id, image_bytes, content_type)
+                for image_bytes, content_type in unique_requests.keys()
+            ),
+            return_exceptions=True,
+        )
+        logger.debug(
+            f"Ran a batch of {len(batch)} inference request(s) for {detector_id=} "
+            f"({len(unique_requests)} unique image(s))."
+        )
+
+        succeeded = []
+        for waiting, raw_result in zip(unique_requests.values(), raw_results):
+            if isinstance(raw_result, BaseException):
+                for pending in waiting:
+                    pending.set_exception(raw_result)
+            else:
+                succeeded.append((waiting, raw_result))
+        if not succeeded:
+            return
+
+        try:
+            output_dicts = get_inference_results_batch(
+                [response for _, (response, _) in succeeded], [oodd_response for _, (_, oodd_response) in succeeded]
+            )
+        except Exception:
+            # A malformed response fails the whole batch, so parse them one at a time to fail only the affected requests
+            output_dicts = []
+            for _, raw_result in succeeded:
+                try:
+                    output_dicts.append(get_inference_result(*raw_result))
+                except Exception as e:
+                    output_dicts.append(e)
+
+        for (waiting, _), output_dict in zip(succeeded, output_dicts):
+            if isinstance(output_dict, Exception):
+                for pending in waiting:
+                    pending.set_exception(output_dict)
+                continue
+            # Every waiting request gets its own copy of the result, since callers may modify it
+            for i, pending in enumerate(waiting):
+                pending.set_result(output_dict if i == 0 else copy.deepcopy(output_dict))
+
+    def _get_batcher(self, detector_id: str, inference_config: EdgeInferenceConfig) -> "InferenceBatcher":
+        """Get the batching scheduler for a detector, creating it if it doesn't exist yet."""
+        batcher = self.batchers.get(detector_id)
+        if batcher is None:
+            batcher = InferenceBatcher(
+                detector_id=detector_id,
+                max_batch_size=inference_config.max_batch_size,
+                max_batch_wait_sec=inference_config.max_batch_wait_ms / 1000,
+                max_queue_depth=inference_config.max_batch_queue_depth,
+                run_batch=self._run_batch,
+            )
+            self.batchers[detector_id] = batcher
+        return batcher
+
+    async def _submit_with_deadline(
+        self, detector_id: str, inference_client_url: str, image_bytes: bytes, content_type: str
+    ) -> dict:
+        """
+        Submit an image to a single inference service, enforcing the detector's per-call deadline. The outcome is
+        recorded in the service's circuit breaker, and the call isn't made at all if the breaker is open.
+        """
+        if not self.circuit_breakers.enabled:
+            return await self._submit_with_timeout(detector_id, inference_client_url, image_bytes, content_type)
+
+        breaker = self.circuit_breakers.get(inference_client_url)
+        if not breaker.allow_request():
+            runtime_stats.increment("circuit_breaker_rejected", service=inference_client_url)
+            raise EdgeInferenceCircuitOpenError(f"The circuit breaker for {inference_client_url} is open")
+
+        start_time = time.perf_counter()
+        try:
+            response = await self._submit_with_timeout(detector_id, inference_client_url, image_bytes, content_type)
+        except Exception:
+            breaker.record_failure()
+            raise
+        except BaseException:  # Cancelled, e.g. because the other inference call failed
+            breaker.record_cancelled()
+            raise
+        breaker.record_success((time.perf_counter() - start_time) * 1000)
+        return response
+
+    async def _submit_with_timeout(
+        self, detector_id: str, inference_client_url: str, image_bytes: bytes, content_type: str
+    ) -> dict:
+        inference_config = self.detector_inference_configs.get(detector_id) or EdgeInferenceConfig()
+        try:
+            return await asyncio.wait_for(
+                self._submit_over_best_transport(detector_id, inference_client_url, image_bytes, content_type),
+                timeout=inference_config.inference_timeout,
+            )
+        except asyncio.TimeoutError as e:
+            raise EdgeInferenceTimeoutError(
+                f"{inference_client_url} did not respond within {inference_config.inference_timeout}s"
+            ) from e
+
+    async def _submit_over_best_transport(
+        self, detector_id: str, inference_client_url: str, image_bytes: bytes, content_type: str
+    ) -> dict:
+        """Submit over the inference service's Unix socket if it's available, and over TCP otherwise."""
+        unix_socket_client = self._get_unix_socket_inference_client(detector_id, inference_client_url)
+        if unix_socket_client is not None:
+            try:
+                return await submit_image_for_inference_async(
+                    unix_socket_client, inference_client_url, image_bytes, content_type
+                )
+            except EdgeInferenceConnectError:
+                # Nothing was sent, so it's safe to retry over TCP
+                logger.warning(
+                    f"Failed to connect to {inference_client_url} over its Unix socket. Falling back to TCP for the "
+                    f"next {UNIX_SOCKET_RETRY_INTERVAL_SEC}s."
+                )
+                runtime_stats.increment("unix_socket_fallbacks", service=inference_client_url)
+                self.unix_socket_retry_times[inference_client_url] = time.monotonic() + UNIX_SOCKET_RETRY_INTERVAL_SEC
+
+        tcp_client = self._get_inference_client(detector_id, inference_client_url)
+        return await submit_image_for_inference_async(tcp_client, inference_client_url, image_bytes, content_type)
+
+    def _get_unix_socket_inference_client(
+        self, detector_id: str, inference_client_url: str
+    ) -> httpx.AsyncClient | None:
+        """
+        Get the Unix socket client for an inference service, creating it if it doesn't exist yet. Returns None if the
+        detector doesn't use Unix sockets, or the service's socket isn't available.
+        """
+        inference_config = self.detector_inference_configs.get(detector_id) or EdgeInferenceConfig()
+        if not inference_config.use_unix_socket:
+            return None
+        if time.monotonic() < self.unix_socket_retry_times.get(inference_client_url, 0.0):
+            return None
+        socket_path = get_inference_socket_path(inference_client_url)
+        if not os.path.exists(socket_path):
+            return None
+
+        client = self.unix_socket_inference_clients.get(inference_client_url)
+        if client is None or client.is_closed:
+            client = create_inference_client(inference_config, uds_path=socket_path)
+            self.unix_socket_inference_clients[inference_client_url] = client
+        return client
+
+    def _get_inference_client(self, detector_id: str, inference_client_url: str) -> httpx.AsyncClient:
+        """Get the pooled async client for an inference service, creating it if it doesn't exist yet."""
+        client = self.inference_clients.get(inference_client_url)
+        if client is None or client.is_closed:
+            inference_config = self.detector_inference_configs.get(detector_id) or EdgeInferenceConfig()
+            client = create_inference_client(inference_config)
+            self.inference_clients[inference_client_url] = client
+        return client
+
+    def result_cache_stats(self) -> dict[str, dict]:
+        """Returns the hit/miss statistics and current size of each detector's result cache."""
+        return {
+            detector_id: {**asdict(cache.stats), "entries": len(cache), "bytes": cache.total_bytes}
+            for detector_id, cache in self.result_caches.items()
+        }
+
+    async def start(self) -> None:
+        """Start the background health prober. Should be called when the application starts."""
+        await self.health_prober.start()
+
+    async def aclose(self) -> None:
+        """Stop the health prober and close all pooled inference clients. Should be called on application shutdown."""
+        await self.health_prober.stop()
+
+        batchers = list(self.batchers.values())
+        self.batchers.clear()
+        for batcher in batchers:
+            await batcher.stop()
+
+        clients = list(self.inference_clients.values()) + list(self.unix_socket_inference_clients.values())
+        self.inference_clients.clear()
+        self.unix_socket_inference_clients.clear()
+        for client in clients:
+            await client.aclose()
+
     def update_models_if_available(self, detector_id: str) -> bool:
         """
         Request a new model from Groundlight. If there is a new model available, download it and
@@ -361,6 +1111,10 @@ class EdgeInferenceManager:
               False otherwise.
         """
         min_time_between_escalations = self.min_times_between_escalations.get(detector_id, 2)
+        if self.shared_state is not None:
+            # The cooldown applies across all the workers, not to each of them
+            return self.shared_state.try_start_escalation(detector_id, min_time_between_escalations)
+
         last_escalation_time = self.last_escalation_times[detector_id]
 
         if last_escalation_time is None or (time.time() - last_escalation_time) > min_time_between_escalations:
@@ -0,0 +1,333 @@
+"""Submitting audits and escalations of edge answers to the cloud after the response has been sent.
+
+These cloud submissions used to run as FastAPI background tasks, which execute blocking SDK calls on Starlette's shared
+thread pool. When the cloud slowed down, they held on to the threads that sync dependencies of other requests need.
+The `EscalationDispatcher` instead runs them on its own thread pool, from a bounded in-memory queue:
+    - Before the response is sent, each escalation and its image are written to the on-disk escalation queue (with a
+      group commit, see `QueueWriter`), so that an escalation isn't lost if the edge endpoint crashes before submitting
+      it. The dispatcher is the fast path: once it has submitted an escalation, it acknowledges the escalation's image,
+      and the escalation queue uploader skips the escalation. The uploader leaves an escalation that is being
+      dispatched alone for `DISPATCH_GRACE_SEC`, after which the dispatcher gives up on it, and the uploader uploads it
+      unless its image has been acknowledged.
+    - Escalations are sharded by detector, and each shard is submitted by one worker, so each detector's escalations
+      reach the cloud in the order they were made.
+    - Submissions that fail with a retryable error (a network error, a timeout, 429 or 5xx) are retried with
+      exponential backoff.
+    - If the in-memory queue is full, or an escalation still fails after its retries, it's left to the uploader. An
+      escalation that couldn't be written to the on-disk queue when it was submitted is spilled to it then instead.
+    - If the on-disk escalation queue is over its quota, escalations are only kept in memory, and are dropped if they
+      can't be submitted. The request path checks `accepts` first, and doesn't escalate at all if there's no room left.
+"""
+
+import asyncio
+import functools
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from fastapi import HTTPException
+from intellioptics import IntelliOptics
+
+from app.core.configs import GlobalConfig
+from app.core.utils import get_formatted_timestamp_str, prefixed_ksuid, safe_call_sdk
+from app.escalation_queue.constants import DISPATCH_GRACE_SEC
+from app.escalation_queue.models import EscalationInfo, ImageLocation, SubmitImageQueryParams
+from app.escalation_queue.queue_writer import QueueWriter
+from app.metrics.runtime_stats import runtime_stats
+
+logger = logging.getLogger(__name__)
+
+# Status codes of cloud responses for which a later retry may succeed
+RETRYABLE_STATUS_CODES = {408, 429}
+# The cloud responds with this when an image query with the given ID already exists
+HTTP_409_CONFLICT = 409
+MAX_RETRY_BACKOFF_SEC = 30.0
+THROUGHPUT_WINDOW_SEC = 60.0
+
+
+@dataclass
+class Escalation:
+    """An image query to submit to the cloud, with the same ID as the edge answer that was returned."""
+
+    detector_id: str
+    image_bytes: bytes
+    io: IntelliOptics
+    submit_iq_params: SubmitImageQueryParams
+    is_audit: bool
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # Where the image was written in the on-disk escalation queue, if the escalation was written there
+    queued_image: ImageLocation | None = None
+
+
+@dataclass
+class _Shard:
+    """The escalations of the detectors that one worker is responsible for, in the order they were made."""
+
+    escalations: deque[Escalation] = field(default_factory=deque)
+    has_escalations: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+def is_retryable_error(error: Exception) -> bool:
+    if isinstance(error, HTTPException):
+        return error.status_code >= 500 or error.status_code in RETRYABLE_STATUS_CODES
+    return True  # Network errors and timeouts
+
+
+class EscalationDispatcher:
+    """Submits escalations to the cloud in the background, from a bounded queue."""
+
+    def __init__(self, global_config: GlobalConfig, queue_writer: QueueWriter | None = None) -> None:
+        self.num_workers = global_config.escalation_workers
+        self.max_queue_size = global_config.escalation_queue_size
+        self.max_attempts = global_config.escalation_max_attempts
+        self.retry_backoff_sec = global_config.escalation_retry_backoff
+        self.queue_writer = queue_writer
+
+        self._shards = [_Shard() for _ in range(self.num_workers)]
+        self._queued = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="escalation")
+        # Writing escalations to disk gets its own thread, so that it isn't stuck behind slow cloud calls
+        self._queue_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="escalation-queue")
+        self._workers: list[asyncio.Task] = []
+        self._submit_times: deque[float] = deque()  # Times of recent successful submissions, for throughput
+
+    def start(self) -> None:
+        self._workers = [asyncio.create_task(self._run_worker(shard)) for shard in self._shards]
+
+    async def stop(self) -> None:
+        """Stops the workers. Escalations that haven't been submitted yet are left to the uploader."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for shard in self._shards:
+            while shard.escalations:
+                self._spill(shard.escalations.popleft(), reason="shutdown")
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._queue_executor.shutdown(wait=True)
+        if self.queue_writer is not None:
+            self.queue_writer.close()
+
+    def accepts(self, is_audit: bool) -> bool:
+        """Whether there's room for another audit or escalation, in memory or in the on-disk escalation queue."""
+        if self._queued < self.max_queue_size:
+            return True
+        if self.queue_writer is not None and self.queue_writer.admits(is_audit):
+            return True
+        runtime_stats.increment("escalations_refused", kind="audit" if is_audit else "escalation")
+        return False
+
+    async def submit(self, escalation: Escalation) -> None:
+        """
+        Writes an escalation to the on-disk escalation queue, and queues it to be submitted to the cloud. Once this
+        returns, the escalation has been handed to the queue writer, unless the on-disk queue is over its quota.
+        """
+        is_dispatched = self._queued < self.max_queue_size
+        if is_dispatched:
+            self._queued += 1  # Reserves its place while it's being written
+        try:
+            reason = None
+            if self.queue_writer is not None:
+                loop = asyncio.get_running_loop()
+                reason = await loop.run_in_executor(
+                    self._queue_executor, self._write_to_queue, escalation, is_dispatched
+                )
+                if reason is not None:
+                    runtime_stats.increment("escalations_not_queued", reason=reason)
+        except BaseException:
+            # E.g. the request was cancelled while the escalation was being written. The write still finishes, and
+            # the uploader picks the escalation up once it's no longer being dispatched.
+            if is_dispatched:
+                self._queued -= 1
+            raise
+        if not is_dispatched:
+            if escalation.queued_image is None:
+                self._drop(escalation, reason=reason or "queue_full")
+            else:
+                runtime_stats.increment("escalations_spilled", reason="queue_full")
+            return
+        shard = self._shards[hash(escalation.detector_id) % self.num_workers]
+        shard.escalations.append(escalation)
+        shard.has_escalations.set()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        oldest_enqueued_at = min(
+            (shard.escalations[0].enqueued_at for shard in self._shards if shard.escalations), default=now
+        )
+        self._trim_submit_times(now)
+        stats = {
+            "queue_depth": self._queued,
+            "max_queue_size": self.max_queue_size,
+            "oldest_age_sec": now - oldest_enqueued_at,
+            "submitted_per_sec": len(self._submit_times) / THROUGHPUT_WINDOW_SEC,
+        }
+        if self.queue_writer is not None:
+            disk_queue_stats = self.queue_writer.quota.stats()
+            stats["disk_queue_bytes"] = disk_queue_stats["bytes"]
+            stats["disk_queue_records"] = disk_queue_stats["records"]
+            stats["disk_queue_fill_fraction"] = disk_queue_stats["fill_fraction"]
+        return stats
+
+    def _trim_submit_times(self, now: float) -> None:
+        while self._submit_times and now - self._submit_times[0] > THROUGHPUT_WINDOW_SEC:
+            self._submit_times.popleft()
+
+    async def _run_worker(self, shard: _Shard) -> None:
+        while True:
+            if not shard.escalations:
+                shard.has_escalations.clear()
+                await shard.has_escalations.wait()
+                continue
+            escalation = shard.escalations.popleft()
+            try:
+                await self._submit_with_retries(escalation)
+            except asyncio.CancelledError:
+                self._spill(escalation, reason="shutdown")
+                raise
+            except Exception as e:
+                logger.error(f"Unexpected error submitting escalation for {escalation.detector_id}: {e}", exc_info=True)
+            finally:
+                self._queued -= 1
+
+    async def _submit_with_retries(self, escalation: Escalation) -> None:
+        loop = asyncio.get_running_loop()
+        kind = "audit" if escalation.is_audit else "escalation"
+        params = escalation.submit_iq_params
+        for attempt in range(1, self.max_attempts + 1):
+            start = time.monotonic()
+            if escalation.queued_image is not None and start - escalation.enqueued_at >= DISPATCH_GRACE_SEC:
+                logger.info(f"Leaving {kind} {params.image_query_id} to the escalation queue uploader.")
+                runtime_stats.increment("escalations_left_to_uploader", kind=kind)
+                return
+            try:
+                await loop.run_in_executor(
+                    self._executor,
+                    lambda: safe_call_sdk(
+                        escalation.io.submit_image_query,
+                        detector=escalation.detector_id,
+                        image=escalation.image_bytes,
+                        wait=0,
+                        want_async=True,
+                        **params.model_dump(),
+                    ),
+                )
+            except Exception as e:
+                if isinstance(e, HTTPException) and e.status_code == HTTP_409_CONFLICT:
+                    # The uploader submitted it first, from the on-disk queue
+                    self._ack(escalation)
+                    return
+                runtime_stats.increment("escalation_submit_errors", kind=kind)
+                if not is_retryable_error(e):
+                    logger.error(f"Failed to submit {kind} {params.image_query_id} to the cloud, not retrying: {e}")
+                    self._ack(escalation)  # So that the uploader doesn't try it again either
+                    return
+                if attempt == self.max_attempts:
+                    logger.warning(f"Failed to submit {kind} {params.image_query_id} after {attempt} attempts: {e}")
+                    self._spill(escalation, reason="retries_exhausted")
+                    return
+                backoff_sec = min(self.retry_backoff_sec * 2 ** (attempt - 1), MAX_RETRY_BACKOFF_SEC)
+                logger.info(f"Retrying {kind} {params.image_query_id} in {backoff_sec}s after error: {e}")
+                runtime_stats.increment("escalation_retries", kind=kind)
+                await asyncio.sleep(backoff_sec)
+                continue
+
+            self._ack(escalation)
+            now = time.monotonic()
+            self._submit_times.append(now)
+            self._trim_submit_times(now)
+            runtime_stats.increment("escalations_submitted", kind=kind)
+            runtime_stats.observe_ms("escalation_submit_ms", (now - start) * 1000, kind=kind)
+            runtime_stats.observe_ms("escalation_queue_to_submit_ms", (now - escalation.enqueued_at) * 1000, kind=kind)
+            return
+
+    def _ack(self, escalation: Escalation) -> None:
+        """Acknowledges the escalation's image in the on-disk queue, if it's there, so that the uploader skips it."""
+        if escalation.queued_image is not None:
+            self._queue_executor.submit(self._ack_image, escalation, escalation.queued_image)
+
+    def _ack_image(self, escalation: Escalation, image_location: ImageLocation) -> None:
+        try:
+            self.queue_writer.ack_image(image_location)
+        except OSError as e:
+            # The uploader will find out from the cloud that it was already submitted
+            logger.warning(f"Failed to acknowledge escalation {escalation.submit_iq_params.image_query_id}: {e}")
+
+    def _spill(self, escalation: Escalation, reason: str) -> None:
+        """
+        Leaves an escalation that couldn't be submitted to the uploader, writing it to the on-disk escalation queue if
+        it isn't there already, or drops it if it can't be written there.
+        """
+        if escalation.queued_image is not None:
+            runtime_stats.increment("escalations_spilled", reason=reason)
+            return
+        if self.queue_writer is None:
+            self._drop(escalation, reason=reason)
+            return
+        self._queue_executor.submit(self._spill_to_queue, escalation, reason)
+
+    def _spill_to_queue(self, escalation: Escalation, reason: str) -> None:
+        if (failure_reason := self._write_to_queue(escalation, is_dispatched=False)) is not None:
+            self._drop(escalation, reason=failure_reason)
+        else:
+            runtime_stats.increment("escalations_spilled", reason=reason)
+
+    def _drop(self, escalation: Escalation, reason: str) -> None:
+        logger.warning(f"Dropping escalation {escalation.submit_iq_params.image_query_id}: {reason}")
+        runtime_stats.increment("escalations_dropped", reason=reason)
+
+    def _write_to_queue(self, escalation: Escalation, is_dispatched: bool) -> str | None:
+        """
+        Writes the escalation to the on-disk escalation queue, unless it's over its quota. If the escalation is being
+        dispatched, the uploader leaves it to the dispatcher for `DISPATCH_GRACE_SEC`. Returns why the escalation
+        wasn't written, if it wasn't.
+        """
+        if not self.queue_writer.admits(escalation.is_audit, len(escalation.image_bytes)):
+            return "disk_queue_full"
+        try:
+            self._write_escalation_info(escalation, is_dispatched)
+        except Exception as e:
+            logger.error(f"Failed to write escalation {escalation.submit_iq_params.image_query_id} to disk: {e}")
+            return "write_failed"
+        return None
+
+    def _write_escalation_info(self, escalation: Escalation, is_dispatched: bool) -> None:
+        """Writes the escalation and its image to the on-disk queue, and sets where its image was written."""
+        image_path, image_location = self.queue_writer.append_image(escalation.image_bytes)
+        # Set before the escalation is written, since a failed group commit can reset it as soon as it is
+        escalation.queued_image = image_location
+        try:
+            escalation_info = EscalationInfo(
+                timestamp=get_formatted_timestamp_str(),
+                detector_id=escalation.detector_id,
+                image_path_str=image_path,
+                request_id=prefixed_ksuid(prefix="req_"),
+                submit_iq_params=escalation.submit_iq_params,
+                image_location=image_location,
+                is_audit=escalation.is_audit,
+                dispatched_at=time.time() if is_dispatched else None,
+            )
+            on_commit_failed = functools.partial(self._on_commit_failed, escalation, image_location, is_dispatched)
+            if not self.queue_writer.write_escalation(escalation_info, on_commit_failed=on_commit_failed):
+                raise OSError("the escalation queue writer failed")
+        except BaseException:
+            escalation.queued_image = None
+            # Nothing refers to the image, so it's acknowledged right away, or its segment would never be reclaimed
+            self._ack_image(escalation, image_location)
+            raise
+
+    def _on_commit_failed(self, escalation: Escalation, image_location: ImageLocation, is_dispatched: bool) -> None:
+        """
+        Called from the queue writer's commit thread when the escalation's record couldn't be written to disk after
+        the writer had accepted it. If the escalation is being dispatched, it's no longer considered queued: it isn't
+        left to the uploader after `DISPATCH_GRACE_SEC`, and it's spilled to the queue again if it can't be submitted.
+        """
+        self._ack_image(escalation, image_location)
+        if not is_dispatched:
+            self._drop(escalation, reason="commit_failed")
+            return
+        if escalation.queued_image == image_location:
+            escalation.queued_image = None
+        runtime_stats.increment("escalations_not_queued", reason="commit_failed")
@@ -15,3 +15,10 @@ MODEL_REPOSITORY_PATH = "/opt/intellioptics/edge/serving/model-repo"
 # Path to the database log file. This will contain all SQL queries executed by the ORM.
 DATABASE_ORM_LOG_FILE = "sqlalchemy.log"
 DATABASE_ORM_LOG_FILE_SIZE = 10_000_000  # 10 MB
+
+# Directory (a hostPath volume shared with the inference pods on the same node) where inference servers can listen on
+# Unix domain sockets, named after their service, e.g. `inference-service-primary-det-abc.sock`.
+INFERENCE_SOCKET_DIR = "/opt/intellioptics/edge/sockets"
+
+# Prefix of the memory-mapped files that hold the state shared by the edge-endpoint worker processes in a pod.
+SHARED_STATE_PATH_PREFIX = "/dev/shm/edge-endpoint-state"
@@ -0,0 +1,197 @@
+"""Hedging slow edge inference requests with a cloud submission.
+
+A stuck or overloaded inference pod can make a request wait far longer than usual for its edge answer. For detectors
+with `hedge_to_cloud` enabled, if the edge answer hasn't arrived after a high percentile of the detector's recent edge
+latency, the image query is also submitted to the cloud, and whichever usable answer arrives first is returned: a
+confident edge answer, or a confident cloud answer. The cloud call waits for the cloud's answer for as long as the edge
+answer has left before its deadline (`inference_timeout`). If neither answer is confident, the cloud image query is
+returned, as it would be for an unconfident edge answer.
+
+The cloud call runs in a worker thread and can't be recalled once it's sent. If the edge answer wins, the cloud image
+query is still created, with the same ID as the returned edge answer. It's a plain escalation of the image, without
+the edge answer, so it's counted as an escalation rather than an audit. If the cloud call fails after the edge answer
+was returned, the image query is escalated again through the escalation dispatcher, so that the returned ID exists in
+the cloud. Each hedge costs a cloud image query, so the fraction of requests that can be hedged is bounded by
+`max_hedge_rate`.
+"""
+
+import asyncio
+import functools
+import logging
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Awaitable, Callable
+
+from app.core.configs import EdgeInferenceConfig
+from app.core.speedmon import SpeedMonitor
+from app.core.utils import prefixed_ksuid
+from app.metrics.iq_activity import record_activity_for_metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class HedgeStats:
+    requests: int = 0  # Edge inference requests that were eligible for hedging
+    hedged: int = 0  # Requests for which a cloud image query was submitted
+    edge_wins: int = 0  # Hedged requests that returned a confident edge answer
+    cloud_wins: int = 0  # Hedged requests that returned a confident cloud answer
+    no_usable_answer: int = 0  # Hedged requests for which neither answer was confident in time
+    late_cloud_failures: int = 0  # Edge wins whose cloud submission failed after the edge answer was returned
+
+    @property
+    def hedge_rate(self) -> float:
+        return self.hedged / self.requests if self.requests else 0.0
+
+    def as_dict(self) -> dict:
+        cloud_win_ratio = self.cloud_wins / self.hedged if self.hedged else 0.0
+        return {**asdict(self), "hedge_rate": self.hedge_rate, "cloud_win_ratio": cloud_win_ratio}
+
+
+@dataclass
+class HedgeOutcome:
+    """
+    The result of a hedged edge inference request. Exactly one of `edge_results` and `cloud_image_query` is set.
+    If a cloud image query was submitted and the edge answer was returned, `image_query_id` is the ID of that image
+    query.
+    """
+
+    edge_results: dict | None = None
+    cloud_image_query: Any = None
+    image_query_id: str | None = None
+
+
+class RequestHedger:
+    """Runs edge inference requests, hedging the slow ones with a cloud submission."""
+
+    def __init__(self, speedmon: SpeedMonitor) -> None:
+        self.speedmon = speedmon
+        self.stats: dict[str, HedgeStats] = {}
+        # Escalations of image queries whose hedged cloud submission failed after the edge answer was returned
+        self._escalation_tasks: set[asyncio.Task] = set()
+
+    def hedge_delay_sec(self, detector_id: str, inference_config: EdgeInferenceConfig) -> float:
+        """How long to wait for the edge answer before submitting to the cloud."""
+        recent_latency_ms = self.speedmon.percentile_ms(detector_id, inference_config.hedge_latency_percentile) or 0.0
+        return max(recent_latency_ms, inference_config.hedge_min_delay_ms) / 1000
+
+    async def run(
+        self,
+        detector_id: str,
+        inference_config: EdgeInferenceConfig,
+        edge_inference: Awaitable[dict],
+        submit_to_cloud: Callable[..., Any],
+        is_usable: Callable[[dict], bool],
+        is_cloud_usable: Callable[[Any], bool],
+        escalate: Callable[[str], Awaitable[None]],
+    ) -> HedgeOutcome:
+        """
+        Wait for `edge_inference`, submitting the image query to the cloud if it takes too long.
+
+        Args:
+            detector_id: ID of the detector the request is for
+            inference_config: The detector's edge inference config
+            edge_inference: The edge inference call
+            submit_to_cloud: Blocking function that submits the image query to the cloud and returns the cloud image
+                query. Called in a worker thread, with `image_query_id` and `wait` (the number of seconds to wait for
+                the cloud's answer) keyword arguments.
+            is_usable: Whether an edge answer can be returned without waiting for the cloud answer
+            is_cloud_usable: Whether a cloud image query has an answer that can be returned without waiting for the
+                edge answer
+            escalate: Escalates the image query with the given ID in the background. Called if the cloud call fails
+                after the edge answer was returned with that ID.
+        Raises:
+            Any exception from the edge inference call if the cloud answer isn't available to fall back on.
+        """
+        stats = self.stats.setdefault(detector_id, HedgeStats())
+        stats.requests += 1
+        edge_task = asyncio.ensure_future(edge_inference)
+        started_at = time.monotonic()
+        try:
+            done, _ = await asyncio.wait({edge_task}, timeout=self.hedge_delay_sec(detector_id, inference_config))
+            if done or stats.hedge_rate >= inference_config.max_hedge_rate:
+                return HedgeOutcome(edge_results=await edge_task)
+
+            image_query_id = prefixed_ksuid(prefix="iq_")
+            logger.debug(f"Edge inference is slow for {detector_id=}, hedging with cloud image query {image_query_id}.")
+            stats.hedged += 1
+            record_activity_for_metrics(detector_id, activity_type="escalations")
+            # Wait for the cloud's answer for as long as the edge answer could still take
+            wait_sec = max(0.0, inference_config.inference_timeout - (time.monotonic() - started_at))
+            cloud_task = asyncio.ensure_future(
+                asyncio.to_thread(submit_to_cloud, image_query_id=image_query_id, wait=wait_sec)
+            )
+            return await self._race(
+                detector_id, stats, edge_task, cloud_task, is_usable, is_cloud_usable, escalate, image_query_id
+            )
+        finally:
+            edge_task.cancel()
+
+    async def _race(
+        self,
+        detector_id: str,
+        stats: HedgeStats,
+        edge_task: asyncio.Future,
+        cloud_task: asyncio.Future,
+        is_usable: Callable[[dict], bool],
+        is_cloud_usable: Callable[[Any], bool],
+        escalate: Callable[[str], Awaitable[None]],
+        image_query_id: str,
+    ) -> HedgeOutcome:
+        cloud_failed = False
+        pending = {edge_task, cloud_task}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if cloud_task in done and cloud_task.exception() is not None:
+                logger.warning(f"Hedged cloud submission failed for {detector_id=}: {cloud_task.exception()}")
+                cloud_failed = True
+            if edge_task in done and edge_task.exception() is None and is_usable(edge_task.result()):
+                stats.edge_wins += 1
+                # Unless it failed, the cloud image query will still be created, with the ID of the returned answer
+                if cloud_task in pending:
+                    cloud_task.add_done_callback(
+                        functools.partial(self._on_late_cloud_result, detector_id, stats, escalate, image_query_id)
+                    )
+                return HedgeOutcome(
+                    edge_results=edge_task.result(), image_query_id=None if cloud_failed else image_query_id
+                )
+            if cloud_task in done and not cloud_failed and is_cloud_usable(cloud_task.result()):
+                stats.cloud_wins += 1
+                return HedgeOutcome(cloud_image_query=cloud_task.result())
+
+        # Neither answer is confident. The cloud image query is what an unconfident edge answer would be escalated to
+        # anyway, so return it, still waiting for its answer.
+        stats.no_usable_answer += 1
+        if not cloud_failed:
+            return HedgeOutcome(cloud_image_query=cloud_task.result())
+        # Fall back to the edge answer, even if it isn't confident. If edge inference failed too, this re-raises its
+        # error so that the caller can handle it as usual.
+        return HedgeOutcome(edge_results=await edge_task)
+
+    def _on_late_cloud_result(
+        self,
+        detector_id: str,
+        stats: HedgeStats,
+        escalate: Callable[[str], Awaitable[None]],
+        image_query_id: str,
+        cloud_task: asyncio.Future,
+    ) -> None:
+        """Escalates the image query again if its cloud submission failed after the edge answer was returned."""
+        if cloud_task.cancelled() or cloud_task.exception() is None:
+            return
+        logger.warning(
+            f"Hedged cloud submission of {image_query_id} failed for {detector_id=} after the edge answer was "
+            f"returned, escalating it instead: {cloud_task.exception()}"
+        )
+        stats.late_cloud_failures += 1
+        escalation_task = asyncio.ensure_future(escalate(image_query_id))
+        self._escalation_tasks.add(escalation_task)
+        escalation_task.add_done_callback(self._on_escalation_done)
+
+    def _on_escalation_done(self, escalation_task: asyncio.Task) -> None:
+        self._escalation_tasks.discard(escalation_task)
+        if not escalation_task.cancelled() and escalation_task.exception() is not None:
+            logger.error(f"Failed to escalate a hedged image query: {escalation_task.exception()}")
+
+    def stats_snapshot(self) -> dict[str, dict]:
+        return {detector_id: stats.as_dict() for detector_id, stats in self.stats.items()}
@@ -0,0 +1,71 @@
+"""Edge-side image preprocessing before inference.
+
+High-resolution cameras send multi-megabyte images, while the inference models work at a few hundred pixels. When a
+detector is configured with `max_image_dimension`, images larger than that are decoded once, downscaled, and re-encoded
+here, and the smaller buffer is sent to both the primary and OODD inference pods. Images escalated to the cloud are
+always sent at their original resolution.
+"""
+
+import logging
+from io import BytesIO
+
+from PIL import Image, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+REENCODED_CONTENT_TYPE = "image/jpeg"
+
+
+def get_image_dimensions(image_bytes: bytes) -> tuple[int, int] | None:
+    """
+    Read the (width, height) of an image from its header, without decoding the pixel data.
+    Returns None if the image format isn't recognized.
+    """
+    try:
+        with Image.open(BytesIO(image_bytes)) as img:
+            return img.size
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+
+
+def needs_downscaling(image_size: tuple[int, int] | None, max_image_dimension: int | None) -> bool:
+    if image_size is None or max_image_dimension is None:
+        return False
+    return max(image_size) > max_image_dimension
+
+
+def downscale_image(image_bytes: bytes, max_image_dimension: int, quality: int) -> bytes:
+    """
+    Resize an image so that its longest side is at most `max_image_dimension` pixels, preserving the aspect ratio, and
+    re-encode it as a JPEG with the given quality. This does a full decode, so it should be run off the event loop.
+    """
+    with Image.open(BytesIO(image_bytes)) as img:
+        # For JPEGs this lets the decoder do most of the downscaling during decoding, which is much cheaper
+        img.draft("RGB", (max_image_dimension, max_image_dimension))
+        exif = img.info.get("exif")
+        resized = img.convert("RGB")
+        resized.thumbnail((max_image_dimension, max_image_dimension), Image.Resampling.BILINEAR)
+
+    output = BytesIO()
+    save_kwargs = {"exif": exif} if exif else {}  # Keep the EXIF orientation so the image is interpreted the same way
+    resized.save(output, format="JPEG", quality=quality, **save_kwargs)
+    return output.getvalue()
+
+
+def preprocess_image(
+    image_bytes: bytes, content_type: str, max_image_dimension: int | None, quality: int
+) -> tuple[bytes, str]:
+    """
+    Downscale and re-encode an image if it's larger than `max_image_dimension`.
+    Returns the (possibly new) image bytes and their content type.
+    """
+    image_size = get_image_dimensions(image_bytes)
+    if not needs_downscaling(image_size, max_image_dimension):
+        return image_bytes, content_type
+
+    processed_bytes = downscale_image(image_bytes, max_image_dimension, quality)
+    logger.debug(
+        f"Downscaled {image_size[0]}x{image_size[1]} image for inference ({len(image_bytes)} -> "
+        f"{len(processed_bytes)} bytes)."
+    )
+    return processed_bytes, REENCODED_CONTENT_TYPE
@@ -0,0 +1,141 @@
+"""Result cache for edge inference, keyed by a perceptual hash of the submitted image.
+
+Fixed cameras tend to send long runs of nearly identical frames. Rather than sending every one of them to the primary
+and OODD inference pods, we compute a difference hash (dHash) of the image and reuse a recent result for an image whose
+hash is within a small Hamming distance of the new one.
+"""
+
+import copy
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from io import BytesIO
+
+from PIL import Image
+
+from app.core.utils import _size_of_dict_in_bytes
+
+logger = logging.getLogger(__name__)
+
+DHASH_SIZE = 8  # Produces a 64-bit hash
+
+
+def dhash(image_bytes: bytes, hash_size: int = DHASH_SIZE) -> int:
+    """
+    Compute the difference hash of an image. The image is decoded in grayscale at a reduced size, shrunk to
+    (hash_size + 1) x hash_size pixels, and each bit of the hash records whether a pixel is darker than its right-hand
+    neighbour. Similar images produce hashes with a small Hamming distance.
+    """
+    with Image.open(BytesIO(image_bytes)) as img:
+        # For JPEGs this lets the decoder skip most of the work by decoding at a fraction of the full resolution
+        img.draft("L", (hash_size * 4, hash_size * 4))
+        small = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+
+    pixels = small.tobytes()
+    image_hash = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            image_hash = (image_hash << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return image_hash
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    return (hash_a ^ hash_b).bit_count()
+
+
+@dataclass
+class CachedResult:
+    result: dict
+    created_at: float
+    size_bytes: int
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    # Estimated time the inference pods would have spent on the requests that were served from the cache
+    saved_ms: float = 0.0
+
+
+class InferenceResultCache:
+    """
+    LRU cache of inference results for a single detector, keyed by perceptual image hash.
+
+    Entries expire after `ttl_sec`, and the least recently used entries are evicted once the cache holds more than
+    `max_entries` entries or `max_bytes` bytes of results.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_sec: float, max_hamming_distance: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self.max_hamming_distance = max_hamming_distance
+        self.stats = CacheStats()
+        self._entries: OrderedDict[int, CachedResult] = OrderedDict()
+        self._total_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def get(self, image_hash: int) -> dict | None:
+        """
+        Look up a result for an image hash. Returns a copy of the cached result for the closest hash within the
+        configured Hamming distance, or None if there is no such (unexpired) entry.
+        """
+        self._evict_expired()
+
+        matched_hash = image_hash if image_hash in self._entries else self._find_nearest(image_hash)
+        if matched_hash is None:
+            self.stats.misses += 1
+            return None
+
+        self._entries.move_to_end(matched_hash)
+        self.stats.hits += 1
+        return copy.deepcopy(self._entries[matched_hash].result)
+
+    def put(self, image_hash: int, result: dict) -> None:
+        """Cache a result for an image hash, evicting old entries if the cache is over its limits."""
+        if image_hash in self._entries:
+            self._remove(image_hash)
+
+        entry = CachedResult(
+            result=copy.deepcopy(result), created_at=time.monotonic(), size_bytes=_size_of_dict_in_bytes(result)
+        )
+        if entry.size_bytes > self.max_bytes:
+            logger.debug(f"Not caching inference result of {entry.size_bytes} bytes, which exceeds the cache size.")
+            return
+
+        self._entries[image_hash] = entry
+        self._total_bytes += entry.size_bytes
+        while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+            oldest_hash = next(iter(self._entries))
+            self._remove(oldest_hash)
+            self.stats.evictions += 1
+
+    def _find_nearest(self, image_hash: int) -> int | None:
+        if self.max_hamming_distance <= 0:
+            return None
+        best_hash, best_distance = None, self.max_hamming_distance + 1
+        for cached_hash in self._entries:
+            distance = hamming_distance(image_hash, cached_hash)
+            if distance < best_distance:
+                best_hash, best_distance = cached_hash, distance
+        return best_hash
+
+    def _evict_expired(self) -> None:
+        expiry = time.monotonic() - self.ttl_sec
+        expired = [image_hash for image_hash, entry in self._entries.items() if entry.created_at < expiry]
+        for image_hash in expired:
+            self._remove(image_hash)
+
+    def _remove(self, image_hash: int) -> None:
+        entry = self._entries.pop(image_hash)
+        self._total_bytes -= entry.size_bytes
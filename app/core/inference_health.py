@@ -0,0 +1,150 @@
+"""Background readiness probing for the edge inference services.
+
+Rather than checking `/health/ready` on the request path, a background task polls every known inference service on its
+own schedule and records the outcome in a readiness table. Request handlers only ever consult the table, so checking
+whether edge inference is available is a pure in-memory lookup and a hung pod can't block a request.
+
+When the edge-endpoint workers share state, only one of them (the leader) probes, and it publishes the readiness table
+to the other workers through the shared state.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterable
+
+import httpx
+from fastapi import status
+
+from app.core.shared_state import SharedState
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ServiceHealth:
+    """The most recent readiness information for a single inference service."""
+
+    ready: bool = False
+    last_checked: float | None = None  # Unix timestamp of the last probe, successful or not
+    last_success: float | None = None  # Unix timestamp of the last successful probe
+    consecutive_failures: int = 0
+
+
+class InferenceHealthProber:
+    """
+    Periodically probes the readiness endpoint of every inference service returned by `get_service_urls`.
+
+    A service is considered ready after a successful probe, and not ready once `failure_threshold` consecutive probes
+    have failed. Services that haven't been probed yet are not ready.
+
+    If `shared_state` is given, only the leader worker probes, and every worker reads readiness from the shared state.
+    """
+
+    def __init__(
+        self,
+        get_service_urls: Callable[[], Iterable[str]],
+        probe_interval_sec: float,
+        probe_timeout_sec: float,
+        failure_threshold: int = 1,
+        shared_state: SharedState | None = None,
+    ) -> None:
+        self.get_service_urls = get_service_urls
+        self.probe_interval_sec = probe_interval_sec
+        self.probe_timeout_sec = probe_timeout_sec
+        self.failure_threshold = failure_threshold
+        self.shared_state = shared_state
+        self.readiness: dict[str, ServiceHealth] = {}
+        self._client: httpx.AsyncClient | None = None
+        self._task: asyncio.Task | None = None
+
+    def is_ready(self, inference_client_url: str) -> bool:
+        """Look up whether a service was ready as of its last probe. Never makes a network call."""
+        if self.shared_state is not None:
+            shared_health = self.shared_state.get_readiness(inference_client_url)
+            return shared_health is not None and shared_health[0]
+        health = self.readiness.get(inference_client_url)
+        return health is not None and health.ready
+
+    async def start(self) -> None:
+        """Probe every service once, then keep probing in the background."""
+        if self._task is not None and not self._task.done():
+            return
+        self._client = httpx.AsyncClient(timeout=self.probe_timeout_sec)
+        # Populate the readiness table before we start serving requests
+        if self._should_probe():
+            await self.probe_all()
+        self._task = asyncio.create_task(self._run(), name="inference-health-prober")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def probe_all(self) -> None:
+        """Probe every known service concurrently and update the readiness table."""
+        service_urls = set(self.get_service_urls())
+        await asyncio.gather(*(self.probe(url) for url in service_urls))
+
+        # Forget about services that are no longer in use
+        for url in set(self.readiness) - service_urls:
+            del self.readiness[url]
+
+    async def probe(self, inference_client_url: str) -> bool:
+        """Probe a single service and record the result. Returns True if the service is ready."""
+        model_ready_url = f"http://{inference_client_url}/health/ready"
+        try:
+            response = await self._client.get(model_ready_url)
+            succeeded = response.status_code == status.HTTP_200_OK
+        except httpx.HTTPError as e:
+            logger.debug(f"Failed to connect to {model_ready_url}: {e}")
+            succeeded = False
+
+        health = self.readiness.setdefault(inference_client_url, ServiceHealth())
+        now = time.time()
+        health.last_checked = now
+        if succeeded:
+            if not health.ready:
+                logger.info(f"Inference service {inference_client_url} is ready.")
+            health.ready = True
+            health.last_success = now
+            health.consecutive_failures = 0
+        else:
+            health.consecutive_failures += 1
+            if health.ready and health.consecutive_failures >= self.failure_threshold:
+                logger.warning(
+                    f"Inference service {inference_client_url} is no longer ready after "
+                    f"{health.consecutive_failures} failed probe(s)."
+                )
+                health.ready = False
+
+        if self.shared_state is not None:
+            self.shared_state.publish_readiness(
+                inference_client_url,
+                ready=health.ready,
+                last_checked=health.last_checked,
+                last_success=health.last_success,
+                consecutive_failures=health.consecutive_failures,
+            )
+        return health.ready
+
+    def _should_probe(self) -> bool:
+        """Without shared state every worker probes. With it, only the leader does (and any worker can take over)."""
+        return self.shared_state is None or self.shared_state.try_become_leader()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.probe_interval_sec)
+            if not self._should_probe():
+                continue
+            try:
+                await self.probe_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # Never let a bad probe kill the prober
+                logger.error(f"Error while probing inference services: {e}", exc_info=True)
@@ -0,0 +1,176 @@
+"""Weighted fair scheduling of edge inference requests.
+
+Without scheduling, requests reach the inference pods in arrival order, so one noisy detector, API token or stream can
+starve everyone else. The `FairScheduler` bounds the number of inference requests in flight in a worker process and,
+when requests have to wait, dispatches them using start-time fair queuing (SFQ): every flow (a combination of source,
+detector and API token) gets a share of the inference capacity proportional to its configured weight.
+
+Requests come from two lanes. The API lane serves external clients, who are waiting on the answer. The stream lane
+serves frames sampled from RTSP streams, which is bulk work. By default, waiting API requests are always dispatched
+before waiting stream requests.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import AsyncIterator
+
+from app.core.configs import SchedulingConfig
+from app.metrics.runtime_stats import runtime_stats
+
+logger = logging.getLogger(__name__)
+
+# Flows whose finish tags fall behind the virtual clock are idle and can be forgotten once there are this many.
+MAX_TRACKED_FLOWS = 10_000
+
+
+class InferenceSource(str, Enum):
+    API = "api"
+    STREAM = "stream"
+
+
+@dataclass(order=True)
+class _Waiter:
+    start_tag: float
+    sequence: int
+    future: asyncio.Future = field(compare=False)
+    source: InferenceSource = field(compare=False)
+    detector_id: str = field(compare=False)
+
+
+class FairScheduler:
+    """Admits inference requests in weighted fair order, with at most `max_concurrent_inferences` in flight."""
+
+    def __init__(self, config: SchedulingConfig):
+        self.config = config
+        self.inflight = 0
+        self.inflight_per_source: dict[InferenceSource, int] = {source: 0 for source in InferenceSource}
+        self._virtual_time = 0.0
+        self._finish_tags: dict[tuple[InferenceSource, str, str | None], float] = {}
+        self._sequence = itertools.count()
+        # With `api_lane_priority`, each source has its own queue and the API queue is always served first
+        self._queues: dict[InferenceSource, list[_Waiter]] = {source: [] for source in InferenceSource}
+
+    def weight(self, source: InferenceSource, detector_id: str, api_token: str | None) -> float:
+        """The weight of a flow is the product of the weights of its source, detector and API token."""
+        config = self.config
+        source_weight = 1.0 if config.api_lane_priority else config.source_weights.get(source.value, 1.0)
+        detector_weight = config.detector_weights.get(detector_id, config.default_weight)
+        token_weight = config.api_token_weights.get(api_token, config.default_weight) if api_token else 1.0
+        return source_weight * detector_weight * token_weight
+
+    @asynccontextmanager
+    async def slot(
+        self, detector_id: str, source: InferenceSource = InferenceSource.API, api_token: str | None = None
+    ) -> AsyncIterator[None]:
+        """Wait for this request's turn, and hold one of the inference slots until the context exits."""
+        await self.acquire(detector_id, source, api_token)
+        try:
+            yield
+        finally:
+            self.release(source)
+
+    async def acquire(
+        self, detector_id: str, source: InferenceSource = InferenceSource.API, api_token: str | None = None
+    ) -> None:
+        flow = (source, detector_id, api_token)
+        start_tag = max(self._virtual_time, self._finish_tags.get(flow, 0.0))
+        self._finish_tags[flow] = start_tag + 1.0 / self.weight(source, detector_id, api_token)
+
+        enqueued_at = time.perf_counter()
+        waiter = _Waiter(
+            start_tag=start_tag,
+            sequence=next(self._sequence),
+            future=asyncio.get_running_loop().create_future(),
+            source=source,
+            detector_id=detector_id,
+        )
+        heapq.heappush(self._queue_for(source), waiter)
+        self._dispatch()  # If there's a free slot and nothing is ahead of us, this starts our request right away
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # We were given a slot just as we were cancelled, so pass it on to the next waiter
+                self.release(source)
+            raise
+        self._record_queue_delay(source, detector_id, (time.perf_counter() - enqueued_at) * 1000)
+
+    def release(self, source: InferenceSource) -> None:
+        self.inflight -= 1
+        self.inflight_per_source[source] -= 1
+        self._dispatch()
+
+    def num_waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        return {
+            "inflight": {source.value: count for source, count in self.inflight_per_source.items()},
+            "max_concurrent_inferences": self.config.max_concurrent_inferences,
+            "waiting": {source.value: len(queue) for source, queue in self._queues.items()},
+            "tracked_flows": len(self._finish_tags),
+        }
+
+    def _queue_for(self, source: InferenceSource) -> list[_Waiter]:
+        return self._queues[source] if self.config.api_lane_priority else self._queues[InferenceSource.API]
+
+    def _has_capacity(self, source: InferenceSource) -> bool:
+        if self.inflight >= self.config.max_concurrent_inferences:
+            return False
+        max_stream_inferences = self.config.max_concurrent_stream_inferences
+        if source == InferenceSource.STREAM and max_stream_inferences is not None:
+            return self.inflight_per_source[source] < max_stream_inferences
+        return True
+
+    def _start(self, source: InferenceSource, start_tag: float) -> None:
+        self.inflight += 1
+        self.inflight_per_source[source] += 1
+        self._virtual_time = max(self._virtual_time, start_tag)
+
+    def _dispatch(self) -> None:
+        while self.inflight < self.config.max_concurrent_inferences:
+            waiter = self._pop_next_waiter()
+            if waiter is None:
+                break
+            self._start(waiter.source, waiter.start_tag)
+            waiter.future.set_result(None)
+
+        if len(self._finish_tags) > MAX_TRACKED_FLOWS:
+            self._finish_tags = {
+                flow: finish_tag for flow, finish_tag in self._finish_tags.items() if finish_tag > self._virtual_time
+            }
+
+    def _pop_next_waiter(self) -> _Waiter | None:
+        # InferenceSource is declared in priority order, so the API queue is checked first
+        for queue in self._queues.values():
+            while queue:
+                waiter = queue[0]
+                if waiter.future.done():  # Skip requests that were cancelled while waiting
+                    heapq.heappop(queue)
+                    continue
+                if not self._has_capacity(waiter.source):
+                    # Stream requests are capped, but requests further back in a shared queue may still be dispatched
+                    waiter = self._pop_first_dispatchable(queue)
+                    if waiter is None:
+                        break
+                    return waiter
+                return heapq.heappop(queue)
+        return None
+
+    def _pop_first_dispatchable(self, queue: list[_Waiter]) -> _Waiter | None:
+        candidates = [waiter for waiter in queue if not waiter.future.done() and self._has_capacity(waiter.source)]
+        if not candidates:
+            return None
+        waiter = min(candidates)
+        queue.remove(waiter)
+        heapq.heapify(queue)
+        return waiter
+
+    def _record_queue_delay(self, source: InferenceSource, detector_id: str, delay_ms: float) -> None:
+        runtime_stats.observe_ms("scheduler_queue_delay", delay_ms, source=source.value, detector_id=detector_id)
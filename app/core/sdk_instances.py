@@ -0,0 +1,134 @@
+"""IntelliOptics SDK instances that share one pool of connections to the cloud.
+
+The edge endpoint keeps an SDK instance for each API token it sees. By default, every instance creates its own
+`httpx.Client`, so each token pays for its own TCP and TLS handshakes to the same cloud API. Instead, all of the
+instances here share a single long-lived client. The SDK sends the API token in the headers of each request, so
+sharing the client doesn't mix up tokens.
+
+The client's transport counts the connections it opens and the requests it sends (through httpcore's `trace` request
+extension), so the stats show how often requests reuse a pooled connection rather than opening a new one.
+"""
+
+import importlib.util
+import logging
+import threading
+
+import cachetools
+import httpx
+from intellioptics import IntelliOptics
+
+logger = logging.getLogger(__name__)
+
+CLOUD_MAX_CONNECTIONS = 100
+CLOUD_MAX_KEEPALIVE_CONNECTIONS = 20
+CLOUD_KEEPALIVE_EXPIRY_SEC = 60.0
+CLOUD_TIMEOUT_SEC = 30.0  # The SDK's default timeout
+CLOUD_CONNECT_TIMEOUT_SEC = 5.0
+
+
+class ConnectionCountingTransport(httpx.HTTPTransport):
+    """HTTP transport that counts the connections its pool opens and the requests it sends over them."""
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.connections_opened = 0
+        self.requests = 0
+        # Requests are sent from several threads
+        self._lock = threading.Lock()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions["trace"] = self._trace
+        return super().handle_request(request)
+
+    def _trace(self, event_name: str, info: dict) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.connections_opened += 1
+        elif event_name.endswith(".send_request_headers.started"):  # http11 or http2
+            with self._lock:
+                self.requests += 1
+
+
+def create_cloud_transport(http2: bool) -> ConnectionCountingTransport:
+    """Create the connection pool shared by all SDK instances. With HTTP/2, concurrent requests can share a connection."""
+    limits = httpx.Limits(
+        max_connections=CLOUD_MAX_CONNECTIONS,
+        max_keepalive_connections=CLOUD_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=CLOUD_KEEPALIVE_EXPIRY_SEC,
+    )
+    return ConnectionCountingTransport(http2=http2, limits=limits)
+
+
+def create_cloud_client(transport: httpx.BaseTransport) -> httpx.Client:
+    """Create the HTTP client shared by all SDK instances, sending requests through the shared connection pool."""
+    timeout = httpx.Timeout(CLOUD_TIMEOUT_SEC, connect=CLOUD_CONNECT_TIMEOUT_SEC)
+    return httpx.Client(transport=transport, timeout=timeout)
+
+
+class _CountingLRUCache(cachetools.LRUCache):
+    """
+    LRU cache of SDK instances that counts the instances it evicts. The instances don't own the shared client, so
+    evicting one only drops its per-token state, and never closes any connections.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        super().__init__(maxsize=maxsize)
+        self.evictions = 0
+
+    def popitem(self):
+        key, sdk = super().popitem()
+        self.evictions += 1
+        return key, sdk
+
+
+class SdkInstanceCache:
+    """Creates and caches an SDK instance per API token, all sharing one HTTP client."""
+
+    def __init__(self, maxsize: int) -> None:
+        self.http2 = importlib.util.find_spec("h2") is not None
+        if not self.http2:
+            logger.info("The h2 package isn't installed, so requests to the cloud will use HTTP/1.1.")
+        self.transport = create_cloud_transport(http2=self.http2)
+        self.client = create_cloud_client(self.transport)
+        self._instances = _CountingLRUCache(maxsize=maxsize)
+        # FastAPI runs sync dependencies, which look up SDK instances, in a thread pool
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, api_token: str | None) -> IntelliOptics:
+        """Returns the SDK instance for the API token. Raises `ApiTokenError` if there isn't a token."""
+        with self._lock:
+            sdk = self._instances.get(api_token)
+            if sdk is not None:
+                self.hits += 1
+                return sdk
+            self.misses += 1
+            sdk = IntelliOptics(api_token=api_token, http_client=self.client, timeout=CLOUD_TIMEOUT_SEC)
+            self._instances[api_token] = sdk
+            return sdk
+
+    def close(self) -> None:
+        with self._lock:
+            self._instances.clear()
+            self.client.close()
+
+    def stats(self) -> dict:
+        """
+        Lookups of SDK instances by API token (hits, misses and evictions), and the reuse of the shared client's
+        connections by the requests sent to the cloud.
+        """
+        lookups = self.hits + self.misses
+        requests = self.transport.requests
+        connections_opened = self.transport.connections_opened
+        return {
+            "instances": len(self._instances),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self._instances.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "http2": self.http2,
+            "requests": requests,
+            "connections_opened": connections_opened,
+            "connection_reuse_rate": max(0, requests - connections_opened) / requests if requests else 0.0,
+        }
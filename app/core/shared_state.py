@@ -0,0 +1,402 @@
+"""Shared-memory state for the edge-endpoint worker processes.
+
+The edge endpoint runs several uvicorn worker processes. Without shared state, each worker fetches its own detector
+metadata, probes the inference servers on its own, keeps its own escalation cooldowns (so a detector escalates once per
+cooldown per worker, rather than once per cooldown), and measures its own inference speed. `SharedState` keeps these in
+memory-mapped files under `/dev/shm`, which every worker in the pod maps.
+
+Each file is a `SharedSlotTable`: a fixed-size open-addressing hash table of fixed-size slots, keyed by short strings.
+    - Reads are lock-free. Every slot has a sequence number (a seqlock) that a writer makes odd while it writes and even
+      when it's done, plus a CRC of the value. A reader retries if the sequence number was odd or changed during the
+      read, or if the CRC doesn't match.
+    - Writes take a lock on just the slot being written (a POSIX record lock on the slot's byte range, plus a thread
+      lock), so read-modify-write updates such as the escalation cooldown check are atomic across workers.
+    - Slots are never freed. A key keeps its slot for the lifetime of the file.
+"""
+
+import fcntl
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"EESTATE1"
+_TABLE_HEADER = struct.Struct("<8sII")  # magic, num_slots, slot_size
+_TABLE_HEADER_SIZE = 64
+_SLOT_HEADER = struct.Struct("<QIIH6x")  # sequence number, value length, value CRC, key length
+MAX_KEY_BYTES = 104
+_VALUE_OFFSET = _SLOT_HEADER.size + MAX_KEY_BYTES  # 128
+# Number of lock-free read attempts before falling back to reading under the slot lock
+_MAX_READ_ATTEMPTS = 100
+# Number of thread locks that slots are striped over, within each process
+_NUM_THREAD_LOCKS = 64
+
+_READINESS = struct.Struct("<?ddI")  # ready, last checked, last success (NaN if never), consecutive failures
+_TIMESTAMP = struct.Struct("<d")
+_RING_HEADER = struct.Struct("<II")  # number of values, index of the next value to write
+
+
+class SharedStateFullError(RuntimeError):
+    """Raised when a new key can't be added because every slot in the table is taken."""
+
+
+class SharedSlotTable:
+    """A fixed-size hash table of byte values in a memory-mapped file, shared between processes."""
+
+    def __init__(self, path: str, num_slots: int, slot_size: int) -> None:
+        if slot_size <= _VALUE_OFFSET:
+            raise ValueError(f"slot_size must be larger than {_VALUE_OFFSET} bytes.")
+        self.path = path
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.max_value_size = slot_size - _VALUE_OFFSET
+        self._file_size = _TABLE_HEADER_SIZE + num_slots * slot_size
+        self._slot_indexes: dict[str, int] = {}  # Keys never move, so their slots can be cached
+        self._thread_locks = [threading.Lock() for _ in range(_NUM_THREAD_LOCKS)]
+        self._claim_lock = threading.Lock()
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._initialize_file()
+            self._mmap = mmap.mmap(self._fd, self._file_size)
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def get(self, key: str) -> bytes | None:
+        """Returns the value stored for a key, or None if there isn't one. Doesn't take any locks."""
+        index = self._find_slot(key)
+        if index is None:
+            return None
+        offset = self._slot_offset(index)
+        for _ in range(_MAX_READ_ATTEMPTS):
+            value = self._try_read_value(offset)
+            if value is not None:
+                return value or None
+        # A writer is holding the slot for a long time (or crashed mid-write), so wait for the lock instead
+        with self._slot_lock(index):
+            return self._try_read_value(offset) or None
+
+    def set(self, key: str, value: bytes) -> None:
+        with self.locked(key) as slot:
+            slot.write(value)
+
+    @contextmanager
+    def locked(self, key: str) -> Iterator["_LockedSlot"]:
+        """
+        Lock a key's slot for a read-modify-write update, claiming a slot for the key if it doesn't have one yet.
+        Raises `SharedStateFullError` if the key is new and the table is full.
+        """
+        index = self._find_slot(key)
+        if index is None:
+            index = self._claim_slot(key)
+        with self._slot_lock(index):
+            yield _LockedSlot(self, self._slot_offset(index))
+
+    def num_used_slots(self) -> int:
+        return sum(1 for index in range(self.num_slots) if self._read_key_length(index))
+
+    def keys(self) -> list[str]:
+        """Returns every key that has a slot. Doesn't take any locks."""
+        keys = []
+        for index in range(self.num_slots):
+            if key_length := self._read_key_length(index):
+                keys.append(self._read_key(index, key_length).decode())
+        return keys
+
+    def close(self) -> None:
+        self._mmap.close()
+        os.close(self._fd)
+
+    def _initialize_file(self) -> None:
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, _TABLE_HEADER_SIZE, 0)
+        try:
+            header = os.pread(self._fd, _TABLE_HEADER.size, 0)
+            if len(header) == _TABLE_HEADER.size and _TABLE_HEADER.unpack(header) == (
+                _MAGIC,
+                self.num_slots,
+                self.slot_size,
+            ):
+                return  # Another worker already created the table
+            # The file is new, or was created with a different layout. Start from an empty table.
+            os.ftruncate(self._fd, 0)
+            os.ftruncate(self._fd, self._file_size)
+            os.pwrite(self._fd, _TABLE_HEADER.pack(_MAGIC, self.num_slots, self.slot_size), 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, _TABLE_HEADER_SIZE, 0)
+
+    def _slot_offset(self, index: int) -> int:
+        return _TABLE_HEADER_SIZE + index * self.slot_size
+
+    def _read_key_length(self, index: int) -> int:
+        return _SLOT_HEADER.unpack_from(self._mmap, self._slot_offset(index))[3]
+
+    def _read_key(self, index: int, key_length: int) -> bytes:
+        key_offset = self._slot_offset(index) + _SLOT_HEADER.size
+        return self._mmap[key_offset : key_offset + key_length]
+
+    def _find_slot(self, key: str) -> int | None:
+        index = self._slot_indexes.get(key)
+        if index is not None:
+            return index
+
+        encoded_key = self._encode_key(key)
+        start = zlib.crc32(encoded_key) % self.num_slots
+        for probe in range(self.num_slots):
+            index = (start + probe) % self.num_slots
+            key_length = self._read_key_length(index)
+            if key_length == 0:
+                return None  # Keys are never removed, so the key would have been found before the first empty slot
+            if key_length == len(encoded_key) and self._read_key(index, key_length) == encoded_key:
+                self._slot_indexes[key] = index
+                return index
+        return None
+
+    def _claim_slot(self, key: str) -> int:
+        encoded_key = self._encode_key(key)
+        start = zlib.crc32(encoded_key) % self.num_slots
+        with self._claim_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, _TABLE_HEADER_SIZE, 0)
+            try:
+                for probe in range(self.num_slots):
+                    index = (start + probe) % self.num_slots
+                    key_length = self._read_key_length(index)
+                    if key_length == 0:
+                        # Write the key before its length, so that readers never see a partially written key
+                        key_offset = self._slot_offset(index) + _SLOT_HEADER.size
+                        self._mmap[key_offset : key_offset + len(encoded_key)] = encoded_key
+                        struct.pack_into("<H", self._mmap, self._slot_offset(index) + 16, len(encoded_key))
+                        self._slot_indexes[key] = index
+                        return index
+                    if key_length == len(encoded_key) and self._read_key(index, key_length) == encoded_key:
+                        self._slot_indexes[key] = index  # Another worker claimed it first
+                        return index
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, _TABLE_HEADER_SIZE, 0)
+        raise SharedStateFullError(f"No free slots left in {self.path} for {key=}.")
+
+    @staticmethod
+    def _encode_key(key: str) -> bytes:
+        encoded_key = key.encode()
+        if not encoded_key or len(encoded_key) > MAX_KEY_BYTES:
+            raise ValueError(f"Shared state keys must be between 1 and {MAX_KEY_BYTES} bytes long, got {key=}.")
+        return encoded_key
+
+    @contextmanager
+    def _slot_lock(self, index: int) -> Iterator[None]:
+        # POSIX record locks only exclude other processes, so threads in this process also need a thread lock
+        with self._thread_locks[index % _NUM_THREAD_LOCKS]:
+            offset = self._slot_offset(index)
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+    def _try_read_value(self, offset: int) -> bytes | None:
+        """Returns the slot's value (b"" if it's empty), or None if it was being written while we read it."""
+        sequence, value_length, crc, _ = _SLOT_HEADER.unpack_from(self._mmap, offset)
+        if sequence % 2 == 1 or value_length > self.max_value_size:
+            return None
+        value_offset = offset + _VALUE_OFFSET
+        value = self._mmap[value_offset : value_offset + value_length]
+        if _SLOT_HEADER.unpack_from(self._mmap, offset)[0] != sequence or zlib.crc32(value) != crc:
+            return None
+        return value
+
+    def _write_value(self, offset: int, value: bytes) -> None:
+        """Write a slot's value. The caller must hold the slot's lock."""
+        if len(value) > self.max_value_size:
+            raise ValueError(f"Value of {len(value)} bytes doesn't fit in a {self.max_value_size}-byte slot.")
+        sequence = struct.unpack_from("<Q", self._mmap, offset)[0]
+        # Make the sequence number odd so that readers retry. It already is if a writer died in the middle of a write.
+        sequence |= 1
+        struct.pack_into("<Q", self._mmap, offset, sequence)
+        value_offset = offset + _VALUE_OFFSET
+        self._mmap[value_offset : value_offset + len(value)] = value
+        struct.pack_into("<II", self._mmap, offset + 8, len(value), zlib.crc32(value))
+        struct.pack_into("<Q", self._mmap, offset, sequence + 1)
+
+
+class _LockedSlot:
+    """A slot whose lock is held by the current thread."""
+
+    def __init__(self, table: SharedSlotTable, offset: int) -> None:
+        self._table = table
+        self._offset = offset
+
+    def read(self) -> bytes | None:
+        return self._table._try_read_value(self._offset) or None
+
+    def write(self, value: bytes) -> None:
+        self._table._write_value(self._offset, value)
+
+
+class SharedState:
+    """
+    The state shared by the edge-endpoint workers in a pod: inference server readiness, escalation cooldowns, recent
+    inference latencies and detector metadata.
+
+    Small fixed-size records and detector metadata are kept in separate tables, since metadata needs much larger slots.
+    """
+
+    def __init__(
+        self,
+        path_prefix: str,
+        num_record_slots: int = 4096,
+        record_slot_size: int = 384,
+        num_metadata_slots: int = 1024,
+        metadata_slot_size: int = 8192,
+    ) -> None:
+        self.path_prefix = path_prefix
+        self.records = SharedSlotTable(f"{path_prefix}.records", num_record_slots, record_slot_size)
+        self.metadata = SharedSlotTable(f"{path_prefix}.metadata", num_metadata_slots, metadata_slot_size)
+        self._leader_fd: int | None = None
+
+    def try_become_leader(self) -> bool:
+        """
+        Try to become the worker that does work on behalf of all the workers, such as probing the inference servers.
+        Leadership is held until this process exits, at which point another worker can take over.
+        """
+        if self._leader_fd is not None:
+            return True
+        fd = os.open(f"{self.path_prefix}.leader", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        logger.info(f"Worker {os.getpid()} is now the leader for shared edge-endpoint tasks.")
+        self._leader_fd = fd
+        return True
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leader_fd is not None
+
+    def publish_readiness(
+        self,
+        inference_client_url: str,
+        ready: bool,
+        last_checked: float | None,
+        last_success: float | None,
+        consecutive_failures: int,
+    ) -> None:
+        value = _READINESS.pack(
+            ready, _or_nan(last_checked), _or_nan(last_success), min(consecutive_failures, 2**32 - 1)
+        )
+        self._set_record(f"ready:{inference_client_url}", value)
+
+    def get_readiness(self, inference_client_url: str) -> tuple[bool, float | None, float | None, int] | None:
+        """Returns (ready, last_checked, last_success, consecutive_failures), or None if nothing was published."""
+        value = self.records.get(f"ready:{inference_client_url}")
+        if value is None:
+            return None
+        ready, last_checked, last_success, consecutive_failures = _READINESS.unpack(value)
+        return ready, _nan_to_none(last_checked), _nan_to_none(last_success), consecutive_failures
+
+    def try_start_escalation(self, detector_id: str, min_time_between_escalations: float) -> bool:
+        """
+        Atomically check whether any worker escalated for the detector in the last `min_time_between_escalations`
+        seconds, and if not, record an escalation now. Returns True if the caller should escalate.
+        """
+        try:
+            with self.records.locked(f"escalation:{detector_id}") as slot:
+                now = time.time()
+                value = slot.read()
+                if value is not None and now - _TIMESTAMP.unpack(value)[0] <= min_time_between_escalations:
+                    return False
+                slot.write(_TIMESTAMP.pack(now))
+                return True
+        except SharedStateFullError as e:
+            logger.warning(f"Can't track the escalation cooldown in shared state: {e}")
+            return True
+
+    def record_latency(self, model_id: str, elapsed_ms: float, window_size: int) -> None:
+        """Add an inference latency to the model's ring buffer of the `window_size` most recent latencies."""
+        try:
+            with self.records.locked(f"latency:{model_id}") as slot:
+                value = slot.read()
+                count, next_index = _RING_HEADER.unpack_from(value) if value else (0, 0)
+                latencies = list(struct.unpack_from(f"<{count}d", value, _RING_HEADER.size)) if count else []
+                if count < window_size:
+                    latencies.append(elapsed_ms)
+                    count += 1
+                else:
+                    latencies[next_index % count] = elapsed_ms
+                next_index = (next_index + 1) % window_size
+                slot.write(_RING_HEADER.pack(count, next_index) + struct.pack(f"<{count}d", *latencies))
+        except SharedStateFullError as e:
+            logger.warning(f"Can't record inference latency in shared state: {e}")
+
+    def recent_latencies(self, model_id: str) -> list[float]:
+        value = self.records.get(f"latency:{model_id}")
+        if value is None:
+            return []
+        count, _ = _RING_HEADER.unpack_from(value)
+        return list(struct.unpack_from(f"<{count}d", value, _RING_HEADER.size))
+
+    def publish_detector_metadata(self, detector_id: str, metadata_json: bytes) -> None:
+        """Share a detector's metadata with the other workers. Skipped if the metadata is too large for a slot."""
+        value = _TIMESTAMP.pack(time.monotonic()) + metadata_json
+        if len(value) > self.metadata.max_value_size:
+            logger.debug(f"Metadata for {detector_id=} is too large to share ({len(value)} bytes).")
+            return
+        try:
+            self.metadata.set(f"metadata:{detector_id}", value)
+        except SharedStateFullError as e:
+            logger.warning(f"Can't share detector metadata: {e}")
+
+    def get_detector_metadata(self, detector_id: str) -> tuple[float, bytes] | None:
+        """Returns the time (from `time.monotonic()`) the metadata was fetched and its JSON, if any worker shared it."""
+        value = self.metadata.get(f"metadata:{detector_id}")
+        if value is None:
+            return None
+        return _TIMESTAMP.unpack_from(value)[0], value[_TIMESTAMP.size :]
+
+    def stats(self) -> dict:
+        return {
+            "is_leader": self.is_leader,
+            "record_slots_used": self.records.num_used_slots(),
+            "record_slots": self.records.num_slots,
+            "metadata_slots_used": self.metadata.num_used_slots(),
+            "metadata_slots": self.metadata.num_slots,
+        }
+
+    def close(self) -> None:
+        self.records.close()
+        self.metadata.close()
+        if self._leader_fd is not None:
+            os.close(self._leader_fd)  # Releases leadership
+            self._leader_fd = None
+
+    def _set_record(self, key: str, value: bytes) -> None:
+        try:
+            self.records.set(key, value)
+        except SharedStateFullError as e:
+            logger.warning(f"Can't update shared state: {e}")
+
+
+def open_shared_state(path_prefix: str) -> SharedState | None:
+    """Open (or create) the shared state. Returns None if it can't be opened, in which case state is per-process."""
+    try:
+        return SharedState(path_prefix)
+    except OSError as e:
+        logger.warning(f"Failed to open shared state at {path_prefix}, falling back to per-worker state: {e}")
+        return None
+
+
+def _or_nan(value: float | None) -> float:
+    return math.nan if value is None else value
+
+
+def _nan_to_none(value: float) -> float | None:
+    return None if math.isnan(value) else value
@@ -1,27 +1,55 @@
 import logging
+import math
 from collections import deque
 
+from app.core.shared_state import SharedState
+
 logger = logging.getLogger(__name__)
 
 
 class SpeedMonitor:
-    """Keeps track of how fast inference has been on each model, in a recency window"""
+    """
+    Keeps track of how fast inference has been on each model, in a recency window.
+    If `shared_state` is given, the window is shared by all the edge-endpoint workers.
+    """
 
-    def __init__(self, window_size: int = 20):
+    def __init__(self, window_size: int = 20, shared_state: SharedState | None = None):
         self.models = {}
         self.window_size = window_size
+        self.shared_state = shared_state
 
     def update(self, model_id: str, elapsed_ms: float):
+        if self.shared_state is not None:
+            self.shared_state.record_latency(model_id, elapsed_ms, self.window_size)
+            return
         if model_id not in self.models:
             self.models[model_id] = deque(maxlen=self.window_size)
         self.models[model_id].append(elapsed_ms)
 
+    def recent_latencies(self, model_id: str) -> list[float]:
+        """The latencies (in milliseconds) in the recency window. Empty if the model has not been updated yet."""
+        if self.shared_state is not None:
+            return self.shared_state.recent_latencies(model_id)
+        return list(self.models.get(model_id, ()))
+
     def average_fps(self, model_id: str) -> float:
         """Returns 0 if the model has not been updated yet."""
-        if model_id not in self.models:
+        latencies = self.recent_latencies(model_id)
+        if not latencies:
             return 0
-        N = len(self.models[model_id])
-        total_ms = sum(self.models[model_id])
+        N = len(latencies)
+        total_ms = sum(latencies)
         if total_ms == 0:
             return 1e99
         return 1000 * N / total_ms
+
+    def percentile_ms(self, model_id: str, percentile: float) -> float | None:
+        """
+        Returns the given percentile (0-100) of the recent inference latencies, in milliseconds, using the nearest-rank
+        method. Returns None if the model has not been updated yet.
+        """
+        latencies = sorted(self.recent_latencies(model_id))
+        if not latencies:
+            return None
+        rank = math.ceil(percentile / 100 * len(latencies))
+        return latencies[min(max(rank, 1), len(latencies)) - 1]
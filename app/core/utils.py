@@ -1,11 +1,10 @@
 import json
 import logging
-import time
+import math
 from datetime import datetime, timezone
 from io import BytesIO
 from typing import Any, Callable
 
-import cachetools
 import ksuid
 from fastapi import HTTPException
 from model import (ROI, BinaryClassificationResult, CountingResult,
@@ -13,7 +12,7 @@ from model import (ROI, BinaryClassificationResult, CountingResult,
                    Label, ModeEnum, MultiClassificationResult,
                    MultiClassModeConfiguration, ResultTypeEnum, Source)
 from PIL import Image
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel, TypeAdapter, ValidationError
 
 from app.core import constants
 
@@ -23,6 +22,8 @@ METADATA_SIZE_LIMIT_BYTES = (
     1024  # This is defined in the SDK and will need to be manually updated here if it gets modified
 )
 
+_ROI_LIST_ADAPTER = TypeAdapter(list[ROI])
+
 
 def create_iq(  # noqa: PLR0913
     detector_id: str,
@@ -36,6 +37,7 @@ def create_iq(  # noqa: PLR0913
     patience_time: float | None = None,
     rois: list[ROI] | None = None,
     text: str | None = None,
+    image_query_id: str | None = None,
 ) -> ImageQuery:
     """
     Creates an ImageQuery object for the appropriate detector with the given result.
@@ -50,6 +52,7 @@ def create_iq(  # noqa: PLR0913
     :param patience_time: The acceptable time to wait for a result.
     :param rois: The ROIs associated with the prediction, if applicable.
     :param text: The text associated with the prediction, if applicable.
+    :param image_query_id: The ID to give the ImageQuery. A new ID is generated if not provided.
 
     :return: The created ImageQuery.
     """
@@ -59,7 +62,7 @@ def create_iq(  # noqa: PLR0913
 
     return ImageQuery(
         metadata={"is_from_edge": True},
-        id=prefixed_ksuid(prefix="iq_"),
+        id=image_query_id or prefixed_ksuid(prefix="iq_"),
         type=ImageQueryTypeEnum.image_query,
         created_at=datetime.now(timezone.utc),
         query=query,
@@ -90,7 +93,7 @@ def _mode_to_result_and_type(
     """
     source = Source.ALGORITHM  # Results from edge model are always from algorithm
     if mode == ModeEnum.BINARY:
-        result_type = ResultTypeEnum.binary_classification
+        result_type = ResultTypeEnum.BINARY_CLASSIFICATION
         label = Label.NO if result_value else Label.YES  # Map false / 0 to "YES" and true / 1 to "NO"
         result = BinaryClassificationResult(
             confidence=confidence,
@@ -107,7 +110,7 @@ def _mode_to_result_and_type(
         if max_count is not None:
             greater_than_max = result_value > max_count
             result_value = max_count if greater_than_max else result_value
-        result_type = ResultTypeEnum.counting
+        result_type = ResultTypeEnum.COUNTING
         result = CountingResult(
             confidence=confidence,
             source=source,
@@ -119,7 +122,7 @@ def _mode_to_result_and_type(
         if mode_configuration is None:
             raise ValueError("mode_configuration for MultiClass detector shouldn't be None.")
         multi_class_mode_configuration = MultiClassModeConfiguration(**mode_configuration)
-        result_type = ResultTypeEnum.multi_classification
+        result_type = ResultTypeEnum.MULTI_CLASSIFICATION
         result = MultiClassificationResult(
             confidence=confidence,
             source=source,
@@ -132,6 +135,141 @@ def _mode_to_result_and_type(
     return result_type, result
 
 
+class EdgeImageQueryTemplate:
+    """
+    Precompiled response template for the ImageQueries returned for a single detector's edge answers.
+
+    Everything that only depends on the detector (its mode, parsed mode configuration, query, etc.) is worked out and
+    JSON-encoded once, when the template is built. Rendering an answer then only encodes the per-request values and
+    joins the pieces together. The output is the same JSON that FastAPI produces when serializing the equivalent
+    `create_iq` ImageQuery through `response_model=ImageQuery`, without building and re-validating the pydantic models
+    on every request.
+    """
+
+    def __init__(self, detector_id: str, mode: ModeEnum, mode_configuration: dict[str, Any] | None, query: str = ""):
+        self.detector_id = detector_id
+        self.query = query
+        self.mode = mode
+        self.max_count: int | None = None
+        self.class_names: list[str] | None = None
+        if mode == ModeEnum.BINARY:
+            result_type = ResultTypeEnum.BINARY_CLASSIFICATION
+        elif mode == ModeEnum.COUNT:
+            if mode_configuration is None:
+                raise ValueError("mode_configuration for Counting detector shouldn't be None.")
+            result_type = ResultTypeEnum.COUNTING
+            self.max_count = CountModeConfiguration(**mode_configuration).max_count
+        elif mode == ModeEnum.MULTI_CLASS:
+            if mode_configuration is None:
+                raise ValueError("mode_configuration for MultiClass detector shouldn't be None.")
+            result_type = ResultTypeEnum.MULTI_CLASSIFICATION
+            self.class_names = MultiClassModeConfiguration(**mode_configuration).class_names
+        else:
+            raise ValueError(f"Got unrecognized or unsupported detector mode: {mode}")
+
+        # Pre-encoded pieces of the response, in ImageQuery field order
+        self._after_id = f',"detector_id":{_encode_json(detector_id)},"created_at":"'.encode()
+        self._after_created_at = (
+            f'","query":{_encode_json(query)},"type":{_encode_json(ImageQueryTypeEnum.image_query.value)},'
+            f'"result_type":{_encode_json(result_type.value)},"result":{{"confidence":'
+        ).encode()
+        # Results from edge model are always from algorithm
+        result_tail = f',"source":{_encode_json(Source.ALGORITHM.value)},"from_edge":true}},"patience_time":'.encode()
+        if mode == ModeEnum.BINARY:
+            # Map false / 0 to "YES" and true / 1 to "NO"
+            self._binary_labels = {
+                label_value: f',"label":{_encode_json(label.value)}'.encode() + result_tail
+                for label_value, label in ((False, Label.YES), (True, Label.NO))
+            }
+        elif mode == ModeEnum.MULTI_CLASS:
+            self._class_labels = [
+                f',"label":{_encode_json(class_name)}'.encode() + result_tail for class_name in self.class_names
+            ]
+        self._count_tail = result_tail
+
+    def render_json(  # noqa: PLR0913
+        self,
+        image_query_id: str,
+        result_value: int,
+        confidence: float,
+        confidence_threshold: float,
+        is_done_processing: bool,
+        patience_time: float | None = None,
+        rois: list[ROI] | None = None,
+        text: str | None = None,
+        extra_metadata: dict[str, Any] | None = None,
+    ) -> bytes:
+        """
+        Returns the encoded JSON for an edge answer, formatted the same way as FastAPI's JSONResponse.
+        """
+        if patience_time is None:
+            patience_time = constants.DEFAULT_PATIENCE_TIME
+        if extra_metadata:
+            metadata = _encode_json({"is_from_edge": True, **extra_metadata}).encode()
+        else:
+            metadata = b'{"is_from_edge":true}'
+        if rois is not None:
+            # ROIs come straight from the inference server, so they still need to be validated
+            rois = _ROI_LIST_ADAPTER.dump_python(_ROI_LIST_ADAPTER.validate_python(rois), mode="json")
+        created_at = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+        return b"".join(
+            (
+                b'{"id":',
+                _encode_json(image_query_id).encode(),
+                self._after_id,
+                created_at.encode(),
+                self._after_created_at,
+                _encode_float(confidence),
+                self._render_result(result_value),
+                _encode_float(patience_time),
+                b',"confidence_threshold":',
+                _encode_float(confidence_threshold),
+                b',"metadata":',
+                metadata,
+                b',"rois":',
+                _encode_json(rois).encode(),
+                b',"text":',
+                _encode_json(text).encode(),
+                b',"done_processing":',
+                b"true}" if is_done_processing else b"false}",
+            )
+        )
+
+    def _render_result(self, result_value: int) -> bytes:
+        """The result fields after the confidence, up to the start of the patience time value."""
+        if self.mode == ModeEnum.BINARY:
+            return self._binary_labels[bool(result_value)]
+        if self.mode == ModeEnum.MULTI_CLASS:
+            return self._class_labels[result_value]
+
+        greater_than_max = False
+        if self.max_count is not None:
+            greater_than_max = result_value > self.max_count
+            result_value = self.max_count if greater_than_max else result_value
+        return b"".join(
+            (
+                b',"count":',
+                str(int(result_value)).encode(),
+                b',"greater_than_max":',
+                b"true" if greater_than_max else b"false",
+                self._count_tail,
+            )
+        )
+
+
+def _encode_json(value: Any) -> str:
+    """Encodes a value the same way as FastAPI's JSONResponse."""
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":"))
+
+
+def _encode_float(value: float) -> bytes:
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"Out of range float values are not JSON compliant: {value}")
+    return float.__repr__(value).encode()
+
+
 def get_formatted_timestamp_str() -> str:
     """Get the current datetime with the highest time precision available."""
     return datetime.now().strftime("%Y%m%d_%H%M%S_%f")
@@ -247,78 +385,6 @@ def pil_image_to_bytes(img: Image.Image, format: str = "JPEG") -> bytes:
         return buffer.getvalue()
 
 
-class TimestampedCache(cachetools.Cache):
-    """Cache subclass that tracks when items were added to the cache, and supports suspending and restoring values."""
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._timestamps: dict[Any, float] = {}  # Store timestamps for each key
-        self._suspended_values: dict[Any, Any] = {}
-        self._suspended_timestamps: dict[Any, float] = {}
-
-    def __setitem__(self, key, value, timestamp: float | None = None):
-        """Overrides the __setitem__ method to track the timestamp of when an item was added to the cache."""
-        # Track the time when setting an item. If no timestamp is provided, use the current time.
-        if timestamp is None:
-            timestamp = time.monotonic()
-        self._timestamps[key] = timestamp
-        super().__setitem__(key, value)
-
-    def __delitem__(self, key):
-        """Overrides the __delitem__ method to remove the timestamp of when an item was added to the cache."""
-        super().__delitem__(key)
-        self._timestamps.pop(key, None)
-
-    def get_timestamp(self, key: Any) -> float | None:
-        """Get the timestamp of when an item was added to the cache. Returns None if the key is not in the cache."""
-        return self._timestamps.get(key, None)
-
-    def suspend_cached_value(self, key: Any) -> bool:
-        """
-        Suspend a value from the cache such that it can be restored later.
-
-        Returns True if the value was successfully suspended.
-        Raises KeyError if the key is not in the cache.
-        """
-        timestamp = self._timestamps.get(key, None)
-        item = self.pop(key, None)
-        if item is not None and timestamp is not None:
-            self._suspended_values[key] = item
-            self._suspended_timestamps[key] = timestamp
-            return True
-        raise KeyError(f"Key {key} not found in cache")
-
-    def restore_suspended_value(self, key: Any) -> bool:
-        """
-        Restore a suspended value to the cache.
-        If the key is already in the cache, the existing value will be overwritten.
-
-        Returns True if the value was successfully restored.
-        Raises KeyError if the key is not in the suspended values.
-        """
-        item = self._suspended_values.pop(key, None)
-        timestamp = self._suspended_timestamps.pop(key, None)
-        if item is not None and timestamp is not None:
-            if key in self:
-                logger.warning(f"Key {key} already in cache, overwriting with suspended value")
-            self.__setitem__(key, item, timestamp=timestamp)
-            return True
-        raise KeyError(f"Key {key} not found in suspended values")
-
-    def delete_suspended_value(self, key: Any) -> bool:
-        """
-        Delete a suspended value.
-
-        Returns True if the value was successfully deleted.
-        Raises KeyError if the key is not in the suspended values.
-        """
-        item = self._suspended_values.pop(key, None)
-        timestamp = self._suspended_timestamps.pop(key, None)
-        if item is not None and timestamp is not None:
-            return True
-        raise KeyError(f"Key {key} not found in suspended values")
-
-
 # Utilities for parsing the fetch models response
 class ModelInfoBase(BaseModel):
     """Both types of model info responses will contain this information."""
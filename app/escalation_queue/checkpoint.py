@@ -0,0 +1,108 @@
+"""Checkpoints recording how much of an escalation queue file has been consumed.
+
+A checkpoint is a small fixed-size record in the file's tracking file, holding the byte offset (and number of lines) up
+to which the file has been consumed. It is overwritten in place, so that resuming can seek straight to the offset.
+
+Tracking files used to hold a "1" for each consumed line. Those are still understood, and are converted to a checkpoint
+when they are opened, so that a queue written by an older version can still be resumed.
+"""
+
+import os
+import struct
+import time
+from pathlib import Path
+
+CHECKPOINT_MAGIC = b"IOQC"
+CHECKPOINT_VERSION = 1
+# Magic, version, offset in bytes, number of lines
+_CHECKPOINT_RECORD = struct.Struct("<4sBQQ")
+
+
+def _parse_checkpoint(contents: bytes, data_path: Path) -> tuple[int, int, bool]:
+    """Returns the offset and number of lines consumed, and whether the tracking file is in the legacy format."""
+    if not contents:
+        return 0, 0, False
+    if len(contents) == _CHECKPOINT_RECORD.size and contents.startswith(CHECKPOINT_MAGIC):
+        _magic, version, offset, num_lines = _CHECKPOINT_RECORD.unpack(contents)
+        if version != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported escalation queue checkpoint version {version}")
+        return offset, num_lines, False
+
+    # A legacy tracking file, with a character for each consumed line. Finding the offset means reading the lines.
+    num_lines = len(contents)
+    offset = 0
+    with data_path.open("rb") as data:
+        for _ in range(num_lines):
+            line = data.readline()
+            if not line:
+                break
+            offset += len(line)
+    return offset, num_lines, True
+
+
+def read_consumed_offset(tracker_path: Path, data_path: Path) -> int:
+    """Returns the offset up to which the data file has been consumed, without opening the checkpoint for updating."""
+    try:
+        contents = tracker_path.read_bytes()
+    except FileNotFoundError:
+        return 0
+    return _parse_checkpoint(contents, data_path)[0]
+
+
+class QueueCheckpoint:
+    """
+    The checkpoint of one queue file, open for updating.
+
+    Consumed lines are recorded with `advance`, and written to the tracking file once `commit_every_lines` lines or
+    `commit_interval_sec` seconds have accumulated since the last commit. Lines that have been advanced past but not
+    committed yet are read again if reading is interrupted, so together with the reader only advancing past lines once
+    the next ones are requested, every line is consumed at least once.
+    """
+
+    def __init__(self, tracker_path: Path, data_path: Path, commit_every_lines: int, commit_interval_sec: float):
+        self.commit_every_lines = commit_every_lines
+        self.commit_interval_sec = commit_interval_sec
+        self._fd = os.open(tracker_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self.offset, self.num_lines, is_legacy = self._read(data_path)
+            if is_legacy:
+                os.ftruncate(self._fd, 0)
+                self.commit()
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self._committed_num_lines = self.num_lines
+        self._committed_at = time.monotonic()
+
+    def __enter__(self) -> "QueueCheckpoint":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _read(self, data_path: Path) -> tuple[int, int, bool]:
+        """Returns the offset and number of lines consumed, and whether the tracking file is in the legacy format."""
+        contents = os.pread(self._fd, max(os.fstat(self._fd).st_size, _CHECKPOINT_RECORD.size), 0)
+        return _parse_checkpoint(contents, data_path)
+
+    def advance(self, lines: list[bytes]) -> None:
+        """Records that `lines` have been consumed, committing the checkpoint if it's due."""
+        self.offset += sum(len(line) for line in lines)
+        self.num_lines += len(lines)
+        if (
+            self.num_lines - self._committed_num_lines >= self.commit_every_lines
+            or time.monotonic() - self._committed_at >= self.commit_interval_sec
+        ):
+            self.commit()
+
+    def commit(self) -> None:
+        """Writes the checkpoint. The record is small enough to be overwritten in a single write."""
+        record = _CHECKPOINT_RECORD.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, self.offset, self.num_lines)
+        os.pwrite(self._fd, record, 0)
+        self._committed_num_lines = self.num_lines
+        self._committed_at = time.monotonic()
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
@@ -2,5 +2,15 @@ DEFAULT_QUEUE_BASE_DIR = "/opt/intellioptics/queue"  # Default base directory fo
 READING_DIR_SUFFIX = "reading"
 WRITING_DIR_SUFFIX = "writing"
 IMAGE_DIR_SUFFIX = "images"
+EVICTING_DIR_SUFFIX = "evicting"  # Where queue files are moved while escalations are evicted from them
+USAGE_FILE_NAME = "usage"  # File tracking the queue's usage and quota
 TRACKING_FILE_NAME_PREFIX = "tracking-"  # Prefix for naming tracking files
+# Queue file names are a timestamp in %Y%m%d_%H%M%S_%f format followed by a 27-character KSUID
+QUEUE_FILE_NAME_REGEX = r"\d{8}_\d{6}_\d{6}-.{27}\.txt"
+LEASE_NAME_SEPARATOR = "~"  # Separates a queue file's name from the ID of the consumer holding its lease
+# Queue file names in the reading directory are followed by the ID of the consumer holding the file's lease
+READING_FILE_NAME_REGEX = rf"({QUEUE_FILE_NAME_REGEX})(?:{LEASE_NAME_SEPARATOR}(.+))?"
 MAX_QUEUE_FILE_LINES = 200  # Maximum number of lines written to each escalation queue file.
+IMAGE_SEGMENT_SIZE_BYTES = 32 * 1024 * 1024  # Size of each segment file that escalated images are appended to.
+# How long the uploader leaves an escalation to the edge endpoint that is submitting it itself, before uploading it
+DISPATCH_GRACE_SEC = 30.0
@@ -0,0 +1,185 @@
+"""Evicting escalations from the escalation queue when it's over its quota.
+
+Writers check the quota before writing (see `app.escalation_queue.quota`), so the queue only goes over it when the quota
+is lowered, or when writers race each other to its last bytes. The escalation queue uploader then evicts queued
+escalations until the queue is back under `EVICTION_TARGET_FRACTION` of its quota: audits first, oldest first, and then
+escalations, oldest first.
+
+Escalations are evicted from the queue files in the writing directory, which the reader hasn't taken yet. A file is
+taken the same way the reader takes it, by moving it (to the evicting directory), so that the writers move on to new
+files.
+The escalations that are kept are written to a new file with the same name, which is moved back into the writing
+directory, keeping its place in the queue. If the uploader stops partway through, `recover` finishes the job on the
+next start, without losing any of the escalations that were to be kept.
+
+The usage tracked by the quota can drift from the truth, e.g. when an edge-endpoint worker is killed between writing an
+escalation and recording it. `count_queue_usage` counts it from the queue's files, which the uploader does when it
+starts.
+"""
+
+import logging
+import os
+import re
+import time
+from pathlib import Path
+
+from pydantic import ValidationError
+
+from app.escalation_queue.checkpoint import read_consumed_offset
+from app.escalation_queue.constants import (EVICTING_DIR_SUFFIX,
+                                            QUEUE_FILE_NAME_REGEX,
+                                            READING_DIR_SUFFIX,
+                                            READING_FILE_NAME_REGEX,
+                                            TRACKING_FILE_NAME_PREFIX,
+                                            WRITING_DIR_SUFFIX)
+from app.escalation_queue.image_store import (ImageSegmentReader,
+                                              release_escalation_image)
+from app.escalation_queue.models import EscalationInfo
+from app.escalation_queue.queue_reader import FINAL_READ_DELAY_SEC
+from app.escalation_queue.quota import QueueQuota, escalation_size_bytes
+
+logger = logging.getLogger(__name__)
+
+# Eviction starts once the queue is over its quota, and stops once it's back under this fraction of it
+EVICTION_TARGET_FRACTION = 0.9
+_TEMPORARY_FILE_SUFFIX = ".tmp"
+
+
+def _parse_escalation(line: bytes) -> EscalationInfo | None:
+    try:
+        return EscalationInfo.model_validate_json(line)
+    except ValidationError:
+        return None
+
+
+def count_queue_usage(base_dir: str) -> tuple[int, int]:
+    """
+    Counts the bytes and records in the queue from its files. Records in files that are being read are only counted
+    from where the reader has got to.
+    """
+    num_bytes = 0
+    num_records = 0
+    for dir_suffix in (WRITING_DIR_SUFFIX, READING_DIR_SUFFIX, EVICTING_DIR_SUFFIX):
+        queue_dir = Path(base_dir, dir_suffix)
+        if not queue_dir.is_dir():
+            continue
+        is_reading_dir = dir_suffix == READING_DIR_SUFFIX
+        for path in queue_dir.iterdir():
+            match = re.fullmatch(READING_FILE_NAME_REGEX if is_reading_dir else QUEUE_FILE_NAME_REGEX, path.name)
+            if match is None:
+                continue
+            try:
+                offset = 0
+                if is_reading_dir:
+                    # Files being read are named after the consumer holding their lease, but tracking files aren't
+                    tracker_path = path.with_name(f"{TRACKING_FILE_NAME_PREFIX}{match.group(1)}")
+                    offset = read_consumed_offset(tracker_path, path)
+                with path.open("rb") as queue_file:
+                    queue_file.seek(offset)
+                    lines = queue_file.readlines()
+            except FileNotFoundError:
+                continue  # Taken by a reader, or finished, while we were counting
+            for line in lines:
+                escalation_info = _parse_escalation(line)
+                num_bytes += escalation_size_bytes(line, escalation_info) if escalation_info else len(line)
+                num_records += 1
+    return num_bytes, num_records
+
+
+class QueueEvictor:
+    """Evicts escalations from the queue while it's over its quota. Only one evictor may run on a queue at a time."""
+
+    def __init__(self, base_dir: str, quota: QueueQuota, image_reader: ImageSegmentReader) -> None:
+        self.base_dir = base_dir
+        self.quota = quota
+        self.image_reader = image_reader
+        self.base_writing_dir = Path(base_dir, WRITING_DIR_SUFFIX)
+        self.base_evicting_dir = Path(base_dir, EVICTING_DIR_SUFFIX)
+        os.makedirs(self.base_evicting_dir, exist_ok=True)  # Ensure base_evicting_dir exists
+
+    def recover(self) -> None:
+        """Finishes evictions that were interrupted, then recounts the queue's usage."""
+        for path in sorted(self.base_evicting_dir.iterdir()):
+            if path.name.endswith(_TEMPORARY_FILE_SUFFIX):
+                path.unlink()  # Kept escalations that were never moved back, which are still in the taken file
+                continue
+            kept_path = self.base_writing_dir / path.name
+            if not kept_path.exists():
+                # Nothing was evicted from the file yet (or the whole file was being evicted), so put it back. Any
+                # images that were already released are skipped by the uploader, as for already-uploaded escalations.
+                path.rename(kept_path)
+                continue
+            # The kept escalations were moved back, but the evicted ones may not all have been released
+            kept_lines = set(kept_path.read_bytes().splitlines(keepends=True))
+            for line in path.read_bytes().splitlines(keepends=True):
+                escalation_info = _parse_escalation(line)
+                if line not in kept_lines and escalation_info is not None:
+                    release_escalation_image(self.image_reader, escalation_info)
+            path.unlink()
+
+        num_bytes, num_records = count_queue_usage(self.base_dir)
+        self.quota.set_usage(num_bytes, num_records)
+        logger.info(f"The escalation queue holds {num_records} escalations ({num_bytes} bytes).")
+
+    def evict_if_over_quota(self) -> int:
+        """Evicts escalations if the queue is over its quota. Returns the number of escalations evicted."""
+        if self.quota.fill_fraction() <= 1.0:
+            return 0
+        num_evicted = self._evict(audits_only=True)
+        if self.quota.fill_fraction() > EVICTION_TARGET_FRACTION:
+            num_evicted += self._evict(audits_only=False)
+        if num_evicted == 0:
+            # There was nothing in the queue to evict, so the tracked usage must have drifted
+            logger.warning(f"The escalation queue is over its quota with nothing to evict: {self.quota.stats()}")
+            self.quota.set_usage(*count_queue_usage(self.base_dir))
+        return num_evicted
+
+    def _evict(self, audits_only: bool) -> int:
+        num_evicted = 0
+        queue_file_names = sorted(
+            path.name for path in self.base_writing_dir.iterdir() if re.fullmatch(QUEUE_FILE_NAME_REGEX, path.name)
+        )
+        for name in queue_file_names:
+            if self.quota.fill_fraction() <= EVICTION_TARGET_FRACTION:
+                break
+            num_evicted += self._evict_from_file(name, audits_only)
+        if num_evicted:
+            kind = "audits" if audits_only else "escalations"
+            logger.warning(f"Evicted {num_evicted} {kind} from the escalation queue, which is over its quota.")
+        return num_evicted
+
+    def _evict_from_file(self, name: str, audits_only: bool) -> int:
+        queue_path = self.base_writing_dir / name
+        taken_path = self.base_evicting_dir / name
+        try:
+            queue_path.rename(taken_path)
+        except FileNotFoundError:
+            return 0  # Taken by the reader
+        # As when the reader takes a file, give writes that were in progress time to finish
+        time.sleep(FINAL_READ_DELAY_SEC)
+
+        to_keep: list[bytes] = []
+        to_evict: list[tuple[bytes, EscalationInfo | None]] = []
+        for line in taken_path.read_bytes().splitlines(keepends=True):
+            escalation_info = _parse_escalation(line)
+            if audits_only and (escalation_info is None or not escalation_info.is_audit):
+                to_keep.append(line)
+            else:
+                to_evict.append((line, escalation_info))
+
+        if not to_evict:
+            taken_path.rename(queue_path)  # Put it back as it was
+            return 0
+        if to_keep:
+            temporary_path = taken_path.with_name(f"{name}{_TEMPORARY_FILE_SUFFIX}")
+            temporary_path.write_bytes(b"".join(to_keep))
+            temporary_path.rename(queue_path)
+
+        for line, escalation_info in to_evict:
+            if escalation_info is None:
+                self.quota.release(len(line), evicted=True)
+                continue
+            self.quota.release(escalation_size_bytes(line, escalation_info), evicted=True)
+            release_escalation_image(self.image_reader, escalation_info)
+        taken_path.unlink()
+        return len(to_evict)
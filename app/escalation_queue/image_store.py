@@ -0,0 +1,287 @@
+"""Packed storage for the images of escalations in the escalation queue.
+
+Writing each image to its own file fragments the filesystem, uses an inode per image, and means deleting thousands of
+files as a backlog drains. Instead, images are appended to large segment files, preallocated up front, and addressed by
+an `ImageLocation` (the segment, the image's index in it, and its offset and length).
+
+    - Each writer (one per edge-endpoint worker process) appends to its own segment, which it holds an exclusive
+      `flock` on. Once the segment is full, or the writer is closed, the segment is sealed, and the writer moves on to
+      a new one. A segment whose writer died without sealing it can be told apart by its lock no longer being held.
+    - The uploader maps segments into memory, and uploads images straight from the mapping without copying them.
+    - Uploaded images are acknowledged in an ack map next to the segment, with a byte per image. Once a segment is
+      sealed and all of its images have been acknowledged, the segment and its ack map are deleted.
+
+A segment starts with a header (see `_SEGMENT_HEADER`), followed by the images, back to back.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+from pathlib import Path
+
+import ksuid
+
+from app.core.utils import get_formatted_timestamp_str
+from app.escalation_queue.models import EscalationInfo, ImageLocation
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_MAGIC = b"IOIS"
+SEGMENT_VERSION = 1
+_SEGMENT_HEADER = struct.Struct("<4sBBxxI")  # magic, version, sealed, number of images
+SEGMENT_DATA_OFFSET = 64  # Images start after the header, leaving room for it to grow
+SEGMENT_FILE_SUFFIX = ".seg"
+ACK_MAP_FILE_SUFFIX = ".acks"
+_ACKED = b"\x01"
+# Segments are written under a temporary name until they are locked and preallocated, so they are never mistaken for
+# segments whose writer died
+_NEW_SEGMENT_FILE_SUFFIX = ".new"
+# Number of segments the uploader keeps mapped at once
+MAX_MAPPED_SEGMENTS = 16
+
+
+def _preallocate(fd: int, size: int) -> None:
+    """Allocates the blocks of the file up front, so that appending doesn't fragment it."""
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not every platform or filesystem supports it (overlayfs on some kernels doesn't), so settle for a sparse file
+        os.ftruncate(fd, size)
+
+
+def release_escalation_image(image_reader: "ImageSegmentReader", escalation_info: EscalationInfo) -> None:
+    """Releases the image of an escalation that has left the queue: acknowledges it in its segment, or deletes it."""
+    if escalation_info.image_location is not None:
+        image_reader.ack(escalation_info.image_location)
+    else:
+        Path(escalation_info.image_path_str).unlink(missing_ok=True)
+
+
+class ImageSegmentWriter:
+    """Appends images to segment files in a directory. Not thread-safe, so callers must serialize calls."""
+
+    def __init__(self, image_dir: Path, segment_size: int) -> None:
+        self.image_dir = image_dir
+        self.segment_size = segment_size
+        self.segment_path: Path | None = None
+        self._fd: int | None = None
+        self._num_images = 0
+        self._next_offset = SEGMENT_DATA_OFFSET
+
+    def append(self, image_bytes: bytes) -> ImageLocation:
+        """Appends the image to the current segment, starting a new one if it doesn't fit."""
+        if self._fd is not None and self._next_offset + len(image_bytes) > self.segment_size and self._num_images > 0:
+            self.seal()
+        if self._fd is None:
+            self._open_new_segment(min_size=SEGMENT_DATA_OFFSET + len(image_bytes))
+
+        offset = self._next_offset
+        view = memoryview(image_bytes)
+        while view:
+            num_written = os.pwrite(self._fd, view, offset + len(image_bytes) - len(view))
+            view = view[num_written:]
+        location = ImageLocation(
+            segment=self.segment_path.name, index=self._num_images, offset=offset, length=len(image_bytes)
+        )
+        self._num_images += 1
+        self._next_offset += len(image_bytes)
+        # The image count lets the segment be reclaimed even if the writer dies before sealing it
+        self._write_header(sealed=False)
+        return location
+
+    def sync(self) -> None:
+        """Syncs the images written so far to disk."""
+        if self._fd is not None:
+            os.fdatasync(self._fd)
+
+    def seal(self) -> None:
+        """Marks the current segment as complete, so that it can be reclaimed once its images have been uploaded."""
+        if self._fd is None:
+            return
+        try:
+            self._write_header(sealed=True)
+        finally:
+            os.close(self._fd)  # Also releases the lock
+            self._fd = None
+            self.segment_path = None
+
+    def _write_header(self, sealed: bool) -> None:
+        os.pwrite(self._fd, _SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, sealed, self._num_images), 0)
+
+    def _open_new_segment(self, min_size: int) -> None:
+        name = f"segment-{get_formatted_timestamp_str()}-{ksuid.KsuidMs()}"
+        new_path = self.image_dir / f"{name}{_NEW_SEGMENT_FILE_SUFFIX}"
+        fd = os.open(new_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            _preallocate(fd, max(self.segment_size, min_size))
+            self._fd = fd
+            self._num_images = 0
+            self._next_offset = SEGMENT_DATA_OFFSET
+            self._write_header(sealed=False)
+            self.segment_path = self.image_dir / f"{name}{SEGMENT_FILE_SUFFIX}"
+            new_path.rename(self.segment_path)
+        except BaseException:
+            self._fd = None
+            os.close(fd)
+            new_path.unlink(missing_ok=True)
+            raise
+
+
+class SegmentImage:
+    """
+    A read-only, file-like view of one image in a mapped segment, which can be uploaded without copying it. Must be
+    closed (or used as a context manager) so that the segment can be unmapped.
+    """
+
+    def __init__(self, view: memoryview) -> None:
+        self._view = view
+        self._position = 0
+
+    def read(self, size: int = -1) -> memoryview:
+        end = len(self._view) if size is None or size < 0 else min(self._position + size, len(self._view))
+        chunk = self._view[self._position : end]
+        self._position = end
+        return chunk
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._position, os.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        self._view.release()
+
+    def __enter__(self) -> "SegmentImage":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class ImageSegmentReader:
+    """Reads and acknowledges images in segment files, and reclaims the segments once they have been drained."""
+
+    def __init__(self, image_dir: Path) -> None:
+        self.image_dir = image_dir
+        self.segment_file_regex = rf"segment-\d{{8}}_\d{{6}}_\d{{6}}-.{{27}}{re.escape(SEGMENT_FILE_SUFFIX)}"
+        self.ack_map_file_regex = rf"{self.segment_file_regex}{re.escape(ACK_MAP_FILE_SUFFIX)}"
+        self._mappings: dict[str, mmap.mmap] = {}  # Ordered from least to most recently used
+        # Uploads run in several threads
+        self._lock = threading.Lock()
+
+    def segment_path(self, location: ImageLocation) -> Path:
+        return self.image_dir / location.segment
+
+    def open_image(self, location: ImageLocation) -> SegmentImage:
+        """Returns the image at the location. Raises `FileNotFoundError` if its segment has been reclaimed."""
+        with self._lock:
+            mapping = self._get_mapping(location.segment)
+            return SegmentImage(memoryview(mapping)[location.offset : location.offset + location.length])
+
+    def is_acked(self, location: ImageLocation) -> bool:
+        """Whether the image has been acknowledged, including because its segment has been reclaimed."""
+        try:
+            with open(self._ack_map_path(location.segment), "rb") as ack_map:
+                ack_map.seek(location.index)
+                return ack_map.read(1) == _ACKED
+        except FileNotFoundError:
+            return not self.segment_path(location).exists()
+
+    def ack(self, location: ImageLocation) -> None:
+        """Acknowledges that the image has been uploaded, reclaiming its segment if it was the last one left."""
+        with self._lock:
+            if not self.segment_path(location).exists():
+                return  # Already reclaimed
+            fd = os.open(self._ack_map_path(location.segment), os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, _ACKED, location.index)
+            finally:
+                os.close(fd)
+            if not self._reclaim_if_drained(location.segment) and not self.segment_path(location).exists():
+                # Another process reclaimed the segment after the check above, so the ack map was created anew
+                self._ack_map_path(location.segment).unlink(missing_ok=True)
+
+    def reclaim_drained_segments(self) -> int:
+        """
+        Reclaims all of the segments that have been drained, including empty segments whose writer died, and deletes ack
+        maps whose segment has already been reclaimed. Returns the number of segments reclaimed.
+        """
+        num_reclaimed = 0
+        for path in self.image_dir.iterdir():
+            if re.fullmatch(self.segment_file_regex, path.name):
+                with self._lock:
+                    num_reclaimed += self._reclaim_if_drained(path.name)
+            elif re.fullmatch(self.ack_map_file_regex, path.name):
+                segment_path = path.with_name(path.name.removesuffix(ACK_MAP_FILE_SUFFIX))
+                if not segment_path.exists():
+                    # Left behind by a process that died acknowledging an image while its segment was reclaimed
+                    path.unlink(missing_ok=True)
+        return num_reclaimed
+
+    def close(self) -> None:
+        with self._lock:
+            for segment in list(self._mappings):
+                self._unmap(segment)
+
+    def _ack_map_path(self, segment: str) -> Path:
+        return self.image_dir / f"{segment}{ACK_MAP_FILE_SUFFIX}"
+
+    def _get_mapping(self, segment: str) -> mmap.mmap:
+        mapping = self._mappings.pop(segment, None)
+        if mapping is None:
+            with open(self.image_dir / segment, "rb") as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(self._mappings) >= MAX_MAPPED_SEGMENTS:
+                self._unmap(next(iter(self._mappings)))
+        self._mappings[segment] = mapping
+        return mapping
+
+    def _unmap(self, segment: str) -> None:
+        mapping = self._mappings.pop(segment, None)
+        if mapping is None:
+            return
+        try:
+            mapping.close()
+        except BufferError:
+            pass  # An image is still being read from it. The mapping is closed once the image has been closed.
+
+    def _reclaim_if_drained(self, segment: str) -> bool:
+        """Deletes the segment and its ack map if the segment is sealed and all of its images have been acknowledged."""
+        segment_path = self.image_dir / segment
+        try:
+            fd = os.open(segment_path, os.O_RDWR)
+        except FileNotFoundError:
+            return False  # Already reclaimed
+        try:
+            magic, _version, sealed, num_images = _SEGMENT_HEADER.unpack(os.pread(fd, _SEGMENT_HEADER.size, 0))
+            if magic != SEGMENT_MAGIC:
+                logger.warning(f"Ignoring image segment {segment} with an invalid header.")
+                return False
+            if not sealed:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return False  # Its writer is still appending to it
+                logger.info(f"Image segment {segment} wasn't sealed by its writer, which has stopped.")
+            try:
+                acks = self._ack_map_path(segment).read_bytes()[:num_images]
+            except FileNotFoundError:
+                acks = b""
+            if acks.count(_ACKED) < num_images:
+                return False
+
+            segment_path.unlink(missing_ok=True)
+            self._ack_map_path(segment).unlink(missing_ok=True)
+            self._unmap(segment)
+            logger.debug(f"Reclaimed drained image segment {segment} of {num_images} images.")
+            return True
+        finally:
+            os.close(fd)
@@ -0,0 +1,99 @@
+"""A minimal ctypes wrapper around Linux's inotify API, for waking up when files are added to a directory.
+
+The standard library doesn't expose inotify, and the queue only needs a few of its features, so this avoids a
+dependency. `Inotify` raises `OSError` on platforms without inotify (or when the watch limit is reached), and callers
+are expected to fall back to polling.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+
+# Event masks, from <sys/inotify.h>
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000  # Events were dropped because the kernel's event queue was full
+IN_IGNORED = 0x00008000  # The watch was removed, e.g. because the directory was deleted
+IN_ONLYDIR = 0x01000000
+
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+_EVENT_HEADER = struct.Struct("iIII")
+_READ_BUFFER_SIZE = 64 * 1024
+
+
+@dataclass(frozen=True)
+class InotifyEvent:
+    wd: int
+    mask: int
+    name: str
+
+
+def _load_libc() -> ctypes.CDLL:
+    libc_name = ctypes.util.find_library("c")
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+    except OSError as e:
+        raise OSError(errno.ENOSYS, f"inotify isn't available: {e}") from e
+    if not hasattr(libc, "inotify_init1"):  # Not every platform or libc has inotify
+        raise OSError(errno.ENOSYS, "inotify isn't available")
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_init1.restype = ctypes.c_int
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_add_watch.restype = ctypes.c_int
+    return libc
+
+
+class Inotify:
+    """An inotify instance, watching any number of directories."""
+
+    def __init__(self) -> None:
+        self._libc = _load_libc()
+        fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 failed: {os.strerror(err)}")
+        self.fd = fd
+        self._poller = select.poll()
+        self._poller.register(self.fd, select.POLLIN)
+
+    def add_watch(self, path: Path, mask: int) -> int:
+        """Watches the directory at `path` for the events in `mask`. Returns the watch descriptor."""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask | IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_add_watch failed for {path}: {os.strerror(err)}")
+        return wd
+
+    def read_events(self, timeout_sec: float | None) -> list[InotifyEvent]:
+        """Waits up to `timeout_sec` (forever if None) for events, and returns them. Returns [] on timeout."""
+        timeout_ms = None if timeout_sec is None else max(0, int(timeout_sec * 1000))
+        if not self._poller.poll(timeout_ms):
+            return []
+        try:
+            data = os.read(self.fd, _READ_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _cookie, name_len = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset : offset + name_len].rstrip(b"\0")
+            offset += name_len
+            events.append(InotifyEvent(wd=wd, mask=mask, name=os.fsdecode(name)))
+        return events
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            self._poller.unregister(self.fd)
+            os.close(self.fd)
+            self.fd = -1
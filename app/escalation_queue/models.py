@@ -13,11 +13,26 @@ class SubmitImageQueryParams(BaseModel):
     image_query_id: str | None = None
 
 
+class ImageLocation(BaseModel):
+    """Where an image is stored in an image segment file (see `app.escalation_queue.image_store`)."""
+
+    segment: str  # Name of the segment file in the images directory
+    index: int  # Index of the image within the segment
+    offset: int
+    length: int
+
+
 class EscalationInfo(BaseModel):
     """The information about an escalation that needs to be written to the escalation queue."""
 
     timestamp: str
     detector_id: str
-    image_path_str: str
+    image_path_str: str  # For images in a segment, the path of the segment
     request_id: str
     submit_iq_params: SubmitImageQueryParams
+    image_location: ImageLocation | None = None  # None if the image is in a file of its own
+    is_audit: bool = False  # Audits are evicted first when the queue is over its quota
+    # Unix time at which the edge endpoint started submitting the escalation itself, if it did. It acknowledges the
+    # image once it has, and the uploader only uploads the escalation if that hasn't happened within
+    # `DISPATCH_GRACE_SEC`.
+    dispatched_at: float | None = None
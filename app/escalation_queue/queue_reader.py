@@ -1,32 +1,124 @@
+import heapq
 import logging
 import os
 import re
+import threading
 import time
-from itertools import islice
 from pathlib import Path
-from typing import Generator
+from typing import BinaryIO, Generator
 
+import ksuid
+
+from app.escalation_queue.checkpoint import QueueCheckpoint
 from app.escalation_queue.constants import (DEFAULT_QUEUE_BASE_DIR,
+                                            LEASE_NAME_SEPARATOR,
+                                            MAX_QUEUE_FILE_LINES,
+                                            QUEUE_FILE_NAME_REGEX,
                                             READING_DIR_SUFFIX,
+                                            READING_FILE_NAME_REGEX,
                                             TRACKING_FILE_NAME_PREFIX,
                                             WRITING_DIR_SUFFIX)
+from app.escalation_queue.inotify import (IN_CREATE, IN_IGNORED, IN_MOVED_TO,
+                                          IN_Q_OVERFLOW, Inotify, InotifyEvent)
 
 logger = logging.getLogger(__name__)
 
+POLL_INTERVAL_SEC = 0.1
+# How long to keep waiting for events before checking for abandoned files, and that the reader hasn't been stopped
+EVENT_WAIT_TIMEOUT_SEC = 1.0
+# How long after taking a file from the writing directory to read it one last time, in case a write was in progress
+FINAL_READ_DELAY_SEC = 0.1
+# How often the checkpoint of the file being read is written, in lines and in seconds, whichever comes first
+DEFAULT_CHECKPOINT_EVERY_LINES = 50
+DEFAULT_CHECKPOINT_INTERVAL_SEC = 1.0
+# How long a lease on a file lasts without being renewed, after which other consumers may take the file over
+DEFAULT_LEASE_TTL_SEC = 30.0
+# How many times a lease is renewed within its TTL, so that a late renewal doesn't let it expire
+LEASE_RENEWALS_PER_TTL = 4
+
 
 class QueueReader:
-    """Manages reading escalation data from a file-based queue system."""
+    """
+    Manages reading escalation data from a file-based queue system.
+
+    Files waiting in the writing directory are kept in a heap ordered by name (and so by age), so that the oldest can be
+    taken without listing the directory. The directory is listed once, and after that the heap is kept up to date from
+    inotify events, which also wake the reader up as soon as a file is written. Where inotify isn't available, or with
+    `event_driven=False`, the reader instead polls, listing the directory only when the heap is empty.
 
-    def __init__(self, base_dir: str = DEFAULT_QUEUE_BASE_DIR):
+    Progress through the file being read is recorded in a checkpoint, every `checkpoint_every_lines` lines or
+    `checkpoint_interval_sec` seconds. Every line is returned at least once: after an interruption, reading resumes
+    from the last checkpoint, so up to that many lines, plus the last batch returned, can be returned again.
+
+    Several readers (in threads or processes) can consume the same queue concurrently, each reading one file at a time,
+    in order. A reader takes a file by renaming it into the reading directory with its `consumer_id` appended to the
+    name, which is atomic, so only one reader gets it. That is the reader's lease on the file, which it renews by
+    updating the file's modification time while reading it. If a reader stops partway through a file, its lease
+    expires after `lease_ttl_sec`, and another reader takes the file over the same way, renaming it to its own ID, and
+    resumes from the file's checkpoint. A reader whose lease was taken over notices when it next renews it, and moves
+    on. Consumer IDs must be unique among the running readers. Giving a reader the same ID when it's restarted lets it
+    take back its files right away, rather than once their leases expire.
+    """
+
+    def __init__(
+        self,
+        base_dir: str = DEFAULT_QUEUE_BASE_DIR,
+        event_driven: bool = True,
+        checkpoint_every_lines: int = DEFAULT_CHECKPOINT_EVERY_LINES,
+        checkpoint_interval_sec: float = DEFAULT_CHECKPOINT_INTERVAL_SEC,
+        consumer_id: str | None = None,
+        lease_ttl_sec: float = DEFAULT_LEASE_TTL_SEC,
+    ):
         self.base_reading_dir = Path(base_dir, READING_DIR_SUFFIX)
         os.makedirs(self.base_reading_dir, exist_ok=True)  # Ensure base_reading_dir exists
         self.base_writing_dir = Path(base_dir, WRITING_DIR_SUFFIX)
         os.makedirs(self.base_writing_dir, exist_ok=True)  # Ensure base_writing_dir exists
 
-        # This matches a timestamp in %Y%m%d_%H%M%S_%f format followed by a 27-character KSUID
-        self.writing_file_regex = r"\d{8}_\d{6}_\d{6}-.{27}\.txt"
-        # This matches the same as the above, with the addition of the tracking file name prefix
-        self.tracking_file_regex = rf"{re.escape(TRACKING_FILE_NAME_PREFIX)}{self.writing_file_regex}"
+        self.writing_file_regex = QUEUE_FILE_NAME_REGEX
+
+        self._backlog: list[str] = []  # Heap of the names of the files waiting in the writing directory
+        self._backlog_names: set[str] = set()
+        self._inotify: Inotify | None = None
+        if event_driven:
+            self._inotify = self._watch_writing_dir()
+        self._needs_listing = True  # Whether the heap may be missing files, so the directory has to be listed
+
+        self.checkpoint_every_lines = checkpoint_every_lines
+        self.checkpoint_interval_sec = checkpoint_interval_sec
+
+        self.consumer_id = consumer_id or f"{os.getpid()}-{ksuid.KsuidMs()}"
+        if os.sep in self.consumer_id or LEASE_NAME_SEPARATOR in self.consumer_id:
+            raise ValueError(f"Invalid escalation queue consumer ID {self.consumer_id!r}")
+        self.lease_ttl_sec = lease_ttl_sec
+        self._leased_path: Path | None = None  # The file being read, whose lease is renewed
+        self._lease_lost = False
+        self._lease_lock = threading.Lock()
+        self._lease_renewer: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    def stop(self) -> None:
+        """
+        Stops the reader. Iteration ends once the reader is waiting for a new file to read, within
+        `EVENT_WAIT_TIMEOUT_SEC`. May be called from any thread.
+        """
+        self._stopped.set()
+
+    def close(self) -> None:
+        """Stops the reader and releases its resources. Must only be called once iteration has ended."""
+        self.stop()
+        if self._lease_renewer is not None:
+            self._lease_renewer.join()
+            self._lease_renewer = None
+        self._close_inotify()
+
+    def _close_inotify(self) -> None:
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    @property
+    def event_driven(self) -> bool:
+        return self._inotify is not None
 
     def __iter__(self) -> Generator[str, None, None]:
         """
@@ -35,51 +127,166 @@ class QueueReader:
         Blocks until there is a file to read from. Then, each iteration will return the next line from that file until
         all lines have been read, at which point the file being read from will be deleted.
 
-        Tracks the number of lines that have been read from the current file to support recovering from a failure or
-        reboot.
-        """
-        for data_path, tracker_path in self._get_files():
-            with data_path.open(mode="r") as escalations, tracker_path.open(mode="a") as tracker:
-                lines_to_skip = len(tracker_path.read_text()) if tracker_path.exists() else 0
-                for line in islice(escalations, lines_to_skip, None):
-                    yield line
-                    # NOTE that we write to the tracking file after we yield a line, meaning the below code won't be
-                    # executed until the next time the generator is called. This means that at any time, the tracking
-                    # file will have one less entry than has been read/returned from the reader. This is by design
-                    # because something might go wrong after the reader returns a line, causing it to not get escalated.
-                    # We don't want to lose that escalation, so we implement it this way. We allow the possibility of
-                    # reading the same line twice (and handle that case in the consumption code) while guaranteeing that
-                    # we don't miss any.
-                    tracker.write("1")  # Indicates the line that we just yielded has been consumed
-                    tracker.flush()  # Write the tracking changes immediately
-
-                # Wait briefly and attempt one final read in case a line was written during processing
-                time.sleep(0.1)
-                final_line = escalations.readline()
-                if final_line.strip():
-                    yield final_line
-                    tracker.write("1")
-                    tracker.flush()
-
-            # Delete files when done reading
+        Checkpoints how much of the current file has been read to support recovering from a failure or reboot.
+        """
+        for batch in self.iter_batches(max_batch_size=1):
+            yield batch[0]
+
+    def iter_batches(self, max_batch_size: int) -> Generator[list[str], None, None]:
+        """
+        Like iterating over the reader, but returns up to `max_batch_size` lines at a time so that they can be processed
+        concurrently. In the same way as single lines, a batch is only tracked as consumed once the next batch is
+        requested, so every line of a batch should be processed before requesting the next one.
+        """
+        for data_path, tracker_path, taken_at in self._get_files():
+            try:
+                yield from self._read_file(data_path, tracker_path, taken_at, max_batch_size)
+            finally:
+                self._release_lease()
+
+    def _read_file(
+        self, data_path: Path, tracker_path: Path, taken_at: float, max_batch_size: int
+    ) -> Generator[list[str], None, None]:
+        """Reads the leased file in batches, deleting it once it has all been read, unless the lease was lost."""
+        with data_path.open(mode="rb") as escalations, QueueCheckpoint(
+            tracker_path,
+            data_path,
+            commit_every_lines=self.checkpoint_every_lines,
+            commit_interval_sec=self.checkpoint_interval_sec,
+        ) as checkpoint:
+            escalations.seek(checkpoint.offset)  # Skip the lines that have already been consumed
+            while (batch := self._read_complete_lines(escalations, max_batch_size)) and not self._lease_lost:
+                yield [line.decode() for line in batch]
+                # NOTE that we advance the checkpoint after we yield a batch, meaning the below code won't be
+                # executed until the next time the generator is called. This means that at any time, the checkpoint
+                # won't include the lines that were last returned from the reader. This is by design because
+                # something might go wrong after the reader returns a line, causing it to not get escalated. We
+                # don't want to lose that escalation, so we implement it this way. We allow the possibility of
+                # reading the same line twice (and handle that case in the consumption code) while guaranteeing that
+                # we don't miss any. Checkpoints are only committed every so often, so after an interruption, the
+                # lines consumed since the last commit are read again too.
+                checkpoint.advance(batch)
+
+            if self._lease_lost:
+                logger.warning(f"Lost the lease on {data_path.name}, so leaving it to the consumer that took it over.")
+                return
+            # Attempt one final read in case lines were written while the file was being taken. Writers don't
+            # write to full files, and notice that a file was taken before their next write, so we only need to
+            # wait briefly after taking a file that isn't full.
+            remaining_delay_sec = FINAL_READ_DELAY_SEC - (time.monotonic() - taken_at)
+            if checkpoint.num_lines < MAX_QUEUE_FILE_LINES and remaining_delay_sec > 0:
+                time.sleep(remaining_delay_sec)
+            final_lines = escalations.readlines()
+            for i in range(0, len(final_lines), max_batch_size):
+                batch = final_lines[i : i + max_batch_size]
+                if lines_to_return := [line.decode() for line in batch if line.strip()]:
+                    yield lines_to_return
+                checkpoint.advance(batch)
+
+        # Delete files when done reading. The file is only gone already if another consumer took it over.
+        try:
             data_path.unlink()
-            tracker_path.unlink()
+        except FileNotFoundError:
+            logger.warning(f"Lost the lease on {data_path.name}, so leaving it to the consumer that took it over.")
+            return
+        tracker_path.unlink(missing_ok=True)
 
-    def _get_files(self) -> Generator[tuple[Path, Path], None, None]:
+    def _read_complete_lines(self, escalations: BinaryIO, max_lines: int) -> list[bytes]:
+        """
+        Reads up to `max_lines` lines. Stops at a line without a newline, which may still be being written, and leaves
+        it to be read again.
         """
-        A generator that yields files containing items in the escalation queue.
+        lines = []
+        while len(lines) < max_lines:
+            line = escalations.readline()
+            if not line.endswith(b"\n"):
+                escalations.seek(-len(line), os.SEEK_CUR)
+                break
+            lines.append(line)
+        return lines
 
-        Blocks until there is a file to return. Then, returns a tuple:
+    def _get_files(self) -> Generator[tuple[Path, Path, float], None, None]:
+        """
+        A generator that yields files containing items in the escalation queue, leased to this reader.
+
+        Blocks until there is a file to return, or the reader is stopped. Then, returns a tuple:
         - The first item is a Path to the chosen next file to read from
         - The second item is a Path to the associated tracking file
+        - The third item is the `time.monotonic()` time at which the file was taken from the writing directory
         """
-        while True:
-            new_reading_path = self._choose_new_file()
-            if new_reading_path is not None:
-                new_tracking_path = new_reading_path.with_name(f"{TRACKING_FILE_NAME_PREFIX}{new_reading_path.name}")
-                yield new_reading_path, new_tracking_path
+        while not self._stopped.is_set():
+            # Files abandoned partway through are older than the ones in the writing directory, so they come first.
+            # They were taken from the writing directory long ago, so there's no need to wait before their final read.
+            if (reading_path := self._take_abandoned_file()) is not None:
+                yield reading_path, self._tracking_path(reading_path), float("-inf")
+            elif (reading_path := self._choose_new_file()) is not None:
+                yield reading_path, self._tracking_path(reading_path), time.monotonic()
             else:
-                self._wait_for_file_check(0.1)
+                self._wait_for_new_files()
+
+    def _tracking_path(self, reading_path: Path) -> Path:
+        name = reading_path.name.partition(LEASE_NAME_SEPARATOR)[0]
+        return reading_path.with_name(f"{TRACKING_FILE_NAME_PREFIX}{name}")
+
+    def _take(self, path: Path, name: str) -> Path | None:
+        """
+        Takes the queue file at `path` by renaming it to a lease for this reader. Returns the leased path, or None if
+        another reader took the file first.
+        """
+        leased_path = self.base_reading_dir / f"{name}{LEASE_NAME_SEPARATOR}{self.consumer_id}"
+        try:
+            # Renaming keeps the modification time, so renew the lease first, so that it never looks expired
+            os.utime(path)
+            path.rename(leased_path)
+        except FileNotFoundError:
+            return None
+        with self._lease_lock:
+            self._leased_path = leased_path
+            self._lease_lost = False
+        if self._lease_renewer is None:
+            self._lease_renewer = threading.Thread(target=self._renew_leases, name="queue-lease-renewer", daemon=True)
+            self._lease_renewer.start()
+        return leased_path
+
+    def _release_lease(self) -> None:
+        with self._lease_lock:
+            self._leased_path = None
+
+    def _renew_leases(self) -> None:
+        """Renews the lease on the file being read, until the reader is stopped."""
+        while not self._stopped.wait(self.lease_ttl_sec / LEASE_RENEWALS_PER_TTL):
+            with self._lease_lock:
+                if self._leased_path is None or self._lease_lost:
+                    continue
+                try:
+                    os.utime(self._leased_path)
+                except FileNotFoundError:
+                    self._lease_lost = True  # Another reader took the file over, after the lease expired
+
+    def _take_abandoned_file(self) -> None | Path:
+        """
+        Takes the oldest file in the reading directory that was abandoned partway through: one whose lease has
+        expired, or was held by this reader's consumer ID before a restart, or that was taken by an older version of
+        the reader, without a lease. Returns its leased path, or None if there are no abandoned files.
+        """
+        expired_before = time.time() - self.lease_ttl_sec
+        abandoned = []
+        for path in self.base_reading_dir.iterdir():
+            match = re.fullmatch(READING_FILE_NAME_REGEX, path.name)
+            if match is None:
+                continue
+            name, consumer_id = match.groups()
+            try:
+                if consumer_id in (None, self.consumer_id) or path.stat().st_mtime < expired_before:
+                    abandoned.append((name, path))
+            except FileNotFoundError:
+                continue  # Finished, or taken over by another reader
+
+        for name, path in sorted(abandoned):
+            if (leased_path := self._take(path, name)) is not None:
+                logger.info(f"Took over escalation queue file {path.name}, which was abandoned partway through.")
+                return leased_path
+        return None
 
     def _choose_new_file(self) -> None | Path:
         """
@@ -89,30 +296,66 @@ class QueueReader:
         files available. If there are multiple files present, the next chosen file will be the
         oldest one as determined by filename.
         """
-        # First we look for tracking files, which will exist if the reader was interrupted while in the middle of
-        # processing a file. We finish processing the in-progress files before selecting newly written files.
-        tracking_files = [
-            path for path in self.base_reading_dir.iterdir() if re.fullmatch(self.tracking_file_regex, path.name)
-        ]
-        if len(tracking_files) > 0:
-            tracking_path = tracking_files[0]
-            new_reading_path = Path(tracking_path.parent, tracking_path.name.replace(TRACKING_FILE_NAME_PREFIX, ""))
-            return new_reading_path
-
-        # If there were no tracking files, we look for fresh files to process and select the oldest one.
-        queue_files = [
-            path for path in self.base_writing_dir.iterdir() if re.fullmatch(self.writing_file_regex, path.name)
-        ]
-        if len(queue_files) == 0:
-            return None
+        if self._needs_listing:
+            self._list_writing_dir()
+        elif self._inotify is not None:
+            self._handle_events(self._inotify.read_events(timeout_sec=0))
+
+        while self._backlog:
+            oldest_name = heapq.heappop(self._backlog)
+            self._backlog_names.discard(oldest_name)
+            # Move the file from writing directory to reading directory
+            new_reading_path = self._take(self.base_writing_dir / oldest_name, oldest_name)
+            if new_reading_path is not None:
+                return new_reading_path
+            # The file was taken by another reader, or evicted, after we learned about it
+
+        if self._inotify is None:
+            self._needs_listing = True  # Without events, listing the directory is the only way to find new files
+        return None
+
+    def _list_writing_dir(self) -> None:
+        for path in self.base_writing_dir.iterdir():
+            self._add_to_backlog(path.name)
+        self._needs_listing = False
 
-        oldest_writing_path = sorted(queue_files)[0]
-        new_reading_path = self.base_reading_dir / oldest_writing_path.name
+    def _add_to_backlog(self, name: str) -> None:
+        if name not in self._backlog_names and re.fullmatch(self.writing_file_regex, name):
+            heapq.heappush(self._backlog, name)
+            self._backlog_names.add(name)
+
+    def _watch_writing_dir(self) -> Inotify | None:
+        """Starts watching the writing directory for new files, or returns None if inotify isn't available."""
+        inotify = None
+        try:
+            inotify = Inotify()
+            inotify.add_watch(self.base_writing_dir, IN_CREATE | IN_MOVED_TO)
+            return inotify
+        except OSError as e:
+            logger.info(f"Falling back to polling the escalation queue, as it can't be watched with inotify: {e}")
+            if inotify is not None:
+                inotify.close()
+            return None
 
-        # Move the file from writing directory to reading directory
-        oldest_writing_path.rename(new_reading_path)
+    def _handle_events(self, events: list[InotifyEvent]) -> None:
+        for event in events:
+            if event.mask & (IN_Q_OVERFLOW | IN_IGNORED):
+                # Events were lost, or the directory is no longer watched, so the heap may be missing files
+                logger.warning(f"Lost track of the escalation queue directory (inotify event mask {event.mask:#x}).")
+                self._needs_listing = True
+                if event.mask & IN_IGNORED:
+                    self._close_inotify()
+                    self._inotify = self._watch_writing_dir()
+            elif event.name:
+                self._add_to_backlog(event.name)
 
-        return new_reading_path
+    def _wait_for_new_files(self) -> None:
+        """Blocks until there may be new files in the writing directory."""
+        if self._inotify is None:
+            self._wait_for_file_check(POLL_INTERVAL_SEC)
+            return
+        events = self._inotify.read_events(timeout_sec=EVENT_WAIT_TIMEOUT_SEC)
+        self._handle_events(events)
 
     def _wait_for_file_check(self, duration: float) -> None:
         """
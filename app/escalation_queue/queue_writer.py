@@ -1,16 +1,23 @@
 import json
 import logging
 import os
+import threading
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Callable
 
 import ksuid
 
+from app.core.configs import QueueFsyncPolicy
 from app.core.utils import get_formatted_timestamp_str
 from app.escalation_queue.constants import (DEFAULT_QUEUE_BASE_DIR,
                                             IMAGE_DIR_SUFFIX,
+                                            IMAGE_SEGMENT_SIZE_BYTES,
                                             MAX_QUEUE_FILE_LINES,
                                             WRITING_DIR_SUFFIX)
-from app.escalation_queue.models import EscalationInfo
+from app.escalation_queue.image_store import ImageSegmentReader, ImageSegmentWriter
+from app.escalation_queue.models import EscalationInfo, ImageLocation
+from app.escalation_queue.quota import QueueQuota, escalation_size_bytes
 
 logger = logging.getLogger(__name__)
 
@@ -20,17 +27,77 @@ def convert_escalation_info_to_str(escalation_info: EscalationInfo) -> str:
     return f"{json.dumps(escalation_info.model_dump())}\n"
 
 
+@dataclass
+class _PendingRecord:
+    """An escalation record waiting to be written by the next commit."""
+
+    record: bytes
+    size_bytes: int  # The escalation's size, as counted against the quota
+    on_commit_failed: Callable[[], None] | None = None
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    """Writes all of `data` to the file descriptor, which a single `os.write` isn't guaranteed to do."""
+    view = memoryview(data)
+    while view:
+        num_written = os.write(fd, view)
+        view = view[num_written:]
+
+
 class QueueWriter:
-    """Handles writing escalation data and associated images to a file-based queue system."""
+    """
+    Handles writing escalation data and associated images to a file-based queue system.
 
-    def __init__(self, base_dir: str = DEFAULT_QUEUE_BASE_DIR):
+    The file currently being written to is kept open between escalations. With a `commit_interval_sec`, escalations are
+    buffered and written together by a background thread (a group commit), so that writing many escalations costs a
+    few large writes rather than a write each. `fsync_policy` controls when the escalations and their images are synced
+    to disk; with `ALWAYS`, escalations aren't buffered, and each one is on disk when `write_escalation` returns.
+
+    Images are either appended to segment files with `append_image`, or written to files of their own with
+    `write_image_bytes`. An appended image whose escalation was submitted to the cloud by the edge endpoint itself is
+    acknowledged with `ack_image`, so that the uploader skips the escalation. An appended image whose escalation
+    couldn't be written must be acknowledged too, so that its segment can be reclaimed.
+
+    The escalations written are counted against the queue's quota (see `QueueQuota`), with the limits `max_bytes` and
+    `max_records` if they're given. Callers should check `admits` before writing an escalation.
+    """
+
+    def __init__(
+        self,
+        base_dir: str = DEFAULT_QUEUE_BASE_DIR,
+        commit_interval_sec: float = 0.0,
+        fsync_policy: QueueFsyncPolicy = QueueFsyncPolicy.NONE,
+        image_segment_size: int = IMAGE_SEGMENT_SIZE_BYTES,
+        max_bytes: int | None = None,
+        max_records: int | None = None,
+    ):
         self.base_writing_dir = Path(base_dir, WRITING_DIR_SUFFIX)
         os.makedirs(self.base_writing_dir, exist_ok=True)  # Ensure base_writing_dir exists
         self.base_image_dir = Path(base_dir, IMAGE_DIR_SUFFIX)
         os.makedirs(self.base_image_dir, exist_ok=True)  # Ensure base_image_dir exists
 
+        self.quota = QueueQuota(base_dir, max_bytes=max_bytes, max_records=max_records)
+
         self.last_file_path: Path | None = None
         self.num_lines_written_to_file: int = 0
+        self._fd: int | None = None  # Open file descriptor of `last_file_path`
+        self._inode: int | None = None  # Inode of the open file, to tell whether the reader has moved it
+
+        self.fsync_policy = fsync_policy
+        self.group_commit = commit_interval_sec > 0 and fsync_policy != QueueFsyncPolicy.ALWAYS
+        self._pending_records: list[_PendingRecord] = []
+        self._pending_image_fds: list[int] = []  # Images that need to be synced with the next group commit
+        self._image_segment_writer = ImageSegmentWriter(self.base_image_dir, segment_size=image_segment_size)
+        self._image_acks = ImageSegmentReader(self.base_image_dir)  # Only used to acknowledge images
+        self._image_segment_needs_sync = False
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._commit_thread: threading.Thread | None = None
+        if self.group_commit:
+            self._commit_thread = threading.Thread(
+                target=self._run_group_commits, args=(commit_interval_sec,), name="queue-writer-commit", daemon=True
+            )
+            self._commit_thread.start()
 
     def write_image_bytes(self, image_bytes: bytes, detector_id: str, timestamp: str) -> str:
         """
@@ -39,56 +106,179 @@ class QueueWriter:
         """
         image_file_name = f"{detector_id}-{timestamp}-{ksuid.KsuidMs()}"
         image_path = Path.joinpath(self.base_image_dir, image_file_name)
-        image_path.write_bytes(image_bytes)
+        fd = os.open(image_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            _write_all(fd, image_bytes)
+            if self.fsync_policy == QueueFsyncPolicy.INTERVAL and self.group_commit:
+                # Synced along with the escalation that refers to it, in the next group commit
+                with self._lock:
+                    self._pending_image_fds.append(fd)
+                fd = None
+            elif self.fsync_policy != QueueFsyncPolicy.NONE:
+                os.fsync(fd)
+        finally:
+            if fd is not None:
+                os.close(fd)
 
         return str(image_path.resolve())
 
-    def write_escalation(self, escalation_info: EscalationInfo) -> bool:
+    def append_image(self, image_bytes: bytes) -> tuple[str, ImageLocation]:
+        """
+        Appends the provided image bytes to the current image segment file. Returns the absolute path of the segment as
+        a string, and the location of the image in it.
+        """
+        with self._lock:
+            location = self._image_segment_writer.append(image_bytes)
+            if self.fsync_policy == QueueFsyncPolicy.INTERVAL and self.group_commit:
+                self._image_segment_needs_sync = True  # Synced in the next group commit
+            elif self.fsync_policy != QueueFsyncPolicy.NONE:
+                self._image_segment_writer.sync()
+            return str(self._image_segment_writer.segment_path.resolve()), location
+
+    def ack_image(self, location: ImageLocation) -> None:
+        """Acknowledges an image appended with `append_image`, once its escalation has been submitted to the cloud."""
+        self._image_acks.ack(location)
+
+    def admits(self, is_audit: bool, num_bytes: int = 0) -> bool:
+        """Whether an escalation (or audit) with an image of `num_bytes` bytes fits in the queue's quota."""
+        return self.quota.admits(is_audit, num_bytes)
+
+    def write_escalation(
+        self, escalation_info: EscalationInfo, on_commit_failed: Callable[[], None] | None = None
+    ) -> bool:
         """
         Writes the provided escalation info to the queue.
 
         Will write to the last used file path if it exists and has not exceeded the maximum length. Otherwise will
         create a new file to write the escalation to.
 
-        Returns True if the write succeeds and False otherwise.
+        Returns True if the write succeeds and False otherwise. With group commits, the escalation is only buffered, and
+        True means that it was accepted. If writing it fails later, the failure is logged and `on_commit_failed` is
+        called, from the thread that tried to write it.
         """
-        is_new_file = False
-        if self.last_file_path is None or self.num_lines_written_to_file >= MAX_QUEUE_FILE_LINES:
-            self._reset_to_new_file()
-            is_new_file = True
+        record = convert_escalation_info_to_str(escalation_info).encode()
+        pending = _PendingRecord(record, escalation_size_bytes(record, escalation_info), on_commit_failed)
+        # Counted before it's written, so that a failed commit can release it
+        self.quota.add(pending.size_bytes)
+        with self._lock:
+            self._pending_records.append(pending)
+            if self.group_commit and not self._closed.is_set():
+                failed = []
+            else:
+                failed = self._commit()
+        accepted = all(failed_record is not pending for failed_record in failed)
+        if not accepted:
+            pending.on_commit_failed = None  # Its failure is returned instead
+        self._report_commit_failures(failed)
+        return accepted
 
-        wrote_successfully = self._write_to_path(self.last_file_path, escalation_info, is_new_file)
-        if wrote_successfully:
-            self.num_lines_written_to_file += 1
-        return wrote_successfully
+    def flush(self) -> bool:
+        """Writes any buffered escalations to the queue. Returns True if the write succeeds and False otherwise."""
+        with self._lock:
+            failed = self._commit()
+        self._report_commit_failures(failed)
+        return not failed
 
-    def _write_to_path(self, path_to_write_to: Path, data: EscalationInfo, is_new_file: bool) -> bool:
-        """Writes the provided data to the provided path. Returns True if the write succeeds and False otherwise."""
-        try:
-            flags = os.O_WRONLY | os.O_APPEND
-            if is_new_file:
-                # If we know the file does not yet exist, we want to create it and open it.
-                flags |= os.O_CREAT
-                fd = os.open(path_to_write_to, flags)
-            else:
+    def close(self) -> None:
+        """Writes any buffered escalations and closes the open files."""
+        self._closed.set()
+        if self._commit_thread is not None:
+            self._commit_thread.join()
+        with self._lock:
+            failed = self._commit()
+            self._close_file()
+            self._image_segment_writer.seal()
+        self._report_commit_failures(failed)
+        self.quota.close()
+
+    def _run_group_commits(self, commit_interval_sec: float) -> None:
+        while not self._closed.wait(commit_interval_sec):
+            with self._lock:
+                if not (self._pending_records or self._pending_image_fds or self._image_segment_needs_sync):
+                    continue
+                failed = self._commit()
+            self._report_commit_failures(failed)
+
+    def _report_commit_failures(self, failed: list[_PendingRecord]) -> None:
+        """Releases the quota taken by escalations that couldn't be written, and notifies their writers."""
+        if not failed:
+            return
+        self.quota.release(sum(failed_record.size_bytes for failed_record in failed), num_records=len(failed))
+        for failed_record in failed:
+            if failed_record.on_commit_failed is not None:
                 try:
-                    # If we think the file exists (because we wrote to it before) but aren't certain (because the reader
-                    # could have moved it), we assume it exists and try to open it for appending. If the file doesn't
-                    # exist, this will raise a FileNotFoundError.
-                    fd = os.open(path_to_write_to, flags)
-                except FileNotFoundError:
-                    # If the file doesn't exist (e.g., if the reader moved it) we reset to a new path.
-                    self._reset_to_new_file()
-                    flags |= os.O_CREAT
-                    fd = os.open(self.last_file_path, flags)
-
-            # TODO this could be optimized by opening each file only once, instead of on each write.
-            with os.fdopen(fd, "a") as f:
-                f.write(convert_escalation_info_to_str(data))
-            return True
+                    failed_record.on_commit_failed()
+                except Exception as e:
+                    logger.error(f"Error handling an escalation that couldn't be written: {e}", exc_info=True)
+
+    def _commit(self) -> list[_PendingRecord]:
+        """
+        Writes the buffered escalations to the queue, syncing them and their images according to the fsync policy.
+        Returns the escalations that couldn't be written.
+        """
+        records, self._pending_records = self._pending_records, []
+        image_fds, self._pending_image_fds = self._pending_image_fds, []
+        sync = self.fsync_policy != QueueFsyncPolicy.NONE
+        try:
+            # Images go to disk before the escalations that refer to them
+            for fd in image_fds:
+                os.fsync(fd)
+            if self._image_segment_needs_sync:
+                self._image_segment_needs_sync = False
+                self._image_segment_writer.sync()
+        except OSError as e:
+            logger.error(f"Failed to sync escalation images with error {e}.")
+        finally:
+            for fd in image_fds:
+                os.close(fd)
+
+        path_to_write_to = self.last_file_path
+        try:
+            while records:
+                fd = self._get_file_to_write_to()
+                path_to_write_to = self.last_file_path
+                num_records = min(len(records), MAX_QUEUE_FILE_LINES - self.num_lines_written_to_file)
+                _write_all(fd, b"".join(pending.record for pending in records[:num_records]))
+                if sync:
+                    os.fsync(fd)
+                self.num_lines_written_to_file += num_records
+                records = records[num_records:]
+            return []
         except OSError as e:
-            logger.error(f"Failed to write to {path_to_write_to} with error {e}.")
-            return False
+            logger.error(f"Failed to write {len(records)} escalations to {path_to_write_to} with error {e}.")
+            self._close_file()
+            return records
+
+    def _get_file_to_write_to(self) -> int:
+        """
+        Returns the file descriptor to write the next escalations to, starting a new file if the current one is full
+        or has been moved by the reader.
+        """
+        if self._fd is not None:
+            if self.num_lines_written_to_file >= MAX_QUEUE_FILE_LINES or self._file_was_moved():
+                self._close_file()
+        if self._fd is None:
+            self._reset_to_new_file()
+            # The file is new, so it's safe to create it. We never recreate a file the reader has taken.
+            self._fd = os.open(self.last_file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o644)
+            self._inode = os.fstat(self._fd).st_ino
+        return self._fd
+
+    def _file_was_moved(self) -> bool:
+        """
+        Whether the reader has moved the open file out of the writing directory. Writing to it after that could mean
+        writing after the reader has finished reading it.
+        """
+        try:
+            return os.stat(self.last_file_path).st_ino != self._inode
+        except FileNotFoundError:
+            return True
+
+    def _close_file(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._inode = None
 
     def _generate_new_path(self) -> Path:
         """Generates a new unique path in the writing directory."""
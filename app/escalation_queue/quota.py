@@ -0,0 +1,142 @@
+"""The byte and record quota of the escalation queue.
+
+During a long cloud outage, the escalation queue would otherwise grow until the device's disk is full, taking down
+everything else that needs it. `QueueQuota` tracks how many bytes (of escalation records and their images) and records
+are in the queue, in a small memory-mapped usage file in the queue directory. The usage file is shared by every writer
+(one per edge-endpoint worker process) and by the escalation queue uploader, which runs in another container, so it's
+updated under a POSIX lock. Checking the quota is a read of the mapped file, cheap enough for the request path.
+
+    - Writers add to the usage as they write escalations, and the uploader releases it as it uploads them.
+    - Audits are refused once the queue is `AUDIT_QUOTA_FRACTION` full, keeping the rest of the quota for escalations,
+      and everything is refused once it's full. Callers check `admits` and skip escalating rather than waiting.
+    - When the queue is over its quota anyway (the quota was lowered, or writers raced), the uploader evicts queued
+      escalations (see `app.escalation_queue.eviction`).
+
+The quota's limits are set by the writers, from the edge config, and stored in the usage file, so the uploader doesn't
+need its own copy of them. A limit of 0 means no limit.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from app.escalation_queue.constants import USAGE_FILE_NAME
+from app.escalation_queue.models import EscalationInfo
+
+_USAGE_MAGIC = b"IOQU"
+# Magic, max bytes, max records, bytes, records, evicted records
+_USAGE_RECORD = struct.Struct("<4s4xqqqqq")
+# Audits are refused once the queue is this full
+AUDIT_QUOTA_FRACTION = 0.8
+
+
+def escalation_size_bytes(record: bytes, escalation_info: EscalationInfo) -> int:
+    """The number of bytes that an escalation takes up in the queue: its record plus its image."""
+    if escalation_info.image_location is not None:
+        return len(record) + escalation_info.image_location.length
+    try:
+        return len(record) + os.path.getsize(escalation_info.image_path_str)
+    except OSError:
+        return len(record)
+
+
+class QueueQuota:
+    """The usage and limits of the escalation queue, shared between processes through the queue's usage file."""
+
+    def __init__(self, base_dir: str, max_bytes: int | None = None, max_records: int | None = None) -> None:
+        """Opens the usage file in `base_dir`. If the limits are given, they replace the ones in the file."""
+        self.path = Path(base_dir, USAGE_FILE_NAME)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._lock = threading.Lock()
+        with self._file_locked():
+            if os.fstat(self._fd).st_size < _USAGE_RECORD.size:
+                os.ftruncate(self._fd, 0)
+                os.pwrite(self._fd, _USAGE_RECORD.pack(_USAGE_MAGIC, 0, 0, 0, 0, 0), 0)
+        self._mmap = mmap.mmap(self._fd, _USAGE_RECORD.size)
+        if self._read()[0] != _USAGE_MAGIC:
+            raise ValueError(f"{self.path} isn't an escalation queue usage file.")
+        if max_bytes is not None or max_records is not None:
+            self.set_limits(max_bytes or 0, max_records or 0)
+
+    @contextmanager
+    def _file_locked(self) -> Iterator[None]:
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _read(self) -> tuple[bytes, int, int, int, int, int]:
+        return _USAGE_RECORD.unpack_from(self._mmap, 0)
+
+    def _update(self, update_bytes: int = 0, update_records: int = 0, update_evicted: int = 0) -> None:
+        with self._file_locked():
+            magic, max_bytes, max_records, num_bytes, num_records, num_evicted = self._read()
+            _USAGE_RECORD.pack_into(
+                self._mmap,
+                0,
+                magic,
+                max_bytes,
+                max_records,
+                max(0, num_bytes + update_bytes),  # Usage can only drift below 0 if it was miscounted
+                max(0, num_records + update_records),
+                num_evicted + update_evicted,
+            )
+
+    def set_limits(self, max_bytes: int, max_records: int) -> None:
+        with self._file_locked():
+            _magic, _max_bytes, _max_records, num_bytes, num_records, num_evicted = self._read()
+            _USAGE_RECORD.pack_into(
+                self._mmap, 0, _USAGE_MAGIC, max_bytes, max_records, num_bytes, num_records, num_evicted
+            )
+
+    def set_usage(self, num_bytes: int, num_records: int) -> None:
+        """Replaces the tracked usage, after counting it from the queue's files."""
+        with self._file_locked():
+            magic, max_bytes, max_records, _num_bytes, _num_records, num_evicted = self._read()
+            _USAGE_RECORD.pack_into(self._mmap, 0, magic, max_bytes, max_records, num_bytes, num_records, num_evicted)
+
+    def add(self, num_bytes: int, num_records: int = 1) -> None:
+        self._update(update_bytes=num_bytes, update_records=num_records)
+
+    def release(self, num_bytes: int, num_records: int = 1, evicted: bool = False) -> None:
+        self._update(update_bytes=-num_bytes, update_records=-num_records, update_evicted=num_records if evicted else 0)
+
+    def fill_fraction(self, extra_bytes: int = 0, extra_records: int = 0) -> float:
+        """How full the queue is (or would be, with the extra usage), relative to the tighter of its limits."""
+        _magic, max_bytes, max_records, num_bytes, num_records, _num_evicted = self._read()
+        fractions = [0.0]
+        if max_bytes > 0:
+            fractions.append((num_bytes + extra_bytes) / max_bytes)
+        if max_records > 0:
+            fractions.append((num_records + extra_records) / max_records)
+        return max(fractions)
+
+    def admits(self, is_audit: bool, num_bytes: int = 0) -> bool:
+        """Whether an escalation (or audit) of `num_bytes` bytes fits in the queue."""
+        limit = AUDIT_QUOTA_FRACTION if is_audit else 1.0
+        return self.fill_fraction(extra_bytes=num_bytes, extra_records=1) <= limit
+
+    def stats(self) -> dict:
+        _magic, max_bytes, max_records, num_bytes, num_records, num_evicted = self._read()
+        return {
+            "bytes": num_bytes,
+            "records": num_records,
+            "max_bytes": max_bytes,
+            "max_records": max_records,
+            "fill_fraction": self.fill_fraction(),
+            "evicted_records": num_evicted,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fd >= 0:
+                self._mmap.close()
+                os.close(self._fd)
+                self._fd = -1
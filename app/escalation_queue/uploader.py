@@ -0,0 +1,358 @@
+"""Uploads the escalations in the on-disk escalation queue to the cloud.
+
+The edge endpoint writes every escalation to the queue before it responds, and then submits it itself (see
+`app.core.escalation_dispatcher`), acknowledging its image once it has. The uploader runs in its own container, reads
+the escalations back with `QueueReader`, and uploads the ones the edge endpoint couldn't submit (because the cloud was
+unreachable, too many were waiting to be submitted, or the edge endpoint stopped or crashed first), with the same image
+query IDs that the edge answers were returned with. It leaves an escalation that the edge endpoint is submitting alone
+for `DISPATCH_GRACE_SEC`, and then only uploads it if its image hasn't been acknowledged. Escalations are uploaded with
+the API token in their detector's inference config, if it has one, and the edge endpoint's API token otherwise.
+
+Several consumers drain the queue in parallel, each with its own `QueueReader`, which leases it one queue file at a time
+(so a consumer that stops partway through a file has it taken over by another one, see `QueueReader`). Each consumer
+reads its file in order, in batches, and uploads each batch concurrently, subject to an overall rate limit. Images are
+streamed to the cloud from their memory-mapped image segment (or from their own file, for escalations written by older
+versions), and acknowledged once their escalation has been uploaded, which lets drained segments be reclaimed. The queue
+guarantees that every escalation is read at least once, so an escalation can be read again after a restart. Those
+duplicates are recognized by their image query ID (or their acknowledged or missing image), and aren't submitted twice.
+
+The uploader also releases the queue's quota as escalations leave the queue, and evicts escalations when the queue is
+over its quota (see `app.escalation_queue.eviction`).
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import BinaryIO
+
+import cachetools
+from fastapi import HTTPException
+from intellioptics import IntelliOptics
+from pydantic import ValidationError
+
+from app.core.app_state import get_detector_inference_configs, load_edge_config
+from app.core.escalation_dispatcher import HTTP_409_CONFLICT, MAX_RETRY_BACKOFF_SEC, is_retryable_error
+from app.core.utils import safe_call_sdk
+from app.escalation_queue.constants import DEFAULT_QUEUE_BASE_DIR, DISPATCH_GRACE_SEC, IMAGE_DIR_SUFFIX
+from app.escalation_queue.eviction import QueueEvictor
+from app.escalation_queue.image_store import (ImageSegmentReader,
+                                              SegmentImage,
+                                              release_escalation_image)
+from app.escalation_queue.models import EscalationInfo
+from app.escalation_queue.queue_reader import QueueReader
+from app.escalation_queue.quota import QueueQuota, escalation_size_bytes
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_NUM_CONSUMERS = 4
+DEFAULT_MAX_UPLOADS_PER_SEC = 20.0
+INITIAL_RETRY_BACKOFF_SEC = 1.0
+UPLOADED_IDS_CACHE_SIZE = 10_000
+STATS_LOG_INTERVAL_SEC = 60.0
+EVICTION_CHECK_INTERVAL_SEC = 1.0
+
+
+@dataclass
+class UploaderStats:
+    uploaded: int = 0
+    duplicates: int = 0  # Escalations that had already been uploaded, by the uploader or by the edge endpoint
+    dropped: int = 0  # Escalations that were invalid or rejected by the cloud
+    retries: int = 0
+    evicted: int = 0  # Escalations evicted because the queue was over its quota
+
+
+class RateLimiter:
+    """A token bucket that allows `rate_per_sec` operations per second on average, in bursts of up to `burst`."""
+
+    def __init__(self, rate_per_sec: float, burst: int) -> None:
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate_per_sec)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate_per_sec)
+
+
+class EscalationUploader:
+    """
+    Drains the escalation queue, uploading the escalations to the cloud. Each of the `readers` is a consumer, and
+    `concurrency` uploads are shared evenly between them, so that each consumer uploads batches of
+    `concurrency // len(readers)` escalations from its file. With as many consumers as concurrent uploads, each file's
+    escalations are uploaded one at a time, strictly in order. Escalations for the detectors in `detector_ios` are
+    uploaded with their SDK instance, and the others with `io`.
+    """
+
+    def __init__(
+        self,
+        io: IntelliOptics,
+        readers: list[QueueReader],
+        image_reader: ImageSegmentReader,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        max_uploads_per_sec: float | None = DEFAULT_MAX_UPLOADS_PER_SEC,
+        evictor: QueueEvictor | None = None,
+        detector_ios: dict[str, IntelliOptics] | None = None,
+    ) -> None:
+        self.io = io
+        self.detector_ios = detector_ios or {}
+        self.readers = readers
+        self.image_reader = image_reader
+        self.evictor = evictor
+        self.concurrency = concurrency
+        self.batch_size = max(1, concurrency // len(readers))
+        self.rate_limiter = RateLimiter(max_uploads_per_sec, burst=concurrency) if max_uploads_per_sec else None
+        self.stats = UploaderStats()
+        self._uploaded_ids: cachetools.LRUCache = cachetools.LRUCache(maxsize=UPLOADED_IDS_CACHE_SIZE)
+        # The default executor is sized by the number of CPUs, which would cap the number of concurrent uploads
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="uploader")
+        # Waiting for a batch blocks until there is something in the queue, so each consumer needs a thread to wait in
+        self._reader_executor = ThreadPoolExecutor(max_workers=len(readers), thread_name_prefix="queue-reader")
+        self._num_processed = 0
+
+    async def run(self, max_escalations: int | None = None) -> None:
+        """
+        Uploads escalations as they are written to the queue, until the readers are stopped. Stops after
+        `max_escalations`, if given.
+        """
+        background_tasks = []
+        if self.evictor is not None:
+            await asyncio.to_thread(self.evictor.recover)
+            background_tasks.append(asyncio.create_task(self._run_evictions()))
+        await self._reclaim_drained_segments()
+        background_tasks.append(asyncio.create_task(self._run_housekeeping()))
+        consumers = [asyncio.create_task(self._consume(reader, max_escalations)) for reader in self.readers]
+        try:
+            done, _pending = await asyncio.wait(consumers, return_when=asyncio.FIRST_COMPLETED)
+            for consumer in done:
+                consumer.result()  # Raises the consumer's exception, if it failed
+        finally:
+            # Consumers waiting for a batch return once their reader is stopped
+            for reader in self.readers:
+                reader.stop()
+            for task in consumers + background_tasks:
+                task.cancel()
+
+    def close(self) -> None:
+        """Closes the readers, once the consumers have noticed that they were stopped."""
+        for reader in self.readers:
+            reader.stop()
+        self._reader_executor.shutdown(wait=True)
+        self._executor.shutdown(wait=False)
+        for reader in self.readers:
+            reader.close()
+
+    async def _consume(self, reader: QueueReader, max_escalations: int | None) -> None:
+        """Uploads the escalations from the files leased by the reader, a batch at a time."""
+        batches = reader.iter_batches(max_batch_size=self.batch_size)
+        loop = asyncio.get_running_loop()
+        while max_escalations is None or self._num_processed < max_escalations:
+            batch = await loop.run_in_executor(self._reader_executor, next, batches, None)
+            if batch is None:
+                return  # The reader was stopped
+            await asyncio.gather(*(self.upload(line) for line in batch))
+            self._num_processed += len(batch)
+
+    async def _run_housekeeping(self) -> None:
+        while True:
+            await asyncio.sleep(STATS_LOG_INTERVAL_SEC)
+            logger.info(f"Escalation uploader stats: {asdict(self.stats)}")
+            # Segments normally get reclaimed as their last image is uploaded, but not if their writer died
+            await self._reclaim_drained_segments()
+
+    async def _run_evictions(self) -> None:
+        while True:
+            await asyncio.sleep(EVICTION_CHECK_INTERVAL_SEC)
+            try:
+                self.stats.evicted += await asyncio.to_thread(self.evictor.evict_if_over_quota)
+            except Exception as e:
+                logger.error(f"Failed to evict escalations from the escalation queue: {e}", exc_info=True)
+
+    async def upload(self, line: str) -> None:
+        """Uploads one escalation from the queue, retrying until it's uploaded or rejected by the cloud."""
+        try:
+            escalation_info = EscalationInfo.model_validate_json(line)
+        except ValidationError as e:
+            logger.error(f"Dropping invalid escalation from the queue: {e}")
+            self.stats.dropped += 1
+            if self.evictor is not None:
+                self.evictor.quota.release(len(line.encode()))
+            return
+
+        image_query_id = escalation_info.submit_iq_params.image_query_id
+        if escalation_info.dispatched_at is not None:
+            # Give the edge endpoint, which is submitting the escalation itself, time to do so
+            delay_sec = escalation_info.dispatched_at + DISPATCH_GRACE_SEC - time.time()
+            if delay_sec > 0:
+                await asyncio.sleep(delay_sec)
+        if image_query_id in self._uploaded_ids or self._is_image_released(escalation_info):
+            # The image is only released after the escalation has been uploaded
+            logger.debug(f"Skipping escalation {image_query_id}, which has already been uploaded.")
+            self.stats.duplicates += 1
+            self._release(line, escalation_info)
+            return
+
+        backoff_sec = INITIAL_RETRY_BACKOFF_SEC
+        while True:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+            try:
+                await asyncio.get_running_loop().run_in_executor(self._executor, self._submit, escalation_info)
+                self.stats.uploaded += 1
+                break
+            except FileNotFoundError:
+                # The image was released by another upload of the same escalation
+                self.stats.duplicates += 1
+                break
+            except HTTPException as e:
+                if e.status_code == HTTP_409_CONFLICT:
+                    self.stats.duplicates += 1
+                    break
+                if not is_retryable_error(e):
+                    logger.error(f"The cloud rejected escalation {image_query_id}, dropping it: {e.detail}")
+                    self.stats.dropped += 1
+                    break
+                error = e
+            except Exception as e:
+                error = e
+            logger.warning(f"Failed to upload escalation {image_query_id}, retrying in {backoff_sec}s: {error}")
+            self.stats.retries += 1
+            await asyncio.sleep(backoff_sec)
+            backoff_sec = min(backoff_sec * 2, MAX_RETRY_BACKOFF_SEC)
+
+        if image_query_id is not None:
+            self._uploaded_ids[image_query_id] = True
+        self._release(line, escalation_info)
+
+    def _is_image_released(self, escalation_info: EscalationInfo) -> bool:
+        if escalation_info.image_location is not None:
+            return self.image_reader.is_acked(escalation_info.image_location)
+        return not Path(escalation_info.image_path_str).exists()
+
+    def _release(self, line: str, escalation_info: EscalationInfo) -> None:
+        """Releases the escalation's image and its share of the queue's quota, once it has left the queue."""
+        if self.evictor is not None:
+            self.evictor.quota.release(escalation_size_bytes(line.encode(), escalation_info))
+        release_escalation_image(self.image_reader, escalation_info)
+
+    def _open_image(self, escalation_info: EscalationInfo) -> BinaryIO | SegmentImage:
+        if escalation_info.image_location is not None:
+            return self.image_reader.open_image(escalation_info.image_location)
+        return Path(escalation_info.image_path_str).open("rb")
+
+    async def _reclaim_drained_segments(self) -> None:
+        num_reclaimed = await asyncio.to_thread(self.image_reader.reclaim_drained_segments)
+        if num_reclaimed:
+            logger.info(f"Reclaimed {num_reclaimed} drained image segments.")
+
+    def _submit(self, escalation_info: EscalationInfo) -> None:
+        io = self.detector_ios.get(escalation_info.detector_id, self.io)
+        with self._open_image(escalation_info) as image:  # Streamed to the cloud rather than read into memory
+            safe_call_sdk(
+                io.submit_image_query,
+                detector=escalation_info.detector_id,
+                image=image,
+                wait=0,
+                want_async=True,
+                **escalation_info.submit_iq_params.model_dump(),
+            )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Upload escalations from the escalation queue to the cloud.")
+    parser.add_argument("--base-dir", default=DEFAULT_QUEUE_BASE_DIR, help="Base directory of the escalation queue.")
+    parser.add_argument(
+        "--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Maximum number of concurrent uploads."
+    )
+    parser.add_argument(
+        "--consumers",
+        type=int,
+        default=DEFAULT_NUM_CONSUMERS,
+        help="Number of queue files uploaded from in parallel. The concurrent uploads are shared between them.",
+    )
+    parser.add_argument(
+        "--max-uploads-per-sec",
+        type=float,
+        default=DEFAULT_MAX_UPLOADS_PER_SEC,
+        help="Maximum average number of uploads per second. 0 means no limit.",
+    )
+    return parser
+
+
+def get_detector_sdk_instances(endpoint: str | None) -> dict[str, IntelliOptics]:
+    """
+    Returns an SDK instance for each detector whose inference config has its own API token, so that its escalations are
+    uploaded with that token. Returns none if the edge config can't be loaded.
+    """
+    try:
+        detector_inference_configs = get_detector_inference_configs(root_edge_config=load_edge_config())
+    except FileNotFoundError as e:
+        logger.warning(f"Uploading every escalation with the edge endpoint's API token, as there's no edge config: {e}")
+        return {}
+    sdk_instances: dict[str, IntelliOptics] = {}  # Shared between the detectors with the same API token
+    detector_ios = {}
+    for detector_id, inference_config in (detector_inference_configs or {}).items():
+        if api_token := inference_config.api_token:
+            if api_token not in sdk_instances:
+                sdk_instances[api_token] = IntelliOptics(api_token=api_token, endpoint=endpoint)
+            detector_ios[detector_id] = sdk_instances[api_token]
+    return detector_ios
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s.%(msecs)03d %(levelname)s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    # Escalations from the queue are submitted with their detector's API token, or the edge endpoint's
+    endpoint = os.environ.get("INTELLIOPTICS_ENDPOINT")
+    io = IntelliOptics(api_token=os.environ.get("INTELLIOPTICS_API_TOKEN"), endpoint=endpoint)
+    detector_ios = get_detector_sdk_instances(endpoint)
+    image_reader = ImageSegmentReader(Path(args.base_dir, IMAGE_DIR_SUFFIX))
+    # The quota's limits are set by the edge endpoint, from its config
+    evictor = QueueEvictor(args.base_dir, QueueQuota(args.base_dir), image_reader)
+    # Consumer IDs that stay the same when the container restarts let it resume the files it was reading right away
+    readers = [
+        QueueReader(base_dir=args.base_dir, consumer_id=f"{socket.gethostname()}-{i}") for i in range(args.consumers)
+    ]
+    uploader = EscalationUploader(
+        io=io,
+        readers=readers,
+        image_reader=image_reader,
+        concurrency=args.concurrency,
+        max_uploads_per_sec=args.max_uploads_per_sec,
+        evictor=evictor,
+        detector_ios=detector_ios,
+    )
+    logger.info(
+        f"Uploading escalations from {args.base_dir} with {args.consumers=}, {args.concurrency=}, "
+        f"{args.max_uploads_per_sec=}"
+    )
+    try:
+        asyncio.run(uploader.run())
+    except KeyboardInterrupt:
+        logger.info("Stopping escalation uploader.")
+    finally:
+        uploader.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
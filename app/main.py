@@ -13,7 +13,7 @@ from fastapi import FastAPI
 
 from app.api.api import api_router, health_router, ping_router
 from app.api.naming import API_BASE_PATH
-from app.core.app_state import AppState
+from app.core.app_state import AppState, detector_metadata_cache, sdk_instances
 from app.streaming.rtsp_ingest import StreamIngestManager
 
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
@@ -62,6 +62,9 @@ async def startup_event():
         scheduler.add_job(update_inference_config, "interval", seconds=30, args=[app.state.app_state])
         scheduler.start()
 
+    await app.state.app_state.edge_inference_manager.start()
+    await detector_metadata_cache.start(app.state.app_state.get_prefetch_sdk_instances())
+    app.state.app_state.escalation_dispatcher.start()
     await app.state.stream_manager.start()
     app.state.app_state.is_ready = True
     logging.info("Application is ready to serve requests.")
@@ -72,8 +75,15 @@ async def shutdown_event():
     """Lifecycle event that is triggered when the application is shutting down."""
     app.state.app_state.is_ready = False
     app.state.app_state.db_manager.shutdown()
+    await detector_metadata_cache.stop()
+    # Stop the RTSP ingest tasks first, as they submit frames for inference and escalation
     stream_manager: StreamIngestManager | None = getattr(app.state, "stream_manager", None)
     if stream_manager is not None:
         await stream_manager.stop()
+    await app.state.app_state.escalation_dispatcher.stop()
+    await app.state.app_state.edge_inference_manager.aclose()
     if DEPLOY_DETECTOR_LEVEL_INFERENCE:
         scheduler.shutdown()
+    if app.state.app_state.shared_state is not None:
+        app.state.app_state.shared_state.close()
+    sdk_instances.close()
@@ -1,145 +1,175 @@
-"""Uses the filesystem to track various metrics about image-query activity. Tracks iqs, escalations,
-and audits for each detector, as well as iqs submitted to the edge-endpoint as a whole.
+"""Tracks various metrics about image-query activity in a counter table shared through the filesystem. Tracks iqs,
+escalations, audits and cache hits for each detector.
+
+The counters are kept in a `SharedSlotTable` (see `app.core.shared_state`) in a memory-mapped file, which every
+edge-endpoint worker process maps to record activity, and the status monitor (in another container) maps to report it.
+Each (activity type, detector) pair has a slot, holding the time of the last activity and the number of activities in
+each of the last few hours, in buckets that are reused as the hours go by. Recording an activity is a single update of
+a single slot, under that slot's lock, and there are no old counters to clear out. Hours are local-time hours.
 
 Filesystem structure:
-/opt/intellioptics/edge-metrics/
-    detectors/
+/opt/intellioptics/device/edge-metrics/
+    activity.table          <-- the counter table
+    activity.table.import   <-- lock file for importing the legacy counters
+    detectors/              <-- legacy counters, imported into the table when it's first opened
         <detector_id1>/
-            last_iqs
-            last_escalations
-            last_audits
-            iqs_<pid1>_YYYY-MM-DD_HH    <-- arbitrary number of files, one per process. hourly files cleared out regularly
-            iqs_<pid1>_YYYY-MM-DD_HH
-            iqs_<pid2>_YYYY-MM-DD_HH
-            iqs_<pid2>_YYYY-MM-DD_HH
-            escalations_<pid1>_YYYY-MM-DD_HH
-            escalations_<pid2>_YYYY-MM-DD_HH
-            audits_<pid1>_YYYY-MM-DD_HH
+            last_iqs        <-- one file per activity type, touched on each activity
+            iqs_<pid1>_YYYY-MM-DD_HH    <-- one file per activity type, process and hour, holding a count
         <detector_id2>/
             repeat of above detector
 """
 
+import fcntl
 import json
 import logging
 import os
+import struct
+from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 from functools import lru_cache
 from pathlib import Path
 
-logger = logging.getLogger(__name__)
-
-
-class FilesystemActivityTrackingHelper:
-    """Helper class to support tracking image-query activity using the filesystem."""
-
-    def __init__(self, base_dir: str):
-        self.base_dir = Path(base_dir)
-        # Ensure the base directory exists
-        os.makedirs(self.base_dir, exist_ok=True)
+from app.core.shared_state import SharedSlotTable, SharedStateFullError
 
-        self.detectors_dir = Path(self.base_dir, "detectors")
-        # Ensure the detectors directory exists
-        os.makedirs(self.detectors_dir, exist_ok=True)
-
-    def file(self, name: str) -> Path:
-        """Get the path to a file which is used to track something across the whole edge-endpoint (like number of
-        active models, or the last image query)"""
-        return Path(self.base_dir, name)
-
-    def detector_folder(self, detector_id: str) -> Path:
-        """Get the path to the folder for a detector's activity metrics. If it doesn't exist, create it."""
-        f = Path(self.detectors_dir, detector_id)
-        f.mkdir(parents=True, exist_ok=True)
-        return f
-
-    def detector_file(self, detector_id: str, name: str) -> Path:
-        """Get the path to a file which is used to track something specific to a detector."""
-        return Path(self.detector_folder(detector_id), name)
-
-    def last_activity_file(self, activity_type: str, detector_id: str | None = None) -> Path:
-        """Get the path to a file which is used to track the last time "activity_type" occurred, on
-        a per-detector or system-wide basis. Not specific to a process.
-        """
-        name = f"last_{activity_type}"
-
-        if detector_id:
-            return self.detector_file(detector_id, name)
-
-        return self.file(name)
+logger = logging.getLogger(__name__)
 
-    def hourly_activity_file(self, activity_type: str, time: datetime, detector_id: str | None = None) -> Path:
-        """Get the path to a file which is used to track the number of times an activity type
-        occurred in an hour on this process."""
-        hour = time.strftime("%Y-%m-%d_%H")
-        pid = os.getpid()
+SUPPORTED_ACTIVITY_TYPES = ["iqs", "escalations", "audits", "cache_hits"]
+# The activity types in the per-detector activity report. Cache hits are counted, but kept out of it so that the report's
+# fields don't change.
+REPORTED_ACTIVITY_TYPES = ["iqs", "escalations", "audits"]
+ACTIVITY_METRICS_BASE_DIR = "/opt/intellioptics/device/edge-metrics"
+ACTIVITY_TABLE_FILE_NAME = "activity.table"
+# A slot per activity type and detector, so the table has room for 1024 detectors
+DEFAULT_NUM_ACTIVITY_SLOTS = 4096
+_ACTIVITY_SLOT_SIZE = 192
+# Number of hours counted. Only the previous hour is reported, but this leaves room for reports that run late.
+_NUM_HOURLY_BUCKETS = 3
+# Time of the last activity (0 if never), then the hour and count of each bucket
+_ACTIVITY = struct.Struct("<d" + "iI" * _NUM_HOURLY_BUCKETS)
+_LEGACY_IMPORTED_KEY = "legacy_imported"
 
-        name = f"{activity_type}_{pid}_{hour}"
 
-        if detector_id:
-            return self.detector_file(detector_id, name)
+def _hour_number(time: datetime) -> int:
+    """Numbers local-time hours, so that each hour (as formatted with %Y-%m-%d_%H) gets its own number."""
+    return time.toordinal() * 24 + time.hour
 
-        return self.file(name)
 
-    def increment_counter_file(self, file: Path):
-        """Increment a counter file, or create it if it doesn't exist.
+class ActivityCounters:
+    """Counts image-query activity per detector, activity type and hour, in a table shared between processes."""
 
-        Args:
-            file (Path): The path to the counter file.
-        """
-        if not file.exists():
-            file.touch()
-            file.write_text("1")
+    def __init__(self, base_dir: str, num_slots: int = DEFAULT_NUM_ACTIVITY_SLOTS):
+        self.base_dir = Path(base_dir)
+        # Ensure the base directory exists
+        os.makedirs(self.base_dir, exist_ok=True)
+        self.table = SharedSlotTable(str(self.base_dir / ACTIVITY_TABLE_FILE_NAME), num_slots, _ACTIVITY_SLOT_SIZE)
+
+    def record(self, detector_id: str, activity_type: str, time: datetime) -> None:
+        """Record an activity. Raises `SharedStateFullError` if the table has no room for a new detector."""
+        self._add(detector_id, activity_type, time.timestamp(), {_hour_number(time): 1})
+
+    def last_activity_time(self, detector_id: str, activity_type: str) -> datetime | None:
+        last_activity, _buckets = self._read(detector_id, activity_type)
+        return datetime.fromtimestamp(last_activity) if last_activity else None
+
+    def hourly_count(self, detector_id: str, activity_type: str, time: datetime) -> int:
+        """Get the number of activities in the hour containing `time`, if it's still counted."""
+        hour = _hour_number(time)
+        _last_activity, buckets = self._read(detector_id, activity_type)
+        return sum(count for bucket_hour, count in buckets if bucket_hour == hour)
+
+    def detector_ids(self) -> set[str]:
+        """Get the IDs of every detector that has had any activity."""
+        detector_ids = set()
+        for key in self.table.keys():
+            activity_type, _, detector_id = key.partition(":")
+            if activity_type in SUPPORTED_ACTIVITY_TYPES:
+                detector_ids.add(detector_id)
+        return detector_ids
+
+    def import_legacy_counters(self) -> None:
+        """Import the counters that were kept in a file each, once, from whichever process opens the table first."""
+        if self.table.get(_LEGACY_IMPORTED_KEY) is not None:
             return
-
-        read_total = int(file.read_text())
-        file.write_text(str(read_total + 1))
-
-    def get_last_file_modification_time(self, file: Path) -> datetime | None:
-        """Get the last time a file was modified."""
-        if not file.exists():
-            return None
-        return datetime.fromtimestamp(file.stat().st_mtime)
-
-    def get_activity_from_file(self, file: Path) -> int:
-        """Get the activity from a file. Returns 0 if the file doesn't exist or is empty."""
-        if not file.exists():
-            return 0
-
-        text = file.read_text(encoding="utf-8")
-        if text == "":
-            return 0
-        return int(text)
+        with open(self.base_dir / f"{ACTIVITY_TABLE_FILE_NAME}.import", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # Released when the file is closed
+            if self.table.get(_LEGACY_IMPORTED_KEY) is not None:
+                return  # Another process imported them while we waited
+            legacy_dir = self.base_dir / "detectors"
+            if legacy_dir.is_dir():
+                for detector_dir in filter(Path.is_dir, legacy_dir.iterdir()):
+                    for activity_type in SUPPORTED_ACTIVITY_TYPES:
+                        self._import_legacy_counter(detector_dir, activity_type)
+            self.table.set(_LEGACY_IMPORTED_KEY, b"1")
+
+    def close(self) -> None:
+        self.table.close()
+
+    def _import_legacy_counter(self, detector_dir: Path, activity_type: str) -> None:
+        last_file = detector_dir / f"last_{activity_type}"
+        last_activity = last_file.stat().st_mtime if last_file.exists() else 0.0
+        hourly_counts: dict[int, int] = defaultdict(int)
+        for f in detector_dir.glob(f"{activity_type}_*_*"):
+            try:
+                hour = datetime.strptime(f.name[-len("YYYY-MM-DD_HH") :], "%Y-%m-%d_%H")
+                hourly_counts[_hour_number(hour)] += int(f.read_text() or 0)
+            except ValueError:
+                continue  # Not a counter file
+        if last_activity or hourly_counts:
+            self._add(detector_dir.name, activity_type, last_activity, hourly_counts)
+
+    def _read(self, detector_id: str, activity_type: str) -> tuple[float, list[tuple[int, int]]]:
+        value = self.table.get(f"{activity_type}:{detector_id}")
+        return _unpack(value)
+
+    def _add(self, detector_id: str, activity_type: str, last_activity: float, hourly_counts: dict[int, int]) -> None:
+        with self.table.locked(f"{activity_type}:{detector_id}") as slot:
+            previous_last_activity, buckets = _unpack(slot.read())
+            for hour, count in hourly_counts.items():
+                index = hour % _NUM_HOURLY_BUCKETS
+                bucket_hour, bucket_count = buckets[index]
+                if bucket_hour == hour:
+                    buckets[index] = (hour, bucket_count + count)
+                elif bucket_hour < hour:
+                    buckets[index] = (hour, count)  # The bucket held an hour that's no longer counted
+            values = [value for bucket in buckets for value in bucket]
+            slot.write(_ACTIVITY.pack(max(previous_last_activity, last_activity), *values))
+
+
+def _unpack(value: bytes | None) -> tuple[float, list[tuple[int, int]]]:
+    if value is None:
+        return 0.0, [(0, 0)] * _NUM_HOURLY_BUCKETS
+    last_activity, *values = _ACTIVITY.unpack(value)
+    return last_activity, list(zip(values[::2], values[1::2]))
 
 
 class ActivityRetriever:
-    """Retrieve IQ activity metrics from the filesystem to report them."""
+    """Retrieve IQ activity metrics from the counter table to report them."""
 
     def last_activity_time(self) -> str:
         """Get the last time an image was processed by the edge-endpoint as an ISO 8601 timestamp."""
-        activity_file = _tracker().last_activity_file("iqs")
-        last_file_activity = _tracker().get_last_file_modification_time(activity_file)
-        return last_file_activity.isoformat() if last_file_activity else "none"
+        counters = _counters()
+        last_activity_times = [counters.last_activity_time(det, "iqs") for det in counters.detector_ids()]
+        last_activity = max((t for t in last_activity_times if t is not None), default=None)
+        return last_activity.isoformat() if last_activity else "none"
 
     def num_detectors_lifetime(self) -> int:
         """Get the total number of detectors."""
-        f = _tracker().detectors_dir
-        return len(list(f.iterdir()))
+        return len(_counters().detector_ids())
 
     def num_detectors_active(self, time_period: timedelta) -> int:
         """Get the number of detectors that have had an IQ submitted to them in the last time period."""
-        f = _tracker().detectors_dir
-        activity_files = [_tracker().last_activity_file("iqs", det.name) for det in f.iterdir()]
+        counters = _counters()
+        active_since = datetime.now() - time_period
         active_detectors = [
-            file.parent.name
-            for file in activity_files
-            if _tracker().get_last_file_modification_time(file) > datetime.now() - time_period
+            det
+            for det in counters.detector_ids()
+            if (last_activity := counters.last_activity_time(det, "iqs")) is not None and last_activity > active_since
         ]
         return len(active_detectors)
 
     def get_all_detector_activity(self) -> dict:
         """Get all activity metrics for all detectors."""
-        f = _tracker().detectors_dir
-        detector_activity = {det.name: self.get_detector_activity_metrics(det.name) for det in f.iterdir()}
+        detector_activity = {det: self.get_detector_activity_metrics(det) for det in _counters().detector_ids()}
 
         # Convert the detector_activity dict to a JSON string to prevent opensearch from indexing all
         # the individual detector fields
@@ -151,18 +181,14 @@ class ActivityRetriever:
 
     def get_detector_activity_metrics(self, detector_id: str) -> int:
         """Get the activity on a detector for the previous hour."""
-        time = (datetime.now() - timedelta(hours=1)).strftime("%Y-%m-%d_%H")
-        logger.info(f"Getting activity for detector {detector_id} at {time}")
-
-        detector_folder = _tracker().detector_folder(detector_id)
-        activity_files = list(detector_folder.glob(f"*_{time}"))
+        previous_hour = datetime.now() - timedelta(hours=1)
+        logger.info(f"Getting activity for detector {detector_id} at {previous_hour.strftime('%Y-%m-%d_%H')}")
 
+        counters = _counters()
         detector_metrics = {}
-        for activity_type in ["iqs", "escalations", "audits"]:
-            files = [f for f in activity_files if f.name.startswith(activity_type)]
-            total_activity = sum([_tracker().get_activity_from_file(f) for f in files])
-            f = _tracker().last_activity_file(activity_type, detector_id)
-            last_activity = _tracker().get_last_file_modification_time(f)
+        for activity_type in REPORTED_ACTIVITY_TYPES:
+            total_activity = counters.hourly_count(detector_id, activity_type, previous_hour)
+            last_activity = counters.last_activity_time(detector_id, activity_type)
             last_activity = last_activity.isoformat() if last_activity else "none"
 
             detector_metrics[f"hourly_total_{activity_type}"] = total_activity
@@ -172,9 +198,11 @@ class ActivityRetriever:
 
 
 @lru_cache(maxsize=1)  # Singleton
-def _tracker() -> FilesystemActivityTrackingHelper:
-    """Get the activity tracker."""
-    return FilesystemActivityTrackingHelper(base_dir="/opt/intellioptics/device/edge-metrics")
+def _counters() -> ActivityCounters:
+    """Get the activity counters."""
+    counters = ActivityCounters(base_dir=ACTIVITY_METRICS_BASE_DIR)
+    counters.import_legacy_counters()
+    return counters
 
 
 def record_activity_for_metrics(detector_id: str, activity_type: str):
@@ -182,42 +210,16 @@ def record_activity_for_metrics(detector_id: str, activity_type: str):
     - iqs
     - escalations
     - audits
+    - cache_hits (image queries answered from the edge inference result cache)
     """
-    supported_activity_types = ["iqs", "escalations", "audits"]
-    if activity_type not in supported_activity_types:
+    if activity_type not in SUPPORTED_ACTIVITY_TYPES:
         raise ValueError(
-            f"The provided activity type ({activity_type}) is not currently supported. Supported types are: {supported_activity_types}"
+            f"The provided activity type ({activity_type}) is not currently supported. Supported types are: {SUPPORTED_ACTIVITY_TYPES}"
         )
 
     logger.debug(f"Recording activity {activity_type} on detector {detector_id}")
 
-    current_hour = datetime.now()
-    f = _tracker().hourly_activity_file(activity_type, current_hour, detector_id)
-    _tracker().increment_counter_file(f)
-
-    f = _tracker().last_activity_file(activity_type, detector_id)
-    f.touch()
-
-
-def clear_old_activity_files():
-    """Clear all activity files that are older than 2 hours."""
-    current_hour = datetime.now().strftime("%Y-%m-%d_%H")
-    last_hour = (datetime.now() - timedelta(hours=1)).strftime("%Y-%m-%d_%H")
-    two_hours_ago = (datetime.now() - timedelta(hours=2)).strftime("%Y-%m-%d_%H")
-    valid_hours = [current_hour, last_hour, two_hours_ago]
-
-    # Looking for files that match the pattern <record_name>_YYYY-MM-DD_HH
-    time_pattern = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]_[0-9][0-9]"
-
-    folders = list(_tracker().detectors_dir.iterdir())
-    folders.append(_tracker().base_dir)
-
-    old_files = []
-    for folder in folders:
-        files = folder.glob(f"*_{time_pattern}")
-        old_files.extend([f for f in files if f.name[-len("YYYY-MM-DD_HH") :] not in valid_hours])
-
-    if old_files:
-        logger.info(f"Clearing {len(old_files)} old activity files: {old_files}")
-        for f in old_files:
-            f.unlink()
+    try:
+        _counters().record(detector_id, activity_type, datetime.now())
+    except SharedStateFullError as e:
+        logger.warning(f"Can't record activity for metrics: {e}")
@@ -0,0 +1,81 @@
+"""In-process runtime statistics for the edge-endpoint web server.
+
+Unlike the activity metrics in `iq_activity`, which are persisted to the filesystem and aggregated across all the
+edge-endpoint worker processes, these statistics live in memory and describe a single worker process. They are cheap
+enough to update on every request, and are served from the `/health/metrics` endpoint for tuning and debugging.
+"""
+
+import logging
+import os
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TimingSummary:
+    count: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+
+    def add(self, value_ms: float) -> None:
+        self.count += 1
+        self.total_ms += value_ms
+        self.max_ms = max(self.max_ms, value_ms)
+
+    def as_dict(self) -> dict[str, float]:
+        mean_ms = self.total_ms / self.count if self.count else 0.0
+        return {"count": self.count, "mean_ms": mean_ms, "max_ms": self.max_ms, "total_ms": self.total_ms}
+
+
+def _metric_key(name: str, labels: dict[str, Any]) -> str:
+    if not labels:
+        return name
+    formatted_labels = ",".join(f"{label}={value}" for label, value in sorted(labels.items()))
+    return f"{name}{{{formatted_labels}}}"
+
+
+class RuntimeStats:
+    """Registry of counters and timing summaries, keyed by metric name and labels."""
+
+    def __init__(self):
+        self.counters: dict[str, int] = defaultdict(int)
+        self.timings: dict[str, TimingSummary] = defaultdict(TimingSummary)
+        # Functions that report the current state of some component (e.g. cache sizes) when a snapshot is taken
+        self.collectors: dict[str, Callable[[], Any]] = {}
+
+    def increment(self, name: str, amount: int = 1, **labels: Any) -> None:
+        self.counters[_metric_key(name, labels)] += amount
+
+    def observe_ms(self, name: str, value_ms: float, **labels: Any) -> None:
+        self.timings[_metric_key(name, labels)].add(value_ms)
+
+    def register_collector(self, name: str, collector: Callable[[], Any]) -> None:
+        self.collectors[name] = collector
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns a JSON-serializable view of all the statistics for this process."""
+        collected = {}
+        for name, collector in self.collectors.items():
+            try:
+                collected[name] = collector()
+            except Exception as e:  # One broken collector shouldn't hide the rest of the stats
+                logger.error(f"Error collecting runtime stats for {name}: {e}", exc_info=True)
+                collected[name] = {"error": str(e)}
+
+        return {
+            "pid": os.getpid(),
+            "counters": dict(self.counters),
+            "timings": {key: summary.as_dict() for key, summary in self.timings.items()},
+            **collected,
+        }
+
+    def reset(self) -> None:
+        self.counters.clear()
+        self.timings.clear()
+
+
+# Shared by everything running in this process
+runtime_stats = RuntimeStats()
@@ -20,6 +20,7 @@ from app.api.naming import API_BASE_PATH
 from app.core.app_state import AppState
 from app.core.configs import (StreamBackend, StreamConfig,
                               StreamSubmissionMethod)
+from app.core.scheduling import InferenceSource
 
 LOGGER = logging.getLogger(__name__)
 
@@ -147,11 +148,11 @@ class RTSPStreamWorker:
                     self.name,
                 )
                 return
-            await asyncio.to_thread(
-                self.app_state.edge_inference_manager.run_inference,
+            await self.app_state.edge_inference_manager.run_inference_async(
                 self.config.detector_id,
                 payload.data,
                 payload.content_type,
+                source=InferenceSource.STREAM,
             )
         else:
             await self._post_via_api(payload)
@@ -0,0 +1,94 @@
+"""
+Throughput benchmark for the escalation uploader.
+
+Fills a temporary escalation queue with escalations using a `QueueWriter` per simulated edge-endpoint worker, then
+drains it with `EscalationUploader` at several numbers of consumers and concurrency levels, without a rate limit. The
+cloud is replaced by a stub SDK that reads the streamed image and then waits for a fixed time, so the results show how
+well concurrent uploads hide the cloud's round-trip latency, plus the overhead of reading the queue and the images from
+disk. With as many consumers as concurrent uploads, each queue file is uploaded strictly in order.
+
+Run from the repository root with:
+    PYTHONPATH=. python test/benchmarks/bench_escalation_uploader.py
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from app.core.utils import get_formatted_timestamp_str
+from app.escalation_queue.constants import IMAGE_DIR_SUFFIX
+from app.escalation_queue.image_store import ImageSegmentReader
+from app.escalation_queue.models import EscalationInfo, SubmitImageQueryParams
+from app.escalation_queue.queue_reader import QueueReader
+from app.escalation_queue.queue_writer import QueueWriter
+from app.escalation_queue.uploader import EscalationUploader
+
+NUM_ESCALATIONS = 400
+IMAGE_SIZE_BYTES = 100 * 1024
+CLOUD_LATENCY_SEC = 0.05
+NUM_WRITERS = 8
+# Numbers of consumers and concurrent uploads
+CONFIGURATIONS = [(1, 1), (1, 16), (4, 16), (16, 16)]
+
+
+class StubSdk:
+    """Stands in for the IntelliOptics SDK, with a fixed latency per submitted image query."""
+
+    def submit_image_query(self, image, **kwargs) -> None:
+        image.read()
+        time.sleep(CLOUD_LATENCY_SEC)
+
+
+def fill_queue(base_dir: str) -> None:
+    queue_writers = [QueueWriter(base_dir=base_dir) for _ in range(NUM_WRITERS)]
+    image_bytes = os.urandom(IMAGE_SIZE_BYTES)
+    for i in range(NUM_ESCALATIONS):
+        queue_writer = queue_writers[i % NUM_WRITERS]
+        image_path, image_location = queue_writer.append_image(image_bytes)
+        queue_writer.write_escalation(
+            EscalationInfo(
+                timestamp=get_formatted_timestamp_str(),
+                detector_id="det_bench",
+                image_path_str=image_path,
+                image_location=image_location,
+                request_id=f"req_{i}",
+                submit_iq_params=SubmitImageQueryParams(
+                    patience_time=None,
+                    confidence_threshold=0.9,
+                    human_review=None,
+                    metadata=None,
+                    image_query_id=f"iq_bench_{i}",
+                ),
+            )
+        )
+    for queue_writer in queue_writers:
+        queue_writer.close()
+
+
+def main() -> None:
+    for num_consumers, concurrency in CONFIGURATIONS:
+        with tempfile.TemporaryDirectory() as base_dir:
+            fill_queue(base_dir)
+            uploader = EscalationUploader(
+                io=StubSdk(),
+                readers=[QueueReader(base_dir=base_dir) for _ in range(num_consumers)],
+                image_reader=ImageSegmentReader(Path(base_dir, IMAGE_DIR_SUFFIX)),
+                concurrency=concurrency,
+                max_uploads_per_sec=None,
+            )
+            start = time.perf_counter()
+            asyncio.run(uploader.run(max_escalations=NUM_ESCALATIONS))
+            elapsed_sec = time.perf_counter() - start
+            uploader.close()
+            assert uploader.stats.uploaded == NUM_ESCALATIONS, uploader.stats
+            print(
+                f"consumers={num_consumers:>3}, concurrency={concurrency:>3}: "
+                f"{NUM_ESCALATIONS / elapsed_sec:8.1f} escalations/sec"
+            )
+    print(f"(stub cloud latency {CLOUD_LATENCY_SEC * 1000:.0f}ms, {IMAGE_SIZE_BYTES // 1024}KB images)")
+
+
+if __name__ == "__main__":
+    main()
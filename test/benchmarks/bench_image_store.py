@@ -0,0 +1,73 @@
+"""
+Benchmark of storing escalated images in the escalation queue, one file per image versus packed into image segments.
+
+For each, writes a backlog of images with `QueueWriter`, then reads each image back and releases it the way the
+escalation uploader does: by deleting its file, or by acknowledging it, which reclaims segments as they are drained.
+
+Run from the repository root with:
+    PYTHONPATH=. python test/benchmarks/bench_image_store.py
+"""
+
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from app.escalation_queue.constants import IMAGE_DIR_SUFFIX
+from app.escalation_queue.image_store import ImageSegmentReader
+from app.escalation_queue.queue_writer import QueueWriter
+
+NUM_IMAGES = 5000
+IMAGE_SIZE_BYTES = 50 * 1024
+
+
+def bench_files(base_dir: str, image_bytes: bytes) -> tuple[float, float]:
+    queue_writer = QueueWriter(base_dir=base_dir)
+    start = time.perf_counter()
+    image_paths = [
+        queue_writer.write_image_bytes(image_bytes, detector_id="det_bench", timestamp="20250101_000000_000000")
+        for _ in range(NUM_IMAGES)
+    ]
+    write_sec = time.perf_counter() - start
+    queue_writer.close()
+
+    start = time.perf_counter()
+    for image_path in image_paths:
+        with open(image_path, "rb") as image:
+            image.read()
+        Path(image_path).unlink()
+    return write_sec, time.perf_counter() - start
+
+
+def bench_segments(base_dir: str, image_bytes: bytes) -> tuple[float, float]:
+    queue_writer = QueueWriter(base_dir=base_dir)
+    start = time.perf_counter()
+    image_locations = [queue_writer.append_image(image_bytes)[1] for _ in range(NUM_IMAGES)]
+    write_sec = time.perf_counter() - start
+    queue_writer.close()
+
+    image_reader = ImageSegmentReader(Path(base_dir, IMAGE_DIR_SUFFIX))
+    start = time.perf_counter()
+    for image_location in image_locations:
+        with image_reader.open_image(image_location) as image:
+            image.read()
+        image_reader.ack(image_location)
+    read_sec = time.perf_counter() - start
+    assert not list(Path(base_dir, IMAGE_DIR_SUFFIX).iterdir()), "Drained segments weren't reclaimed"
+    return write_sec, read_sec
+
+
+def main() -> None:
+    image_bytes = os.urandom(IMAGE_SIZE_BYTES)
+    for name, bench in (("file per image", bench_files), ("image segments", bench_segments)):
+        with tempfile.TemporaryDirectory() as base_dir:
+            write_sec, read_sec = bench(base_dir, image_bytes)
+        print(
+            f"{name:>15}: write {NUM_IMAGES / write_sec:8.0f} images/sec, "
+            f"read and release {NUM_IMAGES / read_sec:8.0f} images/sec"
+        )
+    print(f"({NUM_IMAGES} images of {IMAGE_SIZE_BYTES // 1024}KB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Microbenchmark for the transport used to send images to the inference services.
+
+Starts a stub inference server in a separate process, listening on both a TCP port and a Unix domain socket, which
+answers every `/infer` request with a fixed response. The measured time is therefore the per-request overhead of the
+transport (copying the image through the kernel and HTTP framing) rather than model time. Requests are sent with
+`submit_image_for_inference_async` over the same pooled clients that the `EdgeInferenceManager` uses.
+
+The TCP numbers here are for loopback. In the cluster, TCP requests also go through the service's DNS name and
+kube-proxy's NAT rules, which this benchmark doesn't reproduce, so the real difference is larger.
+
+Run from the repository root with:
+    PYTHONPATH=. python test/benchmarks/bench_inference_transport.py
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from app.core.configs import EdgeInferenceConfig
+from app.core.edge_inference import create_inference_client, submit_image_for_inference_async
+
+IMAGE_SIZES = {"100KB": 100 * 1024, "2MB": 2 * 1024 * 1024}
+NUM_WARMUP_REQUESTS = 20
+NUM_REQUESTS = 300
+
+STUB_RESPONSE_BODY = json.dumps(
+    {
+        "multi_predictions": None,
+        "predictions": {"confidences": [0.9], "labels": [0], "probabilities": [0.9], "scores": [1.0]},
+    }
+).encode()
+STUB_RESPONSE = (
+    b"HTTP/1.1 200 OK\r\ncontent-type: application/json\r\ncontent-length: "
+    + str(len(STUB_RESPONSE_BODY)).encode()
+    + b"\r\n\r\n"
+    + STUB_RESPONSE_BODY
+)
+
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """A minimal HTTP/1.1 keep-alive server that reads each request body and returns a fixed inference response."""
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            content_length = 0
+            for line in head.split(b"\r\n"):
+                name, _, value = line.partition(b":")
+                if name.strip().lower() == b"content-length":
+                    content_length = int(value)
+            await reader.readexactly(content_length)
+            writer.write(STUB_RESPONSE)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_forever(socket_path: str, port_queue: multiprocessing.Queue) -> None:
+    tcp_server = await asyncio.start_server(handle_connection, "127.0.0.1", 0)
+    await asyncio.start_unix_server(handle_connection, socket_path)
+    port_queue.put(tcp_server.sockets[0].getsockname()[1])
+    await asyncio.Event().wait()
+
+
+def run_stub_server(socket_path: str, port_queue: multiprocessing.Queue) -> None:
+    asyncio.run(serve_forever(socket_path, port_queue))
+
+
+async def time_requests(client, inference_client_url: str, image_bytes: bytes) -> list[float]:
+    for _ in range(NUM_WARMUP_REQUESTS):
+        await submit_image_for_inference_async(client, inference_client_url, image_bytes, "image/jpeg")
+
+    latencies_ms = []
+    for _ in range(NUM_REQUESTS):
+        start = time.perf_counter()
+        await submit_image_for_inference_async(client, inference_client_url, image_bytes, "image/jpeg")
+        latencies_ms.append((time.perf_counter() - start) * 1000)
+    return latencies_ms
+
+
+def summarize(latencies_ms: list[float]) -> str:
+    mean, p50 = statistics.mean(latencies_ms), statistics.median(latencies_ms)
+    p99 = statistics.quantiles(latencies_ms, n=100)[98]
+    return f"mean={mean:7.3f}ms  p50={p50:7.3f}ms  p99={p99:7.3f}ms"
+
+
+async def main() -> None:
+    with tempfile.TemporaryDirectory() as socket_dir:
+        socket_path = os.path.join(socket_dir, "inference-service-bench.sock")
+        port_queue = multiprocessing.Queue()
+        server_process = multiprocessing.Process(target=run_stub_server, args=(socket_path, port_queue), daemon=True)
+        server_process.start()
+        inference_client_url = f"127.0.0.1:{port_queue.get(timeout=10)}"
+
+        inference_config = EdgeInferenceConfig()
+        clients = {
+            "tcp": create_inference_client(inference_config),
+            "unix": create_inference_client(inference_config, uds_path=socket_path),
+        }
+        try:
+            for size_name, num_bytes in IMAGE_SIZES.items():
+                image_bytes = os.urandom(num_bytes)
+                results = {
+                    transport: await time_requests(client, inference_client_url, image_bytes)
+                    for transport, client in clients.items()
+                }
+                for transport, latencies_ms in results.items():
+                    print(f"{size_name:>6} {transport:>5}: {summarize(latencies_ms)}")
+                speedup = statistics.mean(results["tcp"]) / statistics.mean(results["unix"])
+                print(f"{size_name:>6} unix socket is {speedup:.2f}x as fast as tcp\n")
+        finally:
+            for client in clients.values():
+                await client.aclose()
+            server_process.terminate()
+            server_process.join()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+"""
+Throughput benchmark for writing escalations to the escalation queue.
+
+Writes escalations with `QueueWriter` under each fsync policy, with and without group commits, and compares them with
+opening the queue file for every escalation, which is how escalations used to be written.
+
+Run from the repository root with:
+    PYTHONPATH=. python test/benchmarks/bench_queue_writer.py
+"""
+
+import tempfile
+import time
+from pathlib import Path
+
+from app.core.configs import QueueFsyncPolicy
+from app.escalation_queue.models import EscalationInfo, SubmitImageQueryParams
+from app.escalation_queue.queue_writer import QueueWriter, convert_escalation_info_to_str
+
+NUM_ESCALATIONS = 2000
+COMMIT_INTERVAL_SEC = 0.05
+
+
+def make_escalation_info(i: int) -> EscalationInfo:
+    return EscalationInfo(
+        timestamp="2025-01-01T00:00:00",
+        detector_id="det_bench",
+        image_path_str=f"/tmp/det_bench-{i}",
+        request_id=f"req_{i}",
+        submit_iq_params=SubmitImageQueryParams(
+            patience_time=None,
+            confidence_threshold=0.9,
+            human_review=None,
+            metadata=None,
+            image_query_id=f"iq_bench_{i}",
+        ),
+    )
+
+
+def bench_open_per_write(base_dir: str) -> float:
+    path = Path(base_dir, "queue.txt")
+    start = time.perf_counter()
+    for i in range(NUM_ESCALATIONS):
+        with path.open("a") as f:
+            f.write(convert_escalation_info_to_str(make_escalation_info(i)))
+    return time.perf_counter() - start
+
+
+def bench_queue_writer(base_dir: str, commit_interval_sec: float, fsync_policy: QueueFsyncPolicy) -> float:
+    queue_writer = QueueWriter(base_dir=base_dir, commit_interval_sec=commit_interval_sec, fsync_policy=fsync_policy)
+    start = time.perf_counter()
+    for i in range(NUM_ESCALATIONS):
+        queue_writer.write_escalation(make_escalation_info(i))
+    queue_writer.close()  # Includes writing the last group commit
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as base_dir:
+        elapsed_sec = bench_open_per_write(base_dir)
+    print(f"{'open per write':>32}: {NUM_ESCALATIONS / elapsed_sec:10.1f} escalations/sec")
+    for fsync_policy in QueueFsyncPolicy:
+        for commit_interval_sec in (0.0, COMMIT_INTERVAL_SEC):
+            with tempfile.TemporaryDirectory() as base_dir:
+                elapsed_sec = bench_queue_writer(base_dir, commit_interval_sec, fsync_policy)
+            label = f"fsync={fsync_policy.value}, interval={commit_interval_sec}"
+            print(f"{label:>32}: {NUM_ESCALATIONS / elapsed_sec:10.1f} escalations/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import pytest
+
+from app.core import circuit_breaker as circuit_breaker_module
+from app.core.circuit_breaker import BreakerState, CircuitBreaker
+
+OPEN_DURATION_SEC = 10.0
+MAX_OPEN_DURATION_SEC = 35.0
+SLOW_CALL_MS = 500.0
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture()
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    fake_clock = FakeClock()
+    monkeypatch.setattr(circuit_breaker_module.time, "monotonic", fake_clock)
+    return fake_clock
+
+
+@pytest.fixture()
+def breaker(clock: FakeClock) -> CircuitBreaker:
+    return CircuitBreaker(
+        name="http://inference",
+        window_sec=30.0,
+        min_requests=4,
+        error_rate_threshold=0.5,
+        slow_call_ms=SLOW_CALL_MS,
+        open_duration_sec=OPEN_DURATION_SEC,
+        max_open_duration_sec=MAX_OPEN_DURATION_SEC,
+    )
+
+
+def _open(breaker: CircuitBreaker) -> None:
+    for _ in range(breaker.min_requests):
+        assert breaker.allow_request()
+        breaker.record_failure()
+    assert breaker.state == BreakerState.OPEN
+
+
+def test_breaker_opens_once_enough_recent_calls_failed(breaker: CircuitBreaker):
+    for _ in range(2):
+        assert breaker.allow_request()
+        breaker.record_success(latency_ms=10)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    # 1 of 3 calls failed, and there aren't enough calls to judge yet
+    assert breaker.state == BreakerState.CLOSED
+
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == BreakerState.OPEN
+    assert breaker.rejects_requests()
+    assert not breaker.allow_request()
+
+
+def test_failures_outside_the_window_are_forgotten(breaker: CircuitBreaker, clock: FakeClock):
+    for _ in range(breaker.min_requests - 1):
+        assert breaker.allow_request()
+        breaker.record_failure()
+    clock.advance(breaker.window_sec + 1)
+
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == BreakerState.CLOSED
+    assert breaker.stats()["recent_failures"] == 1
+
+
+def test_slow_calls_count_as_failures(breaker: CircuitBreaker):
+    for _ in range(breaker.min_requests):
+        assert breaker.allow_request()
+        breaker.record_success(latency_ms=SLOW_CALL_MS + 1)
+    assert breaker.state == BreakerState.OPEN
+
+
+def test_open_breaker_lets_a_single_probe_through_once_the_open_interval_passed(
+    breaker: CircuitBreaker, clock: FakeClock
+):
+    _open(breaker)
+    clock.advance(OPEN_DURATION_SEC - 1)
+    assert not breaker.allow_request()
+
+    clock.advance(1)
+    assert not breaker.rejects_requests()
+    assert breaker.allow_request()
+    assert breaker.state == BreakerState.HALF_OPEN
+    # Only the probe goes through until it finishes
+    assert breaker.rejects_requests()
+    assert not breaker.allow_request()
+
+    breaker.record_success(latency_ms=10)
+    assert breaker.state == BreakerState.CLOSED
+    assert breaker.allow_request()
+    assert breaker.allow_request()
+
+
+def test_failed_probes_double_the_open_duration_up_to_the_maximum(breaker: CircuitBreaker, clock: FakeClock):
+    _open(breaker)
+    open_durations = []
+    for _ in range(4):
+        clock.advance(breaker.current_open_duration_sec)
+        assert breaker.allow_request()
+        breaker.record_failure()
+        assert breaker.state == BreakerState.OPEN
+        open_durations.append(breaker.current_open_duration_sec)
+    assert open_durations == [20.0, MAX_OPEN_DURATION_SEC, MAX_OPEN_DURATION_SEC, MAX_OPEN_DURATION_SEC]
+
+    # The breaker stays open for the whole doubled duration
+    clock.advance(MAX_OPEN_DURATION_SEC - 1)
+    assert not breaker.allow_request()
+
+    # A successful probe closes the breaker, and the next time it opens, it's for the initial duration
+    clock.advance(1)
+    assert breaker.allow_request()
+    breaker.record_success(latency_ms=10)
+    assert breaker.state == BreakerState.CLOSED
+    _open(breaker)
+    assert breaker.current_open_duration_sec == OPEN_DURATION_SEC
+
+
+def test_slow_probe_reopens_the_breaker(breaker: CircuitBreaker, clock: FakeClock):
+    _open(breaker)
+    clock.advance(OPEN_DURATION_SEC)
+    assert breaker.allow_request()
+    breaker.record_success(latency_ms=SLOW_CALL_MS + 1)
+    assert breaker.state == BreakerState.OPEN
+    assert breaker.current_open_duration_sec == 2 * OPEN_DURATION_SEC
+
+
+def test_cancelled_probe_lets_another_probe_through(breaker: CircuitBreaker, clock: FakeClock):
+    _open(breaker)
+    clock.advance(OPEN_DURATION_SEC)
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+    breaker.record_cancelled()
+    assert breaker.state == BreakerState.HALF_OPEN
+    assert breaker.allow_request()
+    breaker.record_success(latency_ms=10)
+    assert breaker.state == BreakerState.CLOSED
+
+
+def test_calls_that_started_before_the_breaker_opened_dont_change_it(breaker: CircuitBreaker):
+    for _ in range(breaker.min_requests + 1):
+        assert breaker.allow_request()
+    for _ in range(breaker.min_requests):
+        breaker.record_failure()
+    assert breaker.state == BreakerState.OPEN
+    opened_at = breaker.opened_at
+
+    breaker.record_failure()
+    assert breaker.state == BreakerState.OPEN
+    assert breaker.opened_at == opened_at
+    assert breaker.current_open_duration_sec == OPEN_DURATION_SEC
@@ -0,0 +1,135 @@
+import copy
+import random
+
+import pytest
+
+from app.core.edge_inference import get_inference_result, get_inference_results_batch
+
+
+def _binary_response(confidence: float | None, label: int) -> dict:
+    return {
+        "multi_predictions": None,
+        "predictions": {"confidences": [confidence], "labels": [label], "probabilities": [0.5], "scores": [0.0]},
+        "secondary_predictions": None,
+    }
+
+
+def _multiclass_response(probabilities: list[float], rois: list[dict] | None = None, text: str | None = None) -> dict:
+    secondary_predictions = None
+    if rois is not None or text is not None:
+        secondary_predictions = {
+            "roi_predictions": {"rois": [rois]} if rois is not None else None,
+            "text_predictions": [text] if text is not None else None,
+        }
+    return {
+        "multi_predictions": {"probabilities": [probabilities]},
+        "predictions": None,
+        "secondary_predictions": secondary_predictions,
+    }
+
+
+def _roi(left: float, right: float, top: float, bottom: float) -> dict:
+    return {
+        "label": "object",
+        "score": 0.9,
+        "geometry": {"left": left, "right": right, "top": top, "bottom": bottom},
+    }
+
+
+def _oodd_response(confidence: float | None, label: int) -> dict:
+    return _binary_response(confidence, label)
+
+
+def _assert_batch_matches_scalar(primary_responses: list[dict], oodd_responses: list[dict]) -> None:
+    # Parsing updates the ROI geometries in place, so each path gets its own copy of the responses
+    expected = [
+        get_inference_result(primary, oodd)
+        for primary, oodd in zip(copy.deepcopy(primary_responses), copy.deepcopy(oodd_responses))
+    ]
+    actual = get_inference_results_batch(copy.deepcopy(primary_responses), copy.deepcopy(oodd_responses))
+    # `==` on floats is exact, so the adjusted confidences must be bit-for-bit identical
+    assert actual == expected
+
+
+def test_binary_results_match_the_scalar_path():
+    primary_responses = [_binary_response(0.54, 0), _binary_response(0.97, 1), _binary_response(0.5, 1)]
+    oodd_responses = [_oodd_response(0.8, 0), _oodd_response(0.65, 1), _oodd_response(0.5, 0)]
+    _assert_batch_matches_scalar(primary_responses, oodd_responses)
+
+
+def test_multiclass_results_with_ties_match_the_scalar_path():
+    primary_responses = [
+        _multiclass_response([0.2, 0.5, 0.3]),
+        # Ties go to the first class with the maximum probability
+        _multiclass_response([0.4, 0.4, 0.2]),
+        _multiclass_response([0.25, 0.25, 0.25, 0.25]),
+        # Detectors in the same batch may have a different number of classes
+        _multiclass_response([0.1, 0.9]),
+    ]
+    oodd_responses = [_oodd_response(0.9, 0), _oodd_response(0.3, 1), _oodd_response(0.5, 1), _oodd_response(0.7, 0)]
+    _assert_batch_matches_scalar(primary_responses, oodd_responses)
+
+    results = get_inference_results_batch(copy.deepcopy(primary_responses), copy.deepcopy(oodd_responses))
+    assert [result["label"] for result in results] == [1, 0, 0, 1]
+
+
+def test_count_results_with_rois_and_text_match_the_scalar_path():
+    primary_responses = [
+        _multiclass_response([0.1, 0.2, 0.7], rois=[_roi(0.1, 0.3, 0.2, 0.6), _roi(0.5, 0.9, 0.0, 0.1)]),
+        _multiclass_response([0.6, 0.3, 0.1], rois=[]),
+        _multiclass_response([0.3, 0.7], rois=[_roi(0.0, 1.0, 0.0, 1.0)], text="ABC 123"),
+        _binary_response(0.8, 1),
+    ]
+    oodd_responses = [_oodd_response(0.95, 0), _oodd_response(0.2, 1), _oodd_response(0.6, 0), _oodd_response(0.9, 0)]
+    _assert_batch_matches_scalar(primary_responses, oodd_responses)
+
+    results = get_inference_results_batch(copy.deepcopy(primary_responses), copy.deepcopy(oodd_responses))
+    assert results[0]["rois"][0]["geometry"]["x"] == pytest.approx(0.2)
+    assert results[0]["rois"][0]["geometry"]["y"] == pytest.approx(0.4)
+    assert results[2]["text"] == "ABC 123"
+
+
+def test_results_with_none_confidences_match_the_scalar_path():
+    primary_responses = [
+        _binary_response(None, 0),
+        _binary_response(0.7, 1),
+        _binary_response(None, 1),
+        _multiclass_response([0.3, 0.7]),
+    ]
+    oodd_responses = [_oodd_response(0.9, 0), _oodd_response(None, 1), _oodd_response(None, 0), _oodd_response(0.8, 1)]
+    _assert_batch_matches_scalar(primary_responses, oodd_responses)
+
+    results = get_inference_results_batch(copy.deepcopy(primary_responses), copy.deepcopy(oodd_responses))
+    # Results with a missing confidence are returned unadjusted
+    assert [result["confidence"] for result in results[:3]] == [None, 0.7, None]
+    assert all("raw_oodd_prediction" not in result for result in results[:3])
+
+
+def test_random_batches_match_the_scalar_path():
+    rng = random.Random(0)
+
+    def random_probabilities() -> list[float]:
+        num_classes = rng.randint(2, 6)
+        # Rounded so that ties happen regularly
+        weights = [round(rng.random(), 1) for _ in range(num_classes)]
+        total = sum(weights) or 1.0
+        return [weight / total for weight in weights]
+
+    def random_primary_response() -> dict:
+        kind = rng.choice(["binary", "multiclass", "count"])
+        if kind == "binary":
+            return _binary_response(rng.choice([None, rng.random()]), rng.randint(0, 1))
+        if kind == "multiclass":
+            return _multiclass_response(random_probabilities())
+        rois = [
+            _roi(*sorted(rng.random() for _ in range(2)), *sorted(rng.random() for _ in range(2))) for _ in range(3)
+        ]
+        return _multiclass_response(random_probabilities(), rois=rois[: rng.randint(0, 3)])
+
+    for _ in range(20):
+        batch_size = rng.randint(1, 16)
+        primary_responses = [random_primary_response() for _ in range(batch_size)]
+        oodd_responses = [
+            _oodd_response(rng.choice([None, rng.random()]), rng.randint(0, 1)) for _ in range(batch_size)
+        ]
+        _assert_batch_matches_scalar(primary_responses, oodd_responses)
@@ -0,0 +1,126 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from model import ImageQuery, ModeEnum
+
+from app.core import utils as utils_module
+from app.core.utils import EdgeImageQueryTemplate, create_iq, prefixed_ksuid
+
+# The field FastAPI builds for `response_model=ImageQuery` on the image query route
+RESPONSE_FIELD = create_model_field(name="Response_post_image_query", type_=ImageQuery, mode="serialization")
+
+DETECTORS = {
+    "binary": (ModeEnum.BINARY, None),
+    "count": (ModeEnum.COUNT, {"max_count": 10}),
+    "count_without_max": (ModeEnum.COUNT, {"max_count": None}),
+    "multiclass": (ModeEnum.MULTI_CLASS, {"class_names": ["red", "yellow", "green"]}),
+}
+ROIS = [
+    {"x": 0.25, "y": 0.5, "width": 0.1, "height": 0.2, "label": "car", "confidence": 0.87},
+    {"x": 0.75, "y": 0.1, "width": 0.3, "height": 0.05, "label": None, "confidence": None},
+]
+
+
+@pytest.fixture(
+    params=[datetime(2026, 1, 2, 3, 4, 5, 678901, tzinfo=timezone.utc), datetime(2026, 1, 2, tzinfo=timezone.utc)]
+)
+def frozen_now(request: pytest.FixtureRequest, monkeypatch: pytest.MonkeyPatch) -> datetime:
+    now = request.param
+
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+
+    monkeypatch.setattr(utils_module, "datetime", FrozenDatetime)
+    return now
+
+
+def _fastapi_response(**create_iq_kwargs) -> bytes:
+    """What FastAPI sends for the `create_iq` ImageQuery, returned from a route with `response_model=ImageQuery`."""
+    extra_metadata = create_iq_kwargs.pop("extra_metadata", None)
+    image_query = create_iq(**create_iq_kwargs)
+    if extra_metadata:
+        image_query.metadata.update(extra_metadata)
+    content = asyncio.run(serialize_response(field=RESPONSE_FIELD, response_content=image_query))
+    return JSONResponse(content=content).body
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+@pytest.mark.parametrize("result_value", [0, 1, 2, 11])
+@pytest.mark.parametrize("rois, text", [(None, None), (ROIS, None), ([], "ABC 123"), (ROIS, "Ünïcode “text”")])
+@pytest.mark.parametrize("extra_metadata", [None, {"from_edge_cache": True}])
+@pytest.mark.parametrize("is_done_processing", [True, False])
+def test_rendered_json_matches_fastapi_serialization(
+    frozen_now: datetime,
+    detector: str,
+    result_value: int,
+    rois: list[dict] | None,
+    text: str | None,
+    extra_metadata: dict | None,
+    is_done_processing: bool,
+):
+    mode, mode_configuration = DETECTORS[detector]
+    if mode == ModeEnum.MULTI_CLASS and result_value >= len(mode_configuration["class_names"]):
+        pytest.skip("Not a valid class index")
+    query = "Is the “door” open?"
+    image_query_id = prefixed_ksuid(prefix="iq_")
+    iq_template = EdgeImageQueryTemplate(
+        detector_id="det_abc", mode=mode, mode_configuration=mode_configuration, query=query
+    )
+
+    rendered = iq_template.render_json(
+        image_query_id=image_query_id,
+        result_value=result_value,
+        confidence=0.9300000000000002,
+        confidence_threshold=0.9,
+        is_done_processing=is_done_processing,
+        rois=rois,
+        text=text,
+        extra_metadata=extra_metadata,
+    )
+    expected = _fastapi_response(
+        detector_id="det_abc",
+        mode=mode,
+        mode_configuration=mode_configuration,
+        result_value=result_value,
+        confidence=0.9300000000000002,
+        confidence_threshold=0.9,
+        is_done_processing=is_done_processing,
+        query=query,
+        rois=rois,
+        text=text,
+        image_query_id=image_query_id,
+        extra_metadata=extra_metadata,
+    )
+    assert rendered == expected
+
+
+@pytest.mark.parametrize("confidence, patience_time", [(1, 30), (0.5, 12.5), (1e-7, None)])
+def test_rendered_numbers_match_fastapi_serialization(frozen_now: datetime, confidence: float, patience_time):
+    mode, mode_configuration = DETECTORS["count"]
+    iq_template = EdgeImageQueryTemplate(detector_id="det_abc", mode=mode, mode_configuration=mode_configuration)
+    rendered = iq_template.render_json(
+        image_query_id="iq_abc",
+        result_value=3,
+        confidence=confidence,
+        confidence_threshold=1,
+        is_done_processing=True,
+        patience_time=patience_time,
+    )
+    expected = _fastapi_response(
+        detector_id="det_abc",
+        mode=mode,
+        mode_configuration=mode_configuration,
+        result_value=3,
+        confidence=confidence,
+        confidence_threshold=1,
+        is_done_processing=True,
+        patience_time=patience_time,
+        image_query_id="iq_abc",
+    )
+    assert rendered == expected
@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from app.core.configs import GlobalConfig
+from app.core.escalation_dispatcher import Escalation, EscalationDispatcher
+from app.escalation_queue.constants import IMAGE_DIR_SUFFIX
+from app.escalation_queue.image_store import ImageSegmentReader
+from app.escalation_queue.models import SubmitImageQueryParams
+from app.escalation_queue.queue_writer import QueueWriter
+
+
+def _escalation(image_query_id: str = "iq_abc") -> Escalation:
+    return Escalation(
+        detector_id="det_abc",
+        image_bytes=b"image",
+        io=None,
+        submit_iq_params=SubmitImageQueryParams(
+            patience_time=None,
+            confidence_threshold=0.9,
+            human_review=None,
+            metadata=None,
+            image_query_id=image_query_id,
+        ),
+        is_audit=False,
+    )
+
+
+@pytest.fixture()
+def queue_writer(tmp_path: Path):
+    writer = QueueWriter(base_dir=str(tmp_path))
+    yield writer
+    writer.close()
+
+
+def test_cancelled_submit_gives_back_its_place_in_the_queue(queue_writer: QueueWriter, monkeypatch: pytest.MonkeyPatch):
+    writing = threading.Event()
+    may_finish_writing = threading.Event()
+    append_image = queue_writer.append_image
+
+    def slow_append_image(image_bytes: bytes):
+        writing.set()
+        may_finish_writing.wait(timeout=5)
+        return append_image(image_bytes)
+
+    monkeypatch.setattr(queue_writer, "append_image", slow_append_image)
+
+    async def main():
+        dispatcher = EscalationDispatcher(GlobalConfig(escalation_queue_size=1), queue_writer=queue_writer)
+        submit = asyncio.ensure_future(dispatcher.submit(_escalation()))
+        await asyncio.to_thread(writing.wait, 5)
+        assert dispatcher.stats()["queue_depth"] == 1
+        submit.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await submit
+        may_finish_writing.set()
+
+        assert dispatcher.stats()["queue_depth"] == 0
+        assert dispatcher.accepts(is_audit=False)
+        assert all(not shard.escalations for shard in dispatcher._shards)
+        await dispatcher.stop()
+
+    asyncio.run(main())
+
+
+def _wait_for(condition, timeout_sec: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout_sec
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out waiting for the condition"
+        time.sleep(0.01)
+
+
+def test_image_of_an_escalation_that_couldnt_be_written_is_acknowledged(
+    tmp_path: Path, queue_writer: QueueWriter, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(queue_writer, "write_escalation", lambda escalation_info, on_commit_failed=None: False)
+    dispatcher = EscalationDispatcher(GlobalConfig(), queue_writer=queue_writer)
+    escalation = _escalation()
+
+    assert dispatcher._write_to_queue(escalation, is_dispatched=True) == "write_failed"
+    assert escalation.queued_image is None
+
+    queue_writer.close()
+    image_reader = ImageSegmentReader(tmp_path / IMAGE_DIR_SUFFIX)
+    assert image_reader.reclaim_drained_segments() == 1
+    assert list((tmp_path / IMAGE_DIR_SUFFIX).iterdir()) == []
+
+
+def test_escalation_whose_group_commit_failed_is_no_longer_considered_queued(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    queue_writer = QueueWriter(base_dir=str(tmp_path), commit_interval_sec=0.01)
+
+    def fail_to_open_file():
+        raise OSError("disk full")
+
+    monkeypatch.setattr(queue_writer, "_get_file_to_write_to", fail_to_open_file)
+    image_locations = []
+    append_image = queue_writer.append_image
+
+    def recording_append_image(image_bytes: bytes):
+        image_path, image_location = append_image(image_bytes)
+        image_locations.append(image_location)
+        return image_path, image_location
+
+    monkeypatch.setattr(queue_writer, "append_image", recording_append_image)
+    dispatcher = EscalationDispatcher(GlobalConfig(), queue_writer=queue_writer)
+    escalation = _escalation()
+    try:
+        # The writer accepts the escalation, and fails to write it in the next group commit
+        assert dispatcher._write_to_queue(escalation, is_dispatched=True) is None
+
+        # The dispatcher keeps the escalation, and the image, which nothing refers to, is acknowledged
+        _wait_for(lambda: escalation.queued_image is None)
+        _wait_for(lambda: queue_writer._image_acks.is_acked(image_locations[0]))
+        assert queue_writer.quota.stats()["records"] == 0
+    finally:
+        queue_writer.close()
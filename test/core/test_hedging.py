@@ -0,0 +1,92 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.core import hedging as hedging_module
+from app.core.configs import EdgeInferenceConfig
+from app.core.hedging import RequestHedger
+from app.core.speedmon import SpeedMonitor
+
+INFERENCE_CONFIG = EdgeInferenceConfig(hedge_to_cloud=True, hedge_min_delay_ms=10, max_hedge_rate=1.0)
+
+
+@pytest.fixture(autouse=True)
+def no_activity_metrics(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(hedging_module, "record_activity_for_metrics", lambda detector_id, activity_type: None)
+
+
+async def _slow_edge_inference(confidence: float) -> dict:
+    await asyncio.sleep(0.05)
+    return {"confidence": confidence}
+
+
+def test_cloud_failure_after_the_edge_answer_won_escalates_the_returned_id():
+    cloud_may_fail = threading.Event()
+    escalated = []
+
+    def submit_to_cloud(image_query_id: str, wait: float):
+        cloud_may_fail.wait(timeout=5)
+        raise RuntimeError("cloud unavailable")
+
+    async def escalate(image_query_id: str) -> None:
+        escalated.append(image_query_id)
+
+    async def main():
+        hedger = RequestHedger(speedmon=SpeedMonitor())
+        outcome = await hedger.run(
+            detector_id="det_abc",
+            inference_config=INFERENCE_CONFIG,
+            edge_inference=_slow_edge_inference(confidence=0.95),
+            submit_to_cloud=submit_to_cloud,
+            is_usable=lambda edge_results: edge_results["confidence"] >= 0.9,
+            is_cloud_usable=lambda iq: True,
+            escalate=escalate,
+        )
+        assert outcome.edge_results == {"confidence": 0.95}
+        assert outcome.image_query_id is not None
+        assert escalated == []
+
+        cloud_may_fail.set()
+        for _ in range(100):
+            if escalated:
+                break
+            await asyncio.sleep(0.01)
+        return hedger, outcome
+
+    hedger, outcome = asyncio.run(main())
+    assert escalated == [outcome.image_query_id]
+    assert hedger.stats["det_abc"].edge_wins == 1
+    assert hedger.stats["det_abc"].late_cloud_failures == 1
+
+
+def test_cloud_success_after_the_edge_answer_won_isnt_escalated_again():
+    cloud_may_answer = threading.Event()
+    escalated = []
+
+    def submit_to_cloud(image_query_id: str, wait: float):
+        cloud_may_answer.wait(timeout=5)
+        return object()
+
+    async def escalate(image_query_id: str) -> None:
+        escalated.append(image_query_id)
+
+    async def main():
+        hedger = RequestHedger(speedmon=SpeedMonitor())
+        outcome = await hedger.run(
+            detector_id="det_abc",
+            inference_config=INFERENCE_CONFIG,
+            edge_inference=_slow_edge_inference(confidence=0.95),
+            submit_to_cloud=submit_to_cloud,
+            is_usable=lambda edge_results: edge_results["confidence"] >= 0.9,
+            is_cloud_usable=lambda iq: True,
+            escalate=escalate,
+        )
+        cloud_may_answer.set()
+        await asyncio.sleep(0.1)
+        return hedger, outcome
+
+    hedger, outcome = asyncio.run(main())
+    assert outcome.edge_results == {"confidence": 0.95}
+    assert escalated == []
+    assert hedger.stats["det_abc"].late_cloud_failures == 0
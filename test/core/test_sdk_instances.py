@@ -0,0 +1,64 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.core.sdk_instances import SdkInstanceCache
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keeps connections open between requests
+
+    def do_GET(self):
+        body = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture()
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def sdk_instances():
+    cache = SdkInstanceCache(maxsize=2)
+    yield cache
+    cache.close()
+
+
+def test_sdk_instances_reuse_the_shared_clients_connections(server_url: str, sdk_instances: SdkInstanceCache):
+    # Instances for different API tokens send their requests over the same connection
+    for api_token in ["token_a", "token_b", "token_a"]:
+        sdk_instances.get(api_token)._client.get(f"{server_url}/v1/me")
+
+    stats = sdk_instances.stats()
+    assert (stats["requests"], stats["connections_opened"]) == (3, 1)
+    assert stats["connection_reuse_rate"] == pytest.approx(2 / 3)
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+
+def test_evicting_an_sdk_instance_keeps_the_shared_clients_connections(
+    server_url: str, sdk_instances: SdkInstanceCache
+):
+    sdk_instances.get("token_a")._client.get(f"{server_url}/v1/me")
+    for api_token in ["token_b", "token_c"]:
+        sdk_instances.get(api_token)
+
+    # The instance for token_a was evicted, and the instance created for it anew reuses its connection
+    sdk_instances.get("token_a")._client.get(f"{server_url}/v1/me")
+
+    stats = sdk_instances.stats()
+    assert stats["evictions"] == 2
+    assert (stats["requests"], stats["connections_opened"]) == (2, 1)
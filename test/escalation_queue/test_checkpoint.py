@@ -0,0 +1,47 @@
+from pathlib import Path
+
+from app.escalation_queue.checkpoint import CHECKPOINT_MAGIC, QueueCheckpoint, read_consumed_offset
+from app.escalation_queue.constants import READING_DIR_SUFFIX, TRACKING_FILE_NAME_PREFIX
+from app.escalation_queue.queue_reader import QueueReader
+
+QUEUE_FILE_NAME = f"20260101_000000_000000-{'A' * 27}.txt"
+LINES = [f"escalation {i}\n" for i in range(5)]
+
+
+def _write_legacy_queue_file(base_dir: Path, num_consumed_lines: int) -> tuple[Path, Path]:
+    """Writes a queue file being read by an older version of the reader, which recorded a "1" per consumed line."""
+    reading_dir = base_dir / READING_DIR_SUFFIX
+    reading_dir.mkdir(parents=True)
+    data_path = reading_dir / QUEUE_FILE_NAME
+    data_path.write_text("".join(LINES))
+    tracker_path = reading_dir / f"{TRACKING_FILE_NAME_PREFIX}{QUEUE_FILE_NAME}"
+    tracker_path.write_text("1" * num_consumed_lines)
+    return data_path, tracker_path
+
+
+def test_legacy_tracking_file_is_converted_to_a_checkpoint(tmp_path: Path):
+    data_path, tracker_path = _write_legacy_queue_file(tmp_path, num_consumed_lines=3)
+    consumed_offset = sum(len(line) for line in LINES[:3])
+    assert read_consumed_offset(tracker_path, data_path) == consumed_offset
+
+    with QueueCheckpoint(tracker_path, data_path, commit_every_lines=1, commit_interval_sec=60) as checkpoint:
+        assert (checkpoint.offset, checkpoint.num_lines) == (consumed_offset, 3)
+    assert tracker_path.read_bytes().startswith(CHECKPOINT_MAGIC)
+    assert read_consumed_offset(tracker_path, data_path) == consumed_offset
+
+    # Reopening the converted checkpoint finds the same progress
+    with QueueCheckpoint(tracker_path, data_path, commit_every_lines=1, commit_interval_sec=60) as checkpoint:
+        assert (checkpoint.offset, checkpoint.num_lines) == (consumed_offset, 3)
+
+
+def test_reader_resumes_a_file_with_a_legacy_tracking_file(tmp_path: Path):
+    _write_legacy_queue_file(tmp_path, num_consumed_lines=2)
+    reader = QueueReader(base_dir=str(tmp_path), event_driven=False, consumer_id="reader")
+    try:
+        lines = iter(reader)
+        assert [next(lines) for _ in range(3)] == LINES[2:]
+        reader.stop()
+        assert list(lines) == []
+    finally:
+        reader.close()
+    assert list((tmp_path / READING_DIR_SUFFIX).iterdir()) == []
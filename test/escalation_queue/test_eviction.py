@@ -0,0 +1,197 @@
+from pathlib import Path
+
+import pytest
+
+from app.escalation_queue import eviction as eviction_module
+from app.escalation_queue.checkpoint import QueueCheckpoint
+from app.escalation_queue.constants import (EVICTING_DIR_SUFFIX,
+                                            IMAGE_DIR_SUFFIX,
+                                            LEASE_NAME_SEPARATOR,
+                                            READING_DIR_SUFFIX,
+                                            TRACKING_FILE_NAME_PREFIX,
+                                            WRITING_DIR_SUFFIX)
+from app.escalation_queue.eviction import QueueEvictor, count_queue_usage
+from app.escalation_queue.image_store import ImageSegmentReader, ImageSegmentWriter
+from app.escalation_queue.models import EscalationInfo, SubmitImageQueryParams
+from app.escalation_queue.queue_writer import convert_escalation_info_to_str
+from app.escalation_queue.quota import QueueQuota, escalation_size_bytes
+
+IMAGE_SEGMENT_SIZE_BYTES = 1024 * 1024
+
+
+def _queue_file_name(i: int) -> str:
+    return f"20260101_000000_{i:06d}-{'A' * 27}.txt"
+
+
+class QueueFiller:
+    """Writes escalations, with their images in a segment, to queue files, as the edge endpoint's writers do."""
+
+    def __init__(self, base_dir: Path) -> None:
+        self.base_dir = base_dir
+        self.image_writer = ImageSegmentWriter(base_dir / IMAGE_DIR_SUFFIX, IMAGE_SEGMENT_SIZE_BYTES)
+        self.image_writer.image_dir.mkdir(parents=True, exist_ok=True)
+        (base_dir / WRITING_DIR_SUFFIX).mkdir(parents=True, exist_ok=True)
+        self._num_escalations = 0
+
+    def escalation(self, is_audit: bool = False) -> tuple[bytes, EscalationInfo]:
+        self._num_escalations += 1
+        image_bytes = b"image" * self._num_escalations  # Images of different sizes, so that the sums can't be mixed up
+        image_location = self.image_writer.append(image_bytes)
+        escalation_info = EscalationInfo(
+            timestamp="2026-01-01T00:00:00",
+            detector_id="det_abc",
+            image_path_str=str(self.image_writer.segment_path),
+            request_id=f"req_{self._num_escalations}",
+            submit_iq_params=SubmitImageQueryParams(
+                patience_time=None,
+                confidence_threshold=0.9,
+                human_review=None,
+                metadata=None,
+                image_query_id=f"iq_{self._num_escalations}",
+            ),
+            image_location=image_location,
+            is_audit=is_audit,
+        )
+        return convert_escalation_info_to_str(escalation_info).encode(), escalation_info
+
+    def write_file(
+        self, i: int, audits: list[bool], dir_suffix: str = WRITING_DIR_SUFFIX, name_suffix: str = ""
+    ) -> tuple[Path, list[tuple[bytes, EscalationInfo]]]:
+        escalations = [self.escalation(is_audit) for is_audit in audits]
+        path = self.base_dir / dir_suffix / f"{_queue_file_name(i)}{name_suffix}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"".join(line for line, _escalation_info in escalations))
+        return path, escalations
+
+
+def _usage(escalations: list[tuple[bytes, EscalationInfo]]) -> tuple[int, int]:
+    return sum(escalation_size_bytes(line, escalation_info) for line, escalation_info in escalations), len(escalations)
+
+
+@pytest.fixture(autouse=True)
+def no_final_read_delay(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(eviction_module, "FINAL_READ_DELAY_SEC", 0)
+
+
+@pytest.fixture()
+def filler(tmp_path: Path):
+    filler = QueueFiller(tmp_path)
+    yield filler
+    filler.image_writer.seal()
+
+
+@pytest.fixture()
+def evictor(tmp_path: Path):
+    quota = QueueQuota(str(tmp_path))
+    image_reader = ImageSegmentReader(tmp_path / IMAGE_DIR_SUFFIX)
+    yield QueueEvictor(str(tmp_path), quota, image_reader)
+    image_reader.close()
+    quota.close()
+
+
+def test_count_queue_usage_skips_consumed_lines(tmp_path: Path, filler: QueueFiller):
+    _writing_path, writing_escalations = filler.write_file(0, [False, True])
+    reading_path, reading_escalations = filler.write_file(
+        1, [False, False, True, False], dir_suffix=READING_DIR_SUFFIX, name_suffix=f"{LEASE_NAME_SEPARATOR}reader"
+    )
+    # The reader has consumed the first two lines of the file it's reading
+    tracker_path = reading_path.with_name(f"{TRACKING_FILE_NAME_PREFIX}{_queue_file_name(1)}")
+    with QueueCheckpoint(tracker_path, reading_path, commit_every_lines=1, commit_interval_sec=60) as checkpoint:
+        checkpoint.advance([line for line, _escalation_info in reading_escalations[:2]])
+
+    assert count_queue_usage(str(tmp_path)) == _usage(writing_escalations + reading_escalations[2:])
+
+
+def test_count_queue_usage_counts_invalid_lines_by_their_length(tmp_path: Path, filler: QueueFiller):
+    path, escalations = filler.write_file(0, [False])
+    invalid_line = b"not an escalation\n"
+    with path.open("ab") as queue_file:
+        queue_file.write(invalid_line)
+
+    num_bytes, num_records = _usage(escalations)
+    assert count_queue_usage(str(tmp_path)) == (num_bytes + len(invalid_line), num_records + 1)
+
+
+def test_queue_under_its_quota_isnt_evicted(filler: QueueFiller, evictor: QueueEvictor):
+    _path, escalations = filler.write_file(0, [True, False])
+    evictor.quota.set_limits(max_bytes=0, max_records=len(escalations))
+    evictor.recover()
+
+    assert evictor.evict_if_over_quota() == 0
+    assert evictor.quota.stats()["records"] == len(escalations)
+
+
+def test_audits_are_evicted_before_escalations(tmp_path: Path, filler: QueueFiller, evictor: QueueEvictor):
+    audits = [True, False, True, False, False]
+    path, escalations = filler.write_file(0, audits)
+    evictor.recover()
+    # Evicting the two audits brings the queue back under EVICTION_TARGET_FRACTION of its quota
+    evictor.quota.set_limits(max_bytes=0, max_records=len(escalations) - 1)
+
+    assert evictor.evict_if_over_quota() == 2
+
+    kept = [escalation for escalation, is_audit in zip(escalations, audits) if not is_audit]
+    assert path.read_bytes() == b"".join(line for line, _escalation_info in kept)
+    for (_line, escalation_info), is_audit in zip(escalations, audits):
+        assert evictor.image_reader.is_acked(escalation_info.image_location) == is_audit
+    stats = evictor.quota.stats()
+    assert (stats["bytes"], stats["records"]) == _usage(kept)
+    assert stats["evicted_records"] == 2
+    assert list((tmp_path / EVICTING_DIR_SUFFIX).iterdir()) == []
+
+
+def test_escalations_are_evicted_oldest_first_once_there_are_no_audits_left(filler: QueueFiller, evictor: QueueEvictor):
+    oldest_path, oldest_escalations = filler.write_file(0, [False, True])
+    newest_path, newest_escalations = filler.write_file(1, [False, False, False, False])
+    evictor.recover()
+    # Evicting the audit isn't enough, and evicting the oldest file's escalation is
+    evictor.quota.set_limits(max_bytes=0, max_records=5)
+
+    assert evictor.evict_if_over_quota() == 2
+
+    assert not oldest_path.exists()
+    assert newest_path.read_bytes() == b"".join(line for line, _escalation_info in newest_escalations)
+    for _line, escalation_info in oldest_escalations:
+        assert evictor.image_reader.is_acked(escalation_info.image_location)
+    assert evictor.quota.stats()["records"] == len(newest_escalations)
+
+
+def test_recover_puts_back_a_file_taken_before_anything_was_evicted(
+    tmp_path: Path, filler: QueueFiller, evictor: QueueEvictor
+):
+    taken_path, escalations = filler.write_file(0, [True, False], dir_suffix=EVICTING_DIR_SUFFIX)
+    # The kept escalations were being written when the uploader stopped
+    temporary_path = taken_path.with_name(f"{taken_path.name}.tmp")
+    temporary_path.write_bytes(escalations[1][0])
+
+    evictor.recover()
+
+    queue_path = tmp_path / WRITING_DIR_SUFFIX / taken_path.name
+    assert queue_path.read_bytes() == b"".join(line for line, _escalation_info in escalations)
+    assert list((tmp_path / EVICTING_DIR_SUFFIX).iterdir()) == []
+    for _line, escalation_info in escalations:
+        assert not evictor.image_reader.is_acked(escalation_info.image_location)
+    stats = evictor.quota.stats()
+    assert (stats["bytes"], stats["records"]) == _usage(escalations)
+
+
+def test_recover_releases_the_images_of_a_file_whose_kept_escalations_were_moved_back(
+    tmp_path: Path, filler: QueueFiller, evictor: QueueEvictor
+):
+    audits = [True, False, True, False]
+    taken_path, escalations = filler.write_file(0, audits, dir_suffix=EVICTING_DIR_SUFFIX)
+    kept = [escalation for escalation, is_audit in zip(escalations, audits) if not is_audit]
+    # The uploader stopped after moving the kept escalations back, before releasing the evicted ones' images
+    queue_path = tmp_path / WRITING_DIR_SUFFIX / taken_path.name
+    queue_path.write_bytes(b"".join(line for line, _escalation_info in kept))
+    # The second file was untouched
+    _untouched_path, untouched_escalations = filler.write_file(1, [True])
+
+    evictor.recover()
+
+    assert queue_path.read_bytes() == b"".join(line for line, _escalation_info in kept)
+    assert not taken_path.exists()
+    for (_line, escalation_info), is_audit in zip(escalations, audits):
+        assert evictor.image_reader.is_acked(escalation_info.image_location) == is_audit
+    stats = evictor.quota.stats()
+    assert (stats["bytes"], stats["records"]) == _usage(kept + untouched_escalations)
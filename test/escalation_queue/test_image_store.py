@@ -0,0 +1,205 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from app.escalation_queue.image_store import (ACK_MAP_FILE_SUFFIX,
+                                              SEGMENT_DATA_OFFSET,
+                                              ImageSegmentReader,
+                                              ImageSegmentWriter)
+
+SEGMENT_SIZE_BYTES = 4096
+
+
+@pytest.fixture()
+def image_dir(tmp_path: Path) -> Path:
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    return image_dir
+
+
+@pytest.fixture()
+def image_writer(image_dir: Path):
+    writer = ImageSegmentWriter(image_dir, SEGMENT_SIZE_BYTES)
+    yield writer
+    writer.seal()
+
+
+@pytest.fixture()
+def image_reader(image_dir: Path):
+    reader = ImageSegmentReader(image_dir)
+    yield reader
+    reader.close()
+
+
+def _kill_writer(image_writer: ImageSegmentWriter) -> None:
+    """Stops the writer without sealing its segment, as when its process dies, which releases its lock."""
+    os.close(image_writer._fd)
+    image_writer._fd = None
+
+
+def test_images_are_read_back_from_their_segment(image_writer: ImageSegmentWriter, image_reader: ImageSegmentReader):
+    images = [b"first image", b"second image" * 10, b"third image"]
+    locations = [image_writer.append(image_bytes) for image_bytes in images]
+
+    assert {location.segment for location in locations} == {image_writer.segment_path.name}
+    assert [location.index for location in locations] == [0, 1, 2]
+    for location, image_bytes in zip(locations, images):
+        with image_reader.open_image(location) as image:
+            assert bytes(image.read()) == image_bytes
+
+
+def test_full_segment_is_sealed_and_reclaimed_once_drained(
+    image_dir: Path, image_writer: ImageSegmentWriter, image_reader: ImageSegmentReader
+):
+    image_bytes = b"x" * ((SEGMENT_SIZE_BYTES - SEGMENT_DATA_OFFSET) // 2)
+    first_segment_locations = [image_writer.append(image_bytes), image_writer.append(image_bytes)]
+    # The third image doesn't fit, so the first segment is sealed and the image starts a new one
+    next_segment_location = image_writer.append(image_bytes)
+    assert next_segment_location.segment != first_segment_locations[0].segment
+    first_segment_path = image_dir / first_segment_locations[0].segment
+
+    image_reader.ack(first_segment_locations[0])
+    assert first_segment_path.exists()
+    image_reader.ack(first_segment_locations[1])
+
+    assert not first_segment_path.exists()
+    assert sorted(path.name for path in image_dir.iterdir()) == [next_segment_location.segment]
+
+
+def test_drained_segment_isnt_reclaimed_while_its_writer_is_appending_to_it(
+    image_dir: Path, image_writer: ImageSegmentWriter, image_reader: ImageSegmentReader
+):
+    location = image_writer.append(b"image")
+    image_reader.ack(location)
+
+    assert image_reader.reclaim_drained_segments() == 0
+    assert image_reader.segment_path(location).exists()
+
+    image_writer.seal()
+    assert image_reader.reclaim_drained_segments() == 1
+    assert list(image_dir.iterdir()) == []
+
+
+def test_segment_whose_writer_died_is_reclaimed_once_drained(
+    image_dir: Path, image_writer: ImageSegmentWriter, image_reader: ImageSegmentReader
+):
+    locations = [image_writer.append(b"first image"), image_writer.append(b"second image")]
+    _kill_writer(image_writer)
+
+    image_reader.ack(locations[0])
+    assert image_reader.reclaim_drained_segments() == 0
+    image_reader.ack(locations[1])
+
+    assert list(image_dir.iterdir()) == []
+
+
+def test_empty_segment_whose_writer_died_is_reclaimed(
+    image_dir: Path, image_writer: ImageSegmentWriter, image_reader: ImageSegmentReader
+):
+    location = image_writer.append(b"image")
+    image_writer.seal()
+    image_reader.ack(location)
+    # The writer dies right after starting its next segment
+    image_writer.append(b"image")
+    image_writer._num_images = 0
+    image_writer._write_header(sealed=False)
+    _kill_writer(image_writer)
+
+    assert image_reader.reclaim_drained_segments() == 1
+    assert list(image_dir.iterdir()) == []
+
+
+def test_is_acked(image_writer: ImageSegmentWriter, image_reader: ImageSegmentReader):
+    locations = [image_writer.append(b"first image"), image_writer.append(b"second image")]
+    image_writer.seal()
+    assert not image_reader.is_acked(locations[0])
+
+    image_reader.ack(locations[0])
+    assert image_reader.is_acked(locations[0])
+    assert not image_reader.is_acked(locations[1])
+
+    # Once the segment has been reclaimed, all of its images count as acknowledged
+    image_reader.ack(locations[1])
+    assert not image_reader.segment_path(locations[0]).exists()
+    assert image_reader.is_acked(locations[0])
+    assert image_reader.is_acked(locations[1])
+
+
+def test_ack_of_an_image_in_a_reclaimed_segment_leaves_nothing_behind(
+    image_dir: Path, image_writer: ImageSegmentWriter, image_reader: ImageSegmentReader
+):
+    location = image_writer.append(b"image")
+    image_writer.seal()
+    image_reader.ack(location)
+
+    # E.g. the edge endpoint and the uploader both acknowledge an image
+    image_reader.ack(location)
+
+    assert list(image_dir.iterdir()) == []
+
+
+def test_ack_racing_another_process_reclaiming_the_segment_leaves_nothing_behind(
+    image_dir: Path, image_writer: ImageSegmentWriter, image_reader: ImageSegmentReader, monkeypatch: pytest.MonkeyPatch
+):
+    location = image_writer.append(b"image")
+    image_writer.seal()
+    ack_map_path = image_reader._ack_map_path
+
+    def reclaimed_by_another_process(segment: str) -> Path:
+        # The other process deletes the segment and its ack map after this one checked that the segment exists
+        (image_dir / segment).unlink(missing_ok=True)
+        (image_dir / f"{segment}{ACK_MAP_FILE_SUFFIX}").unlink(missing_ok=True)
+        return ack_map_path(segment)
+
+    monkeypatch.setattr(image_reader, "_ack_map_path", reclaimed_by_another_process)
+    image_reader.ack(location)
+
+    assert list(image_dir.iterdir()) == []
+
+
+def test_ack_map_of_a_reclaimed_segment_is_swept(
+    image_dir: Path, image_writer: ImageSegmentWriter, image_reader: ImageSegmentReader
+):
+    location = image_writer.append(b"image")
+    image_writer.seal()
+    image_reader.ack(location)
+    # Left behind by a process that died acknowledging the image while the segment was being reclaimed
+    orphaned_ack_map_path = image_dir / f"{location.segment}{ACK_MAP_FILE_SUFFIX}"
+    orphaned_ack_map_path.write_bytes(b"\x01")
+    live_location = image_writer.append(b"image")
+    image_reader.ack(live_location)
+
+    assert image_reader.reclaim_drained_segments() == 0
+
+    assert not orphaned_ack_map_path.exists()
+    assert (image_dir / f"{live_location.segment}{ACK_MAP_FILE_SUFFIX}").exists()
+
+
+def test_image_closed_after_its_segment_was_reclaimed(
+    image_dir: Path, image_writer: ImageSegmentWriter, image_reader: ImageSegmentReader
+):
+    location = image_writer.append(b"image")
+    image_writer.seal()
+    image = image_reader.open_image(location)
+
+    # The segment is reclaimed while the image is still being uploaded from its mapping
+    image_reader.ack(location)
+    assert list(image_dir.iterdir()) == []
+    assert bytes(image.read()) == b"image"
+
+    image.close()
+    image_reader.close()
+
+
+def test_reader_closed_while_an_image_is_open(image_writer: ImageSegmentWriter, image_reader: ImageSegmentReader):
+    location = image_writer.append(b"image")
+    image = image_reader.open_image(location)
+
+    image_reader.close()
+    assert bytes(image.read()) == b"image"
+    image.close()
+
+    # The segment is mapped again when it's next read
+    with image_reader.open_image(location) as image:
+        assert bytes(image.read()) == b"image"
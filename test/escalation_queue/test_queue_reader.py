@@ -0,0 +1,158 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from app.escalation_queue.constants import LEASE_NAME_SEPARATOR, READING_DIR_SUFFIX, WRITING_DIR_SUFFIX
+from app.escalation_queue.queue_reader import QueueReader
+
+LINES_PER_FILE = 10
+LEASE_TTL_SEC = 60.0
+
+
+def _queue_file_name(i: int) -> str:
+    return f"20260101_000000_{i:06d}-{'A' * 27}.txt"
+
+
+def _write_queue_file(base_dir: Path, i: int, dir_suffix: str = WRITING_DIR_SUFFIX) -> tuple[Path, list[str]]:
+    lines = [f"file {i} line {j}\n" for j in range(LINES_PER_FILE)]
+    path = base_dir / dir_suffix / _queue_file_name(i)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("".join(lines))
+    return path, lines
+
+
+def _make_reader(base_dir: Path, consumer_id: str, lease_ttl_sec: float = LEASE_TTL_SEC) -> QueueReader:
+    return QueueReader(
+        base_dir=str(base_dir),
+        event_driven=False,
+        checkpoint_every_lines=1,
+        consumer_id=consumer_id,
+        lease_ttl_sec=lease_ttl_sec,
+    )
+
+
+def _expire_leases(base_dir: Path) -> None:
+    expired_at = time.time() - 2 * LEASE_TTL_SEC
+    for path in (base_dir / READING_DIR_SUFFIX).iterdir():
+        os.utime(path, (expired_at, expired_at))
+
+
+@pytest.fixture()
+def readers():
+    created = []
+
+    def make(*args, **kwargs) -> QueueReader:
+        reader = _make_reader(*args, **kwargs)
+        created.append(reader)
+        return reader
+
+    yield make
+    for reader in created:
+        reader.close()
+
+
+def test_readers_racing_for_a_file_only_one_takes_it(tmp_path: Path, readers):
+    path, _lines = _write_queue_file(tmp_path, 0)
+    racers = [readers(tmp_path, "a"), readers(tmp_path, "b")]
+    start = threading.Barrier(len(racers))
+    taken = {}
+
+    def take(reader: QueueReader) -> None:
+        start.wait()
+        taken[reader.consumer_id] = reader._take(path, path.name)
+
+    threads = [threading.Thread(target=take, args=(reader,)) for reader in racers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    winners = [consumer_id for consumer_id, leased_path in taken.items() if leased_path is not None]
+    assert len(winners) == 1
+    assert [p.name for p in (tmp_path / READING_DIR_SUFFIX).iterdir()] == [
+        f"{path.name}{LEASE_NAME_SEPARATOR}{winners[0]}"
+    ]
+
+
+def test_concurrent_readers_consume_every_line_once(tmp_path: Path, readers):
+    expected = []
+    for i in range(20):
+        expected += _write_queue_file(tmp_path, i)[1]
+    consumers = [readers(tmp_path, "a"), readers(tmp_path, "b")]
+    consumed = []
+    consumed_lock = threading.Lock()
+
+    def consume(reader: QueueReader) -> None:
+        for batch in reader.iter_batches(max_batch_size=3):
+            with consumed_lock:
+                consumed.extend(batch)
+                if len(consumed) >= len(expected):
+                    for r in consumers:
+                        r.stop()
+
+    threads = [threading.Thread(target=consume, args=(reader,)) for reader in consumers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+
+    assert sorted(consumed) == sorted(expected)
+    # Each file is read in order, by a single reader
+    for i in range(20):
+        lines = [line for line in consumed if line.startswith(f"file {i} ")]
+        assert lines == [f"file {i} line {j}\n" for j in range(LINES_PER_FILE)]
+    assert list((tmp_path / READING_DIR_SUFFIX).iterdir()) == []
+
+
+def test_expired_lease_is_taken_over_from_the_checkpoint(tmp_path: Path, readers):
+    _path, lines = _write_queue_file(tmp_path, 0)
+    first = readers(tmp_path, "first")
+    first_lines = first.__iter__()
+    assert [next(first_lines) for _ in range(5)] == lines[:5]
+    # The first reader stops without finishing the file, and its lease runs out
+    first.close()
+    _expire_leases(tmp_path)
+
+    second = readers(tmp_path, "second")
+    second_lines = second.__iter__()
+    # The last line returned to the first reader wasn't checkpointed yet, so it's read again
+    assert [next(second_lines) for _ in range(6)] == lines[4:]
+    second.stop()
+    assert list(second_lines) == []
+    assert list((tmp_path / READING_DIR_SUFFIX).iterdir()) == []
+
+
+def test_stale_owner_leaves_the_file_to_the_reader_that_took_it_over(tmp_path: Path, readers):
+    _path, lines = _write_queue_file(tmp_path, 0)
+    stale = readers(tmp_path, "stale", lease_ttl_sec=0.2)
+    stale_lines = stale.__iter__()
+    assert [next(stale_lines) for _ in range(3)] == lines[:3]
+
+    # The stale reader stalls (its lease isn't renewed) until its lease expires and the file is taken over
+    with stale._lease_lock:
+        _expire_leases(tmp_path)
+        current = readers(tmp_path, "current")
+        current_lines = current.__iter__()
+        assert next(current_lines) == lines[2]
+    deadline = time.monotonic() + 5
+    while not stale._lease_lost and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert stale._lease_lost
+
+    # The stale reader stops reading the file, and doesn't delete it
+    stale.stop()
+    assert list(stale_lines) == []
+    reading_dir = tmp_path / READING_DIR_SUFFIX
+    assert sorted(p.name for p in reading_dir.iterdir()) == [
+        f"{_queue_file_name(0)}{LEASE_NAME_SEPARATOR}current",
+        f"tracking-{_queue_file_name(0)}",
+    ]
+
+    assert [next(current_lines) for _ in range(7)] == lines[3:]
+    current.stop()
+    assert list(current_lines) == []
+    assert list(reading_dir.iterdir()) == []
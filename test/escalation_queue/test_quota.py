@@ -0,0 +1,114 @@
+from pathlib import Path
+
+import pytest
+
+from app.escalation_queue.constants import USAGE_FILE_NAME
+from app.escalation_queue.quota import AUDIT_QUOTA_FRACTION, QueueQuota
+
+MAX_RECORDS = 10
+
+
+@pytest.fixture()
+def quotas(tmp_path: Path):
+    created = []
+
+    def make(*args, **kwargs) -> QueueQuota:
+        quota = QueueQuota(str(tmp_path), *args, **kwargs)
+        created.append(quota)
+        return quota
+
+    yield make
+    for quota in created:
+        quota.close()
+
+
+def test_audits_are_refused_once_the_queue_is_audit_quota_fraction_full(quotas):
+    quota = quotas(max_records=MAX_RECORDS)
+    num_audit_records = int(MAX_RECORDS * AUDIT_QUOTA_FRACTION)
+
+    # The last audit admitted brings the queue to exactly AUDIT_QUOTA_FRACTION
+    quota.add(0, num_records=num_audit_records - 1)
+    assert quota.admits(is_audit=True)
+    quota.add(0)
+    assert not quota.admits(is_audit=True)
+    assert quota.admits(is_audit=False)
+
+    # The rest of the quota is kept for escalations
+    quota.add(0, num_records=MAX_RECORDS - num_audit_records - 1)
+    assert not quota.admits(is_audit=True)
+    assert quota.admits(is_audit=False)
+    quota.add(0)
+    assert not quota.admits(is_audit=False)
+
+
+def test_admits_counts_the_bytes_of_the_escalation(quotas):
+    quota = quotas(max_bytes=1000)
+    quota.add(700)
+
+    assert quota.admits(is_audit=True, num_bytes=100)
+    assert not quota.admits(is_audit=True, num_bytes=101)
+    assert quota.admits(is_audit=False, num_bytes=300)
+    assert not quota.admits(is_audit=False, num_bytes=301)
+
+
+def test_fill_fraction_is_relative_to_the_tighter_limit(quotas):
+    quota = quotas(max_bytes=1000, max_records=4)
+    quota.add(100, num_records=2)
+    assert quota.fill_fraction() == 0.5
+
+    quota.add(700, num_records=1)
+    assert quota.fill_fraction() == 0.8
+
+
+def test_queue_without_limits_admits_everything(quotas):
+    quota = quotas()
+    quota.add(10**12, num_records=10**6)
+
+    assert quota.fill_fraction() == 0.0
+    assert quota.admits(is_audit=True, num_bytes=10**12)
+
+
+def test_usage_and_limits_are_shared_through_the_usage_file(quotas):
+    writer_quota = quotas(max_bytes=1000, max_records=MAX_RECORDS)
+    # The uploader doesn't know the limits, and keeps the ones set by the writers
+    uploader_quota = quotas()
+
+    writer_quota.add(300, num_records=3)
+    uploader_quota.release(100, evicted=True)
+
+    for quota in (writer_quota, uploader_quota):
+        assert quota.stats() == {
+            "bytes": 200,
+            "records": 2,
+            "max_bytes": 1000,
+            "max_records": MAX_RECORDS,
+            "fill_fraction": 0.2,
+            "evicted_records": 1,
+        }
+
+
+def test_usage_doesnt_drift_below_zero(quotas):
+    quota = quotas(max_records=MAX_RECORDS)
+    quota.add(100)
+    quota.release(150, num_records=2)
+
+    assert (quota.stats()["bytes"], quota.stats()["records"]) == (0, 0)
+
+
+def test_set_usage_replaces_the_tracked_usage_and_keeps_the_limits(quotas):
+    quota = quotas(max_bytes=1000, max_records=MAX_RECORDS)
+    quota.add(300, num_records=3)
+    quota.release(100, evicted=True)
+
+    quota.set_usage(500, 5)
+
+    stats = quota.stats()
+    assert (stats["bytes"], stats["records"]) == (500, 5)
+    assert (stats["max_bytes"], stats["max_records"], stats["evicted_records"]) == (1000, MAX_RECORDS, 1)
+
+
+def test_file_that_isnt_a_usage_file_is_refused(tmp_path: Path):
+    (tmp_path / USAGE_FILE_NAME).write_bytes(b"not a usage file, but long enough to be read as one")
+
+    with pytest.raises(ValueError):
+        QueueQuota(str(tmp_path))
@@ -0,0 +1,238 @@
+import asyncio
+import time
+from pathlib import Path
+
+import pytest
+
+from app.core.utils import get_formatted_timestamp_str
+from app.escalation_queue import uploader as uploader_module
+from app.escalation_queue.constants import IMAGE_DIR_SUFFIX
+from app.escalation_queue.eviction import QueueEvictor
+from app.escalation_queue.image_store import ImageSegmentReader
+from app.escalation_queue.models import EscalationInfo, SubmitImageQueryParams
+from app.escalation_queue.queue_reader import QueueReader
+from app.escalation_queue.quota import QueueQuota
+from app.escalation_queue.queue_writer import QueueWriter, convert_escalation_info_to_str
+from app.escalation_queue.uploader import EscalationUploader
+
+GRACE_SEC = 0.3
+
+
+class CloudError(Exception):
+    """An error response from the cloud, which `safe_call_sdk` turns into an `HTTPException`."""
+
+    def __init__(self, status: int) -> None:
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+
+class StubSdk:
+    """Stands in for the IntelliOptics SDK, recording the image queries submitted to it."""
+
+    def __init__(self, error_status: int | None = None) -> None:
+        self.error_status = error_status
+        self.submitted: list[tuple[str, bytes]] = []
+
+    def submit_image_query(self, image, image_query_id: str, **kwargs) -> None:
+        self.submitted.append((image_query_id, bytes(image.read())))
+        if self.error_status is not None:
+            raise CloudError(self.error_status)
+
+
+@pytest.fixture(autouse=True)
+def short_dispatch_grace(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(uploader_module, "DISPATCH_GRACE_SEC", GRACE_SEC)
+
+
+@pytest.fixture()
+def queue_writer(tmp_path: Path):
+    writer = QueueWriter(base_dir=str(tmp_path))
+    yield writer
+    writer.close()
+
+
+@pytest.fixture()
+def make_uploader(tmp_path: Path):
+    created = []
+
+    def make(io: StubSdk, detector_ios: dict | None = None) -> EscalationUploader:
+        image_reader = ImageSegmentReader(tmp_path / IMAGE_DIR_SUFFIX)
+        uploader = EscalationUploader(
+            io=io,
+            readers=[QueueReader(base_dir=str(tmp_path), event_driven=False)],
+            image_reader=image_reader,
+            max_uploads_per_sec=None,
+            evictor=QueueEvictor(str(tmp_path), QueueQuota(str(tmp_path)), image_reader),
+            detector_ios=detector_ios,
+        )
+        created.append(uploader)
+        return uploader
+
+    yield make
+    for uploader in created:
+        uploader.close()
+        uploader.evictor.quota.close()
+
+
+def _queue_escalation(
+    queue_writer: QueueWriter,
+    image_query_id: str,
+    image_bytes: bytes = b"image",
+    detector_id: str = "det_abc",
+    dispatched_at: float | None = None,
+) -> tuple[str, EscalationInfo]:
+    """Writes an escalation to the queue, as the edge endpoint does. Returns its line in the queue, and its info."""
+    image_path, image_location = queue_writer.append_image(image_bytes)
+    escalation_info = EscalationInfo(
+        timestamp=get_formatted_timestamp_str(),
+        detector_id=detector_id,
+        image_path_str=image_path,
+        request_id=f"req_{image_query_id}",
+        submit_iq_params=SubmitImageQueryParams(
+            patience_time=None,
+            confidence_threshold=0.9,
+            human_review=None,
+            metadata=None,
+            image_query_id=image_query_id,
+        ),
+        image_location=image_location,
+        dispatched_at=dispatched_at,
+    )
+    assert queue_writer.write_escalation(escalation_info)
+    return convert_escalation_info_to_str(escalation_info), escalation_info
+
+
+def _queue_usage(queue_writer: QueueWriter) -> tuple[int, int]:
+    stats = queue_writer.quota.stats()
+    return stats["bytes"], stats["records"]
+
+
+def test_escalation_is_uploaded_and_its_image_and_quota_released(queue_writer: QueueWriter, make_uploader):
+    line, escalation_info = _queue_escalation(queue_writer, "iq_1", image_bytes=b"image 1")
+    io = StubSdk()
+    uploader = make_uploader(io)
+
+    asyncio.run(uploader.upload(line))
+
+    assert io.submitted == [("iq_1", b"image 1")]
+    assert uploader.stats.uploaded == 1
+    assert uploader.image_reader.is_acked(escalation_info.image_location)
+    assert _queue_usage(queue_writer) == (0, 0)
+
+
+def test_escalation_whose_image_was_acknowledged_is_skipped(queue_writer: QueueWriter, make_uploader):
+    line, escalation_info = _queue_escalation(queue_writer, "iq_1")
+    # The edge endpoint submitted it itself
+    queue_writer.ack_image(escalation_info.image_location)
+    io = StubSdk()
+    uploader = make_uploader(io)
+
+    asyncio.run(uploader.upload(line))
+
+    assert io.submitted == []
+    assert uploader.stats.duplicates == 1
+    assert _queue_usage(queue_writer) == (0, 0)
+
+
+def test_escalation_read_again_is_only_uploaded_once(queue_writer: QueueWriter, make_uploader):
+    line, _escalation_info = _queue_escalation(queue_writer, "iq_1")
+    io = StubSdk()
+    uploader = make_uploader(io)
+
+    asyncio.run(uploader.upload(line))
+    asyncio.run(uploader.upload(line))
+
+    assert [image_query_id for image_query_id, _image in io.submitted] == ["iq_1"]
+    assert (uploader.stats.uploaded, uploader.stats.duplicates) == (1, 1)
+
+
+def test_dispatched_escalation_is_left_to_the_edge_endpoint_for_the_grace_period(
+    queue_writer: QueueWriter, make_uploader
+):
+    acked_line, acked_escalation_info = _queue_escalation(queue_writer, "iq_acked", dispatched_at=time.time())
+    unacked_line, _unacked_escalation_info = _queue_escalation(queue_writer, "iq_unacked", dispatched_at=time.time())
+    io = StubSdk()
+    uploader = make_uploader(io)
+
+    async def main():
+        uploads = asyncio.gather(uploader.upload(acked_line), uploader.upload(unacked_line))
+        await asyncio.sleep(GRACE_SEC / 2)
+        assert io.submitted == []
+        # The edge endpoint submits one of them within the grace period
+        queue_writer.ack_image(acked_escalation_info.image_location)
+        await uploads
+
+    start = time.monotonic()
+    asyncio.run(main())
+
+    assert time.monotonic() - start >= GRACE_SEC
+    assert [image_query_id for image_query_id, _image in io.submitted] == ["iq_unacked"]
+    assert (uploader.stats.uploaded, uploader.stats.duplicates) == (1, 1)
+    assert _queue_usage(queue_writer) == (0, 0)
+
+
+def test_escalation_dispatched_longer_ago_than_the_grace_period_is_uploaded_right_away(
+    queue_writer: QueueWriter, make_uploader
+):
+    line, _escalation_info = _queue_escalation(queue_writer, "iq_1", dispatched_at=time.time() - 2 * GRACE_SEC)
+    io = StubSdk()
+    uploader = make_uploader(io)
+
+    start = time.monotonic()
+    asyncio.run(uploader.upload(line))
+
+    assert time.monotonic() - start < GRACE_SEC
+    assert uploader.stats.uploaded == 1
+
+
+def test_conflict_from_the_cloud_counts_as_a_duplicate(queue_writer: QueueWriter, make_uploader):
+    line, escalation_info = _queue_escalation(queue_writer, "iq_1")
+    io = StubSdk(error_status=409)
+    uploader = make_uploader(io)
+
+    asyncio.run(uploader.upload(line))
+
+    assert len(io.submitted) == 1
+    assert (uploader.stats.uploaded, uploader.stats.duplicates, uploader.stats.retries) == (0, 1, 0)
+    assert uploader.image_reader.is_acked(escalation_info.image_location)
+    assert _queue_usage(queue_writer) == (0, 0)
+
+
+def test_escalation_rejected_by_the_cloud_is_dropped(queue_writer: QueueWriter, make_uploader):
+    line, escalation_info = _queue_escalation(queue_writer, "iq_1")
+    io = StubSdk(error_status=400)
+    uploader = make_uploader(io)
+
+    asyncio.run(uploader.upload(line))
+
+    assert (uploader.stats.uploaded, uploader.stats.dropped, uploader.stats.retries) == (0, 1, 0)
+    assert uploader.image_reader.is_acked(escalation_info.image_location)
+    assert _queue_usage(queue_writer) == (0, 0)
+
+
+def test_invalid_escalation_is_dropped(make_uploader):
+    uploader = make_uploader(StubSdk())
+    line = '{"not": "an escalation"}\n'
+    uploader.evictor.quota.add(len(line))
+
+    asyncio.run(uploader.upload(line))
+
+    assert uploader.stats.dropped == 1
+    assert uploader.evictor.quota.stats()["records"] == 0
+    assert uploader.evictor.quota.stats()["bytes"] == 0
+
+
+def test_escalations_are_uploaded_with_their_detectors_sdk_instance(queue_writer: QueueWriter, make_uploader):
+    line_a, _escalation_info_a = _queue_escalation(queue_writer, "iq_a", detector_id="det_a")
+    line_b, _escalation_info_b = _queue_escalation(queue_writer, "iq_b", detector_id="det_b")
+    io = StubSdk()
+    io_a = StubSdk()
+    uploader = make_uploader(io, detector_ios={"det_a": io_a})
+
+    async def main():
+        await asyncio.gather(uploader.upload(line_a), uploader.upload(line_b))
+
+    asyncio.run(main())
+
+    assert [image_query_id for image_query_id, _image in io_a.submitted] == ["iq_a"]
+    assert [image_query_id for image_query_id, _image in io.submitted] == ["iq_b"]